@@ -4,11 +4,89 @@ import './Sort.css';
 
 const API_BASE_URL = import.meta.env.VITE_API_BASE_URL;
 
+// Loading message for the current phase of a sort job
+const describeProgress = (job) => {
+    switch (job?.status) {
+        case 'fetching_tracks':
+            return `Fetched ${job.tracks_fetched} of ${job.tracks_total} tracks...`;
+        case 'resolving_artists':
+            return `Looked up ${job.artists_resolved} of ${job.artists_total} artists...`;
+        case 'grouping':
+        case 'done':
+            return 'Grouping tracks by genre...';
+        default:
+            return 'This may take a moment while we categorize tracks by genre.';
+    }
+};
+
+// Move the given track uris into targetGenre and drop removedUris (duplicates
+// removed by the server), dropping genres left empty
+const moveTracks = (genreGroups, movedUris, targetGenre, removedUris = []) => {
+    const moved = new Set(movedUris);
+    const removed = new Set(removedUris);
+    const movedTracks = [];
+    const updated = {};
+
+    for (const [genre, tracks] of Object.entries(genreGroups)) {
+        const remaining = [];
+        for (const track of tracks) {
+            if (removed.has(track.uri)) {
+                continue;
+            } else if (moved.has(track.uri)) {
+                movedTracks.push(track);
+            } else {
+                remaining.push(track);
+            }
+        }
+        if (remaining.length > 0 || genre === targetGenre) {
+            updated[genre] = remaining;
+        }
+    }
+
+    updated[targetGenre] = [...(updated[targetGenre] || []), ...movedTracks];
+    return updated;
+};
+
+// Rebuild {genre: [track]} from the ?columnar=true response, where artists
+// and images are sent once and tracks refer to them by index
+const expandColumnar = (columnar) => {
+    const { uri_prefix, image_prefix, artists, images, tracks } = columnar;
+    const withPrefix = (value, prefix, marker) => value.includes(marker) ? value : prefix + value;
+    const imageUrls = images.map(image => withPrefix(image, image_prefix, '://'));
+
+    const genreGroups = {};
+    for (const [genre, members] of columnar.genres) {
+        genreGroups[genre] = members.map(i => ({
+            name: tracks.name[i],
+            artist: artists[tracks.artist[i]],
+            uri: withPrefix(tracks.uri[i], uri_prefix, ':'),
+            image: tracks.image[i] >= 0 ? imageUrls[tracks.image[i]] : null,
+        }));
+    }
+    return genreGroups;
+};
+
+// Genre classifiers the server can group a playlist with
+const GROUPINGS = [
+    { value: 'primary', label: 'Exact genres' },
+    { value: 'taxonomy:2', label: 'Subgenres' },
+    { value: 'taxonomy:1', label: 'Main genres' },
+    { value: 'weighted', label: 'Best fit (all artists)' },
+];
+
 function Sort () {
     const [genreGroups, setGenreGroups] = useState({});
+    const [version, setVersion] = useState(null);
+    const [canUndo, setCanUndo] = useState(false);
+    const [canRedo, setCanRedo] = useState(false);
+    const [sortProgress, setSortProgress] = useState(null);
+    const [grouping, setGrouping] = useState('primary');
     const [isLoading, setIsLoading] = useState(true);
     const [error, setError] = useState(null);
     const [creatingPlaylist, setCreatingPlaylist] = useState(null);
+    const [exportingAll, setExportingAll] = useState(false);
+    // Leave out other releases of the same recording when combining and exporting
+    const [skipDuplicates, setSkipDuplicates] = useState(false);
     const [selectedTrack, setSelectedTrack] = useState(null);
     const [selectedTrackGenre, setSelectedTrackGenre] = useState(null);
     const [showGenreSelector, setShowGenreSelector] = useState(false);
@@ -32,19 +110,29 @@ function Sort () {
         fetchAndSortTracks();
     }, [playlistId]);
 
-    const fetchAndSortTracks = async () => {
+    // Sort in a background job so large playlists don't hit request timeouts
+    const fetchAndSortTracks = async (classifier = grouping) => {
         try {
             const response = await fetch (
-                `${API_BASE_URL}api/sort-playlist/${playlistId}/`,
+                `${API_BASE_URL}api/sort-jobs/`,
                 {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
                     credentials: 'include',
+                    body: JSON.stringify({
+                        playlist_id: playlistId,
+                        classifier: classifier,
+                    }),
                 });
             if (!response.ok) {
                 throw new Error('Failed to sort playlist');
             }
 
-            const data = await response.json();
-            setGenreGroups(data.genre_groups);
+            const job = await response.json();
+            await waitForSortJob(job.job_id);
+            await streamGenreGroups();
         } catch (err) {
             setError(err.message);
         } finally {
@@ -52,6 +140,149 @@ function Sort () {
         }
     }
 
+    // Regrouping sorts the playlist again from scratch with the chosen classifier
+    const changeGrouping = (classifier) => {
+        setGrouping(classifier);
+        setSortProgress(null);
+        setIsLoading(true);
+        fetchAndSortTracks(classifier);
+    };
+
+    // Follow a sort job's progress over server-sent events until it finishes
+    const waitForSortJob = (jobId) => new Promise((resolve, reject) => {
+        const events = new EventSource(
+            `${API_BASE_URL}api/sort-jobs/${jobId}/events/`,
+            { withCredentials: true }
+        );
+
+        events.onmessage = (event) => {
+            const job = JSON.parse(event.data);
+            setSortProgress(job);
+            if (job.status === 'done') {
+                events.close();
+                resolve();
+            } else if (job.status === 'failed') {
+                events.close();
+                reject(new Error(job.error || 'Failed to sort playlist'));
+            }
+        };
+        events.onerror = () => {
+            // The server ends long streams, EventSource reconnects unless it gave up
+            if (events.readyState === EventSource.CLOSED) {
+                reject(new Error('Lost connection while sorting playlist'));
+            }
+        };
+    });
+
+    // Load the sorted groups as NDJSON lines, rendering genres as they arrive
+    const streamGenreGroups = async () => {
+        const response = await fetch(
+            `${API_BASE_URL}api/genre-groups/${playlistId}/?stream=true`,
+            {
+                credentials: 'include',
+            });
+        if (!response.ok || !response.body) {
+            throw new Error('Failed to load genre groups');
+        }
+
+        const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+        let buffer = '';
+        let started = false;
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) {
+                break;
+            }
+            buffer += value;
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+
+            const chunks = [];
+            for (const line of lines.filter(Boolean)) {
+                const data = JSON.parse(line);
+                if (data.genre === undefined) {
+                    setVersion(data.version);
+                    setCanUndo(data.can_undo);
+                    setCanRedo(data.can_redo);
+                } else {
+                    chunks.push(data);
+                }
+            }
+            if (!started) {
+                setGenreGroups({});
+                started = true;
+            }
+            if (chunks.length > 0) {
+                // Large genres come in several lines, append to what's there
+                setGenreGroups(prev => {
+                    const updated = { ...prev };
+                    for (const { genre, tracks } of chunks) {
+                        updated[genre] = [...(updated[genre] || []), ...tracks];
+                    }
+                    return updated;
+                });
+                setIsLoading(false);
+            }
+        }
+    };
+
+    // Reload the stored genre groups without re-sorting the playlist
+    const resyncGenreGroups = async () => {
+        const response = await fetch(
+            `${API_BASE_URL}api/genre-groups/${playlistId}/?columnar=true`,
+            {
+                credentials: 'include',
+            });
+        if (!response.ok) {
+            throw new Error('Failed to load genre groups');
+        }
+
+        const data = await response.json();
+        setGenreGroups(expandColumnar(data.columnar));
+        setVersion(data.version);
+        setCanUndo(data.can_undo);
+        setCanRedo(data.can_redo);
+    };
+
+    // Patch local state from an edit delta, resyncing if our copy was stale
+    const applyDelta = async (data) => {
+        setCanUndo(data.can_undo);
+        setCanRedo(data.can_redo);
+        if (data.base_version !== version) {
+            await resyncGenreGroups();
+            return;
+        }
+        setGenreGroups(prev => moveTracks(prev, data.moved_uris, data.genre, data.removed_uris));
+        setVersion(data.version);
+    };
+
+    // Step through the server's edit journal, the full grouping comes back
+    const undoOrRedo = async (action) => {
+        try {
+            const response = await fetch(`${API_BASE_URL}api/${action}-edit/?columnar=true`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                credentials: 'include',
+                body: JSON.stringify({ playlist_id: playlistId })
+            });
+
+            if (!response.ok) {
+                throw new Error(`Failed to ${action}`);
+            }
+
+            const data = await response.json();
+            setGenreGroups(expandColumnar(data.columnar));
+            setVersion(data.version);
+            setCanUndo(data.can_undo);
+            setCanRedo(data.can_redo);
+        } catch (err) {
+            console.error(`Error during ${action}:`, err);
+            alert(`Failed to ${action}. Please try again.`);
+        }
+    };
+
     const CreatePlaylist = async (genre) => {
         setCreatingPlaylist(genre);
         try {
@@ -66,6 +297,7 @@ function Sort () {
                     body: JSON.stringify({
                         playlist_id: playlistId,
                         genre: genre,
+                        dedupe: skipDuplicates,
                     }),
                 }
             );
@@ -82,6 +314,43 @@ function Sort () {
         }
     }
 
+    const exportAllGenres = async () => {
+        setExportingAll(true);
+        try {
+            const response = await fetch(
+                `${API_BASE_URL}api/create-playlists/`,
+                {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    credentials: 'include',
+                    body: JSON.stringify({
+                        playlist_id: playlistId,
+                        genres: 'all',
+                        dedupe: skipDuplicates,
+                    }),
+                }
+            );
+            if (!response.ok) {
+                throw new Error('Failed to create playlists');
+            }
+
+            const data = await response.json();
+            const failed = data.results.filter(result => !result.success);
+            const created = data.results.length - failed.length;
+            if (failed.length) {
+                alert(`Created ${created} playlists, failed for: ${failed.map(result => result.genre).join(', ')}`);
+            } else {
+                alert(`Created ${created} playlists successfully!`);
+            }
+        } catch (err) {
+            alert(`Error: ${err.message}`);
+        } finally {
+            setExportingAll(false);
+        }
+    }
+
     const assignGenreToTrack = async (trackUri, newGenre, currentGenre) => {
         try {
             const response = await fetch(`${API_BASE_URL}api/assign-genre/`, {
@@ -94,7 +363,8 @@ function Sort () {
                     playlist_id: playlistId,
                     track_uri: trackUri,
                     genre: newGenre,
-                    current_genre: currentGenre
+                    current_genre: currentGenre,
+                    delta: true
                 })
             });
 
@@ -103,7 +373,7 @@ function Sort () {
             }
 
             const data = await response.json();
-            setGenreGroups(data.genre_groups);
+            await applyDelta(data);
             setShowGenreSelector(false);
             setShowTrackModal(false);
             setSelectedTrack(null);
@@ -136,7 +406,9 @@ function Sort () {
                 credentials: 'include',
                 body: JSON.stringify({
                     playlist_id: playlistId,
-                    genres: selectedGenres
+                    genres: selectedGenres,
+                    dedupe: skipDuplicates,
+                    delta: true
                 })
             });
 
@@ -145,10 +417,11 @@ function Sort () {
             }
 
             const data = await response.json();
-            setGenreGroups(data.genre_groups);
+            await applyDelta(data);
             setCombineMode(false);
             setSelectedGenres([]);
-            alert(`Successfully combined into "${data.combined_genre_name}"`);
+            const removed = data.duplicates_removed ? `, removed ${data.duplicates_removed} duplicates` : '';
+            alert(`Successfully combined into "${data.combined_genre_name}"${removed}`);
         } catch (err) {
             console.error('Error combining genres:', err);
             alert('Failed to combine genres. Please try again.');
@@ -167,7 +440,8 @@ function Sort () {
                     playlist_id: playlistId,
                     artist_name: artistName,
                     genre: newGenre,
-                    current_genre: currentGenre
+                    current_genre: currentGenre,
+                    delta: true
                 })
             });
 
@@ -176,7 +450,7 @@ function Sort () {
             }
 
             const data = await response.json();
-            setGenreGroups(data.genre_groups);
+            await applyDelta(data);
             setShowArtistGenreSelector(false);
             setShowTrackModal(false);
             setSelectedTrack(null);
@@ -197,7 +471,7 @@ function Sort () {
         return (
             <div className="loading-message">
                 <h2>Analyzing your playlist...</h2>
-                <p>This may take a moment while we categorize tracks by genre.</p>
+                <p>{describeProgress(sortProgress)}</p>
             </div>
         );
     }
@@ -228,6 +502,29 @@ function Sort () {
                     Found {genreEntries.length} genres with {Object.values(genreGroups).flat().length} total tracks
                 </p>
                 <div className="header-actions">
+                    <select
+                        className="grouping-select"
+                        value={grouping}
+                        onChange={(e) => changeGrouping(e.target.value)}
+                    >
+                        {GROUPINGS.map(({ value, label }) => (
+                            <option key={value} value={value}>{label}</option>
+                        ))}
+                    </select>
+                    <label className="dedupe-toggle">
+                        <input
+                            type="checkbox"
+                            checked={skipDuplicates}
+                            onChange={(e) => setSkipDuplicates(e.target.checked)}
+                        />
+                        Skip duplicates
+                    </label>
+                    <button className="undo-btn" onClick={() => undoOrRedo('undo')} disabled={!canUndo}>
+                        Undo
+                    </button>
+                    <button className="undo-btn" onClick={() => undoOrRedo('redo')} disabled={!canRedo}>
+                        Redo
+                    </button>
                     <button 
                         className={`combine-btn ${combineMode ? 'active' : ''}`}
                         onClick={() => {
@@ -242,6 +539,13 @@ function Sort () {
                             Combine {selectedGenres.length} Genres
                         </button>
                     )}
+                    <button
+                        className="export-all-btn"
+                        onClick={exportAllGenres}
+                        disabled={exportingAll || genreEntries.length === 0}
+                    >
+                        {exportingAll ? 'Creating Playlists...' : 'Export All Genres'}
+                    </button>
                     <button className="back-btn" onClick={() => navigate('/playlists')}>
                         ← Back to Playlists
                     </button>
@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from django.core.signals import request_started
+
+        from .jobs import fail_interrupted_jobs
+
+        # On the first request rather than here, ready() shouldn't query the database
+        request_started.connect(fail_interrupted_jobs, dispatch_uid='api.fail_interrupted_jobs')
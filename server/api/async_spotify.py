@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import weakref
+
+import httpx
+from django.conf import settings
+
+from .metrics import record_rate_limit_wait, record_spotify_call, record_spotify_retry
+from .spotify import (
+    ARTIST_BATCH_SIZE,
+    SpotifyFetchError,
+    backoff_delay,
+    retry_after_seconds,
+    spotify_rate_limiter,
+)
+
+logger = logging.getLogger(__name__)
+
+# One pooled client per event loop, clients can't be shared across loops
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """
+    Keep-alive connection pool shared by every request on the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            base_url=settings.SPOTIFY_API_URL,
+            timeout=httpx.Timeout(10.0),
+            limits=httpx.Limits(
+                max_connections=settings.SPOTIFY_ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.SPOTIFY_ASYNC_MAX_CONNECTIONS,
+            ),
+        )
+        _clients[loop] = client
+    return client
+
+
+async def spotify_request(access_token, method, path, params=None, json=None):
+    """
+    Async counterpart of call_spotify: shares the same rate limiter and retries
+    429s, 5xx responses and connection errors with backoff
+    """
+    response = await send(access_token, method, path, params=params, json=json)
+    return response.json()
+
+
+async def send(access_token, method, path, params=None, json=None, etag=None):
+    """
+    spotify_request returning the httpx response, 304 Not Modified included
+    """
+    client = get_async_client()
+    headers = {'Authorization': f'Bearer {access_token}'}
+    if etag:
+        headers['If-None-Match'] = etag
+    max_retries = settings.SPOTIFY_MAX_RETRIES
+
+    # Label by endpoint rather than full path so ids don't explode the metric
+    call = f"{method} {path.split('/')[0]}"
+
+    for attempt in range(max_retries + 1):
+        waited = 0
+        while wait := spotify_rate_limiter.reserve():
+            await asyncio.sleep(wait)
+            waited += wait
+        if waited:
+            record_rate_limit_wait(waited)
+
+        try:
+            response = await client.request(method, path, params=params, json=json, headers=headers)
+        except httpx.TransportError as e:
+            delay = backoff_delay(attempt)
+            error = e
+            record_spotify_call(call, 'connection_error')
+        else:
+            if response.status_code == 429:
+                spotify_rate_limiter.throttle(retry_after_seconds(response.headers))
+                delay = 0
+                record_spotify_call(call, 'rate_limited')
+            elif response.status_code >= 500:
+                delay = backoff_delay(attempt)
+                record_spotify_call(call, 'server_error')
+            elif response.status_code >= 400:
+                record_spotify_call(call, 'client_error')
+                raise SpotifyFetchError(f"Spotify {method} {path} returned {response.status_code}", status=response.status_code)
+            else:
+                spotify_rate_limiter.recover()
+                record_spotify_call(call, 'ok')
+                return response
+            error = f"status {response.status_code}"
+
+        logger.warning(f"Spotify {method} {path} failed (attempt {attempt + 1}/{max_retries + 1}): {error}")
+        if attempt < max_retries:
+            record_spotify_retry(call)
+            if delay:
+                await asyncio.sleep(delay)
+
+    raise SpotifyFetchError(f"Spotify {method} {path} failed after {max_retries + 1} attempts")
+
+
+async def fetch_all_pages(access_token, path, limit, parse_item=None, **params):
+    """
+    Async counterpart of spotify.fetch_all_pages
+    """
+    def parse_page(page):
+        if parse_item is None:
+            return page['items']
+        return [record for record in map(parse_item, page['items']) if record is not None]
+
+    first_page = await spotify_request(access_token, 'GET', path, params={**params, 'limit': limit, 'offset': 0})
+    items = parse_page(first_page)
+
+    offsets = range(limit, first_page.get('total') or 0, limit)
+    semaphore = asyncio.Semaphore(settings.SPOTIFY_MAX_WORKERS)
+
+    async def fetch_page(offset):
+        async with semaphore:
+            page = await spotify_request(access_token, 'GET', path, params={**params, 'limit': limit, 'offset': offset})
+        return parse_page(page)
+
+    # gather keeps the pages in offset order
+    for page_items in await asyncio.gather(*(fetch_page(offset) for offset in offsets)):
+        items.extend(page_items)
+
+    return items
+
+
+async def conditional_get(access_token, path, etag=None, **params):
+    """
+    Async counterpart of spotify.conditional_get, returns (data, etag) with
+    data None on 304 Not Modified
+    """
+    response = await send(access_token, 'GET', path, params=params, etag=etag)
+    if response.status_code == 304:
+        return None, etag
+    return response.json(), response.headers.get('ETag')
+
+
+async def fetch_artist_genres(access_token, artist_ids):
+    """
+    Async counterpart of spotify.fetch_artist_genres, {artist_id: [genres]}
+    """
+    semaphore = asyncio.Semaphore(settings.SPOTIFY_MAX_WORKERS)
+
+    async def fetch_batch(batch):
+        async with semaphore:
+            data = await spotify_request(access_token, 'GET', 'artists', params={'ids': ','.join(batch)})
+        return {artist['id']: artist.get('genres', []) for artist in data['artists'] if artist}
+
+    artist_genres = {}
+    batches = [artist_ids[i:i + ARTIST_BATCH_SIZE] for i in range(0, len(artist_ids), ARTIST_BATCH_SIZE)]
+    for batch_genres in await asyncio.gather(*map(fetch_batch, batches)):
+        artist_genres.update(batch_genres)
+    return artist_genres
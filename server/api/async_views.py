@@ -0,0 +1,194 @@
+import logging
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.shortcuts import redirect
+from django.views import View
+
+from . import async_spotify
+from .metrics import phase
+from .models import SortResult
+from .classification import get_classifier
+from .concurrency import TooManyInFlight, sort_flights, user_limiter
+from .genre_cache import artist_genre_cache
+from .sorting import new_tracks_since
+from .spotify import PLAYLIST_TRACK_FIELDS, SpotifyFetchError, parse_track, spotify_pool
+from .streaming import genre_group_lines, ndjson_response, playlist_lines
+from .user_cache import aget_playlists, aget_profile, invalidate_user
+
+logger = logging.getLogger(__name__)
+
+# Async versions of the Spotify-bound views, used instead of the APIView
+# versions in views.py when SPOTIFY_ASYNC_VIEWS is on and served over ASGI.
+# They need every middleware to be async capable (see MIDDLEWARE in settings),
+# one sync middleware makes Django run them through a single thread.
+# Database work, the artist cache and classifying run in worker threads,
+# every Spotify call goes through the httpx client on the event loop.
+
+
+def wants_stream(request):
+    return request.GET.get('stream', 'false').lower() == 'true'
+
+async def genre_groups_response(request, sort_result):
+    dedupe = request.GET.get('dedupe', 'false').lower() == 'true'
+    if wants_stream(request):
+        lines = await sync_to_async(genre_group_lines)(sort_result, dedupe=dedupe)
+        return ndjson_response(lines, asynchronous=True)
+    columnar = request.GET.get('columnar', 'false').lower() == 'true'
+    return JsonResponse(await sync_to_async(sort_result.groups_payload)(columnar=columnar, dedupe=dedupe))
+
+async def aresolve_artist_genres(access_token, artist_ids):
+    """
+    Async counterpart of sorting.resolve_artist_genres
+    """
+    artist_genres_map, missing_artist_ids = await sync_to_async(artist_genre_cache.get_many)(artist_ids)
+    with phase('fetch_artists'):
+        fetched_genres = await async_spotify.fetch_artist_genres(access_token, missing_artist_ids)
+    artist_genres_map.update(fetched_genres)
+    artist_genre_cache.set_many(fetched_genres)
+    return artist_genres_map
+
+async def aget_session_key(request):
+    if not request.session.session_key:
+        await request.session.asave()
+    return request.session.session_key
+
+class AsyncSpotifyLoginView(View):
+    async def get(self, request, *args, **kwargs):
+        # reset session to ensure new user data
+        if request.session.session_key:
+            await SortResult.objects.filter(session_key=request.session.session_key).adelete()
+            await sync_to_async(invalidate_user)(request.session.session_key)
+        await request.session.aflush()
+        auth_url = spotify_pool.oauth().get_authorize_url()
+        return redirect(auth_url)
+
+class AsyncIsAuthenticatedView(View):
+    async def get(self, request, *args, **kwargs):
+        # Validate token, only hits Spotify when it needs refreshing
+        token_info = await sync_to_async(spotify_pool.session_token)(request.session)
+
+        if not token_info:
+            return JsonResponse({'status': False})
+
+        # Through the same ETag cache as the sync views
+        session_key = await aget_session_key(request)
+        try:
+            user_info = await aget_profile(session_key, token_info['access_token'])
+        except SpotifyFetchError as e:
+            logger.error(f"Error fetching current user: {e}")
+            return JsonResponse({'error': 'Failed to fetch user from Spotify'}, status=e.response_status)
+
+        user_data = {
+            'name': user_info.get('display_name', 'User'),
+            'image_url': user_info['images'][0]['url'] if user_info.get('images') else None
+        }
+        return JsonResponse({'status': True, 'user': user_data})
+
+class AsyncGetPlaylistsView(View):
+    async def get(self, request, *args, **kwargs):
+        token_info = await sync_to_async(spotify_pool.session_token)(request.session)
+
+        if not token_info:
+            return JsonResponse({'error': 'Token expired'}, status=401)
+
+        session_key = await aget_session_key(request)
+        try:
+            playlists = await aget_playlists(session_key, token_info['access_token'])
+        except SpotifyFetchError as e:
+            logger.error(f"Error fetching playlists: {e}")
+            return JsonResponse({'error': 'Failed to fetch playlists from Spotify'}, status=e.response_status)
+
+        if wants_stream(request):
+            return ndjson_response(playlist_lines(playlists), asynchronous=True)
+        return JsonResponse({'playlists': playlists})
+
+class AsyncSortPlaylistByGenreView(View):
+    async def get(self, request, playlist_id, *args, **kwargs):
+        token_info = await sync_to_async(spotify_pool.session_token)(request.session)
+
+        if not token_info:
+            return JsonResponse({'error': 'Not authenticated'}, status=401)
+
+        session_key = await aget_session_key(request)
+        refresh = request.GET.get('refresh', 'false').lower() == 'true'
+        try:
+            classifier = get_classifier(request.GET.get('classifier'))
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        async def sort():
+            with user_limiter.slot(session_key):
+                return await self.sort(token_info['access_token'], session_key, playlist_id, refresh, classifier)
+
+        # Identical sorts already running (double clicks, re-renders) are joined rather than repeated
+        try:
+            sort_result = await sort_flights.ado(('sort', session_key, playlist_id, classifier.name, refresh), sort)
+        except TooManyInFlight as e:
+            return JsonResponse({'error': str(e)}, status=429, headers={'Retry-After': '1'})
+        except SpotifyFetchError as e:
+            return JsonResponse({'error': str(e)}, status=e.response_status)
+
+        return await genre_groups_response(request, sort_result)
+
+    async def sort(self, access_token, session_key, playlist_id, refresh, classifier):
+        """
+        Async counterpart of sorting.sort_playlist, returns the SortResult
+        """
+        try:
+            with phase('snapshot'):
+                playlist = await async_spotify.spotify_request(
+                    access_token, 'GET', f'playlists/{playlist_id}', params={'fields': 'snapshot_id'}
+                )
+        except SpotifyFetchError as e:
+            logger.error(f"Error fetching snapshot for playlist {playlist_id}: {e}")
+            raise SpotifyFetchError('Failed to fetch playlist from Spotify', status=e.status) from e
+
+        snapshot_id = playlist['snapshot_id']
+        previous = None
+        if not refresh:
+            previous = await SortResult.objects.filter(session_key=session_key, playlist_id=playlist_id).afirst()
+        if previous and previous.classifier != classifier.name:
+            previous = None
+
+        # Unchanged playlist, the stored grouping is still current
+        if previous and previous.snapshot_id == snapshot_id:
+            return previous
+
+        try:
+            with phase('fetch_tracks'):
+                tracks = await async_spotify.fetch_all_pages(
+                    access_token,
+                    f'playlists/{playlist_id}/tracks',
+                    limit=100,
+                    parse_item=parse_track,
+                    fields=PLAYLIST_TRACK_FIELDS,
+                    additional_types='track',
+                )
+        except SpotifyFetchError as e:
+            logger.error(f"Error fetching tracks for playlist {playlist_id}: {e}")
+            raise SpotifyFetchError('Failed to fetch playlist tracks from Spotify', status=e.status) from e
+
+        # Only tracks added since the previous snapshot need classifying
+        removed_uris = set()
+        if previous and previous.snapshot_id:
+            tracks, removed_uris = await sync_to_async(new_tracks_since)(previous, tracks)
+
+        try:
+            artist_genres_map = await aresolve_artist_genres(access_token, classifier.artist_ids(tracks))
+        except SpotifyFetchError as e:
+            logger.error(f"Error fetching artists for playlist {playlist_id}: {e}")
+            raise SpotifyFetchError('Failed to fetch artist genres from Spotify', status=e.status) from e
+
+        known_genres = await sync_to_async(previous.genres)() if previous and previous.snapshot_id else ()
+        with phase('classify'):
+            genre_groups = await sync_to_async(classifier.classify, thread_sensitive=False)(
+                tracks, artist_genres_map, known_genres=known_genres
+            )
+
+        if previous and previous.snapshot_id:
+            await sync_to_async(previous.apply_playlist_changes)(genre_groups, removed_uris, snapshot_id)
+            return previous
+        return await sync_to_async(SortResult.store)(
+            session_key, playlist_id, genre_groups, snapshot_id=snapshot_id, classifier=classifier.name
+        )
@@ -0,0 +1,188 @@
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from scipy import sparse
+
+from .taxonomy import genre_taxonomy
+
+# Pluggable genre classifiers. Each one turns TrackRecords plus an
+# {artist_id: [genres]} map into the {genre: [track_info]} groups that get
+# stored, and says which artists it needs genres for.
+
+
+def track_info(track):
+    return {
+        'name': track.name,
+        'artist': track.artist,
+        'uri': track.uri,
+        'image': track.image,
+        # Stored for duplicate detection, not sent to the client
+        'isrc': track.isrc,
+    }
+
+
+class PrimaryGenreClassifier:
+    """
+    Puts each track under its first artist's first genre, tracks whose
+    artist has no genres go under 'unknown'
+    """
+    name = 'primary'
+
+    def artist_ids(self, tracks):
+        return list(set(track.artist_id for track in tracks if track.artist_id))
+
+    def classify(self, tracks, artist_genres_map, known_genres=()):
+        genre_groups = defaultdict(list)
+
+        for track in tracks:
+            artist_genres = artist_genres_map.get(track.artist_id, [])
+
+            #If artist does not have a genre, add to unknown
+            if not artist_genres:
+                genre_groups['unknown'].append(track_info(track))
+            else:
+                genre_groups[artist_genres[0]].append(track_info(track))
+
+        # Convert defaultdict to regular dict for JSON serialization
+        return dict(genre_groups)
+
+
+class WeightedGenreClassifier:
+    """
+    Scores every track against all genres of all of its artists and groups
+    the playlist into at most max_groups groups (more only if the stored
+    grouping already uses more genres than that).
+
+    Tracks become rows of a sparse track x genre weight matrix: each artist
+    gets an equal share of the track, split over its genres with earlier
+    genres weighted higher. The most weighted genres of the playlist are the
+    parents, and a genre x genre similarity built from which genres appear
+    on the same tracks lets micro-genres score towards those parents.
+    Every track is then assigned in one sparse product. Tracks unrelated to
+    every parent go under 'other' and tracks without genres under 'unknown',
+    both count towards max_groups, though one parent is always kept.
+    """
+    name = 'weighted'
+
+    # Genres at least this similar to an existing parent don't become parents themselves
+    PARENT_SIMILARITY = 0.2
+    OTHER = 'other'
+
+    def __init__(self, max_groups):
+        self.max_groups = max_groups
+
+    def artist_ids(self, tracks):
+        return list(set(artist_id for track in tracks for artist_id in track.artist_ids))
+
+    def classify(self, tracks, artist_genres_map, known_genres=()):
+        genre_index = {}
+        rows, cols, weights = [], [], []
+
+        for row, track in enumerate(tracks):
+            artist_ids = [artist_id for artist_id in track.artist_ids if artist_genres_map.get(artist_id)]
+            for artist_id in artist_ids:
+                genres = artist_genres_map[artist_id]
+                rank_weights = [1 / rank for rank in range(1, len(genres) + 1)]
+                share = 1 / (sum(rank_weights) * len(artist_ids))
+                for genre, weight in zip(genres, rank_weights):
+                    rows.append(row)
+                    cols.append(genre_index.setdefault(genre, len(genre_index)))
+                    weights.append(weight * share)
+
+        if not genre_index:
+            return {'unknown': [track_info(track) for track in tracks]} if tracks else {}
+
+        genres = np.array(list(genre_index), dtype=object)
+        # Duplicate (track, genre) entries are summed on conversion
+        track_genres = sparse.csr_matrix((weights, (rows, cols)), shape=(len(tracks), len(genres)))
+
+        # Genre similarity: cosine of the genres' columns, so genres that keep
+        # appearing on the same tracks score towards each other
+        similarity = (track_genres.T @ track_genres).tocsr()
+        norms = np.sqrt(similarity.diagonal())
+        norms[norms == 0] = 1
+        scale = sparse.diags(1 / norms)
+        similarity = (scale @ similarity @ scale).tocsr()
+
+        # Parents are genres already used by the grouping, then the most
+        # weighted genres that aren't too close to a parent already picked
+        has_genres = np.diff(track_genres.indptr) > 0
+        # 'unknown' takes up one of the groups
+        limit = max(self.max_groups - int(not has_genres.all()), 1)
+        popularity = np.asarray(track_genres.sum(axis=0)).ravel()
+        known = [genre_index[genre] for genre in dict.fromkeys(known_genres) if genre in genre_index]
+        parents = list(known)
+        for column in np.argsort(-popularity, kind='stable'):
+            if len(parents) >= limit:
+                break
+            if column in parents:
+                continue
+            if parents and similarity[column, parents].max() >= self.PARENT_SIMILARITY:
+                continue
+            parents.append(column)
+
+        scores = (track_genres @ similarity[:, parents]).toarray()
+        unrelated = has_genres & (scores.max(axis=1) == 0)
+        if unrelated.any() and len(parents) >= limit > len(known) and len(parents) > 1:
+            # 'other' needs a group too, the least popular new parent makes
+            # room. The last parent stays, everything can't be 'other'.
+            parents.pop()
+            scores = (track_genres @ similarity[:, parents]).toarray()
+            unrelated = has_genres & (scores.max(axis=1) == 0)
+
+        best_parent = genres[np.array(parents)[scores.argmax(axis=1)]]
+        best_parent[unrelated] = self.OTHER
+
+        genre_groups = defaultdict(list)
+        for track, genre, classified in zip(tracks, best_parent, has_genres):
+            genre_groups[genre if classified else 'unknown'].append(track_info(track))
+        return dict(genre_groups)
+
+
+class TaxonomyGenreClassifier:
+    """
+    Groups tracks by where their first artist's genre sits in the bundled
+    genre taxonomy, cut at depth: 1 groups by top-level genre (pop, rock...),
+    2 by the genres under those (indie pop, dance pop...) and so on.
+    """
+    def __init__(self, depth):
+        self.depth = depth
+        self.name = f'taxonomy:{depth}'
+
+    def artist_ids(self, tracks):
+        return list(set(track.artist_id for track in tracks if track.artist_id))
+
+    def classify(self, tracks, artist_genres_map, known_genres=()):
+        genre_groups = defaultdict(list)
+
+        for track in tracks:
+            artist_genres = artist_genres_map.get(track.artist_id, [])
+            if not artist_genres:
+                genre_groups['unknown'].append(track_info(track))
+                continue
+
+            # Prefer a genre the taxonomy actually lists over a guessed placement
+            genre = next((genre for genre in artist_genres if genre in genre_taxonomy), artist_genres[0])
+            genre_groups[genre_taxonomy.ancestor(genre, self.depth)].append(track_info(track))
+
+        return dict(genre_groups)
+
+
+def get_classifier(name=None):
+    """
+    Classifier by name, settings.GENRE_CLASSIFIER if none is given. The
+    taxonomy classifier takes its depth after a colon ('taxonomy:2').
+    Raises ValueError for unknown names.
+    """
+    name = name or settings.GENRE_CLASSIFIER
+    kind, _, option = name.partition(':')
+    if name == PrimaryGenreClassifier.name:
+        return PrimaryGenreClassifier()
+    if name == WeightedGenreClassifier.name:
+        return WeightedGenreClassifier(max_groups=settings.GENRE_MAX_GROUPS)
+    if kind == 'taxonomy':
+        depth = option or str(settings.GENRE_TAXONOMY_DEPTH)
+        if depth.isdigit() and int(depth) >= 1:
+            return TaxonomyGenreClassifier(int(depth))
+    raise ValueError(f"Unknown genre classifier: {name}")
@@ -0,0 +1,134 @@
+from array import array
+
+# Column-oriented form of a stored grouping. Artist names and album images
+# are kept once in lookup tables and tracks refer to them by index, genres are
+# arrays of track indices. Only expanded into per-track dicts at the API
+# boundary, or sent as is to clients that ask for ?columnar=true.
+
+TRACK_URI_PREFIX = 'spotify:track:'
+IMAGE_URL_PREFIX = 'https://i.scdn.co/image/'
+
+
+def _strip_prefix(value, prefix):
+    # Values without the usual prefix (local files, other image hosts) are
+    # kept whole, and still contain the marker (':' or '://') the prefix ends with
+    return value[len(prefix):] if value.startswith(prefix) else value
+
+
+def _add_prefix(value, prefix, marker):
+    return value if marker in value else prefix + value
+
+
+class ColumnarGroups:
+    __slots__ = ('artists', 'images', 'names', 'uris', 'artist_index', 'image_index', 'genres')
+
+    def __init__(self):
+        self.artists = []
+        self.images = []
+        self.names = []
+        # Track uris without the spotify:track: prefix
+        self.uris = []
+        self.artist_index = array('I')
+        # -1 for tracks without an image
+        self.image_index = array('i')
+        # genre -> track indices, genres in display order
+        self.genres = {}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds the columns from (genre, uri, name, artist, image) rows in
+        display order. Genres come out ordered by their first track.
+        """
+        groups = cls()
+        artist_ids = {}
+        image_ids = {}
+
+        for genre, uri, name, artist, image in rows:
+            track_id = len(groups.names)
+            groups.names.append(name)
+            groups.uris.append(_strip_prefix(uri, TRACK_URI_PREFIX))
+
+            artist_id = artist_ids.get(artist)
+            if artist_id is None:
+                artist_id = artist_ids[artist] = len(groups.artists)
+                groups.artists.append(artist)
+            groups.artist_index.append(artist_id)
+
+            if image is None:
+                groups.image_index.append(-1)
+            else:
+                image_id = image_ids.get(image)
+                if image_id is None:
+                    image_id = image_ids[image] = len(groups.images)
+                    groups.images.append(image)
+                groups.image_index.append(image_id)
+
+            members = groups.genres.get(genre)
+            if members is None:
+                members = groups.genres[genre] = array('I')
+            members.append(track_id)
+
+        return groups
+
+    def track_info(self, track_id):
+        image_id = self.image_index[track_id]
+        return {
+            'name': self.names[track_id],
+            'artist': self.artists[self.artist_index[track_id]],
+            'uri': _add_prefix(self.uris[track_id], TRACK_URI_PREFIX, ':'),
+            'image': self.images[image_id] if image_id >= 0 else None,
+        }
+
+    def rows(self):
+        """
+        The (genre, uri, name, artist, image) rows from_rows was given, in
+        display order. Track indices follow that order in groups built by
+        from_rows or unpacked from sort state.
+        """
+        track_genres = [None] * len(self.names)
+        for genre, members in self.genres.items():
+            for track_id in members:
+                track_genres[track_id] = genre
+        for track_id, genre in enumerate(track_genres):
+            info = self.track_info(track_id)
+            yield genre, info['uri'], info['name'], info['artist'], info['image']
+
+    def without(self, uris):
+        """
+        Copy without the tracks whose uri is in uris
+        """
+        def rows():
+            for genre, members in self.genres.items():
+                for track_id in members:
+                    info = self.track_info(track_id)
+                    if info['uri'] not in uris:
+                        yield genre, info['uri'], info['name'], info['artist'], info['image']
+        return ColumnarGroups.from_rows(rows())
+
+    def expand(self):
+        """
+        The {genre: [track_info]} structure the client renders
+        """
+        return {
+            genre: [self.track_info(track_id) for track_id in members]
+            for genre, members in self.genres.items()
+        }
+
+    def as_json(self):
+        """
+        Compact JSON form for ?columnar=true, see expandColumnar in the client
+        """
+        return {
+            'uri_prefix': TRACK_URI_PREFIX,
+            'image_prefix': IMAGE_URL_PREFIX,
+            'artists': self.artists,
+            'images': [_strip_prefix(image, IMAGE_URL_PREFIX) for image in self.images],
+            'tracks': {
+                'uri': self.uris,
+                'name': self.names,
+                'artist': self.artist_index.tolist(),
+                'image': self.image_index.tolist(),
+            },
+            'genres': [[genre, members.tolist()] for genre, members in self.genres.items()],
+        }
@@ -0,0 +1,164 @@
+import asyncio
+import threading
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .metrics import metrics
+
+# Request coalescing and per-user limits for the Spotify-heavy operations.
+# Both are per process, with several workers a duplicate request that lands
+# on another process still runs on its own.
+
+
+class TooManyInFlight(Exception):
+    """
+    Raised when a user already has USER_MAX_IN_FLIGHT operations running
+    """
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one execution: the first caller
+    runs the function, the others wait for it and get the same result (or
+    the same exception). Sync and async callers share the keys, either kind
+    can join a run the other started.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        # (future, whether this caller runs it)
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                metrics.inc('coalesced_requests_total')
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            del self._calls[key]
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def do(self, key, func):
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def ado(self, key, func):
+        # func is a coroutine function, only awaited by the first caller.
+        # Waits are shielded so one caller disconnecting doesn't cancel the others
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.shield(asyncio.wrap_future(future))
+
+        async def run():
+            try:
+                result = await func()
+            except BaseException as e:
+                self._finish(key, future, error=e)
+                raise
+            self._finish(key, future, result)
+            return result
+
+        task = asyncio.ensure_future(run())
+        # Read the outcome even if the leader went away, the followers got it
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return await asyncio.shield(task)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class UserConcurrencyLimiter:
+    """
+    Caps the Spotify-heavy operations (sorts, exports) one user can have
+    running at once, so a single huge library can't take every worker.
+    Requests are turned away when the user is at the cap, background work
+    waits in a per-user queue instead and starts as a slot frees up.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self._counts = Counter()
+        self._waiting = defaultdict(deque)
+        self._lock = threading.Lock()
+
+    def try_acquire(self, user_key):
+        with self._lock:
+            if self._counts[user_key] >= self.limit:
+                return False
+            self._counts[user_key] += 1
+            return True
+
+    def release(self, user_key):
+        with self._lock:
+            waiting = self._waiting.get(user_key)
+            if waiting:
+                # The slot passes straight to the user's next queued start
+                start = waiting.popleft()
+                if not waiting:
+                    del self._waiting[user_key]
+            else:
+                start = None
+                self._counts[user_key] -= 1
+                if self._counts[user_key] <= 0:
+                    del self._counts[user_key]
+        if start:
+            start()
+
+    def start_when_free(self, user_key, start):
+        """
+        Calls start() now if the user has a free slot, otherwise once one is
+        released. The slot is held for start, whatever it kicks off must call
+        release(user_key) when done. Returns whether it started right away.
+        """
+        with self._lock:
+            if self._counts[user_key] >= self.limit:
+                self._waiting[user_key].append(start)
+                return False
+            self._counts[user_key] += 1
+        start()
+        return True
+
+    @contextmanager
+    def slot(self, user_key):
+        """
+        Holds one of the user's slots for the code inside, raises
+        TooManyInFlight right away if they are all taken
+        """
+        if not self.try_acquire(user_key):
+            metrics.inc('user_limit_rejections_total')
+            raise TooManyInFlight(f'At most {self.limit} sorts or exports can run at once, try again shortly')
+        try:
+            yield
+        finally:
+            self.release(user_key)
+
+    def in_flight(self):
+        with self._lock:
+            return sum(self._counts.values())
+
+    def waiting(self):
+        with self._lock:
+            return sum(len(waiting) for waiting in self._waiting.values())
+
+
+sort_flights = SingleFlight()
+user_limiter = UserConcurrencyLimiter(settings.USER_MAX_IN_FLIGHT)
@@ -0,0 +1,97 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .metrics import in_request_context
+from .spotify import SpotifyFetchError, call_spotify
+
+logger = logging.getLogger(__name__)
+
+# Spotify accepts up to 100 uris per add-items request
+PLAYLIST_CHUNK_SIZE = 100
+
+# Attempts per chunk on top of call_spotify's own 429 handling
+CHUNK_ATTEMPTS = 3
+
+
+def playlist_name_for(genre):
+    return f"{genre.title()} Mix"
+
+
+def add_chunk(sp, playlist_id, uris, offset):
+    """
+    Adds one chunk of uris at `offset`. Requests Spotify rejected (400, 403,
+    404...) fail straight away. Adding items isn't idempotent, so after a 5xx
+    or connection error the chunk is only resent once the playlist length
+    shows it didn't land: if the response was lost it is not added twice.
+    """
+    for attempt in range(CHUNK_ATTEMPTS):
+        try:
+            call_spotify(sp.playlist_add_items, playlist_id, uris, position=offset, retry_errors=False)
+            return
+        except SpotifyFetchError as e:
+            logger.warning(f"Adding tracks {offset}-{offset + len(uris)} to {playlist_id} failed (attempt {attempt + 1}/{CHUNK_ATTEMPTS}): {e}")
+            # status is only set for rejected requests, which will never succeed
+            if e.status is not None:
+                raise
+            error = e
+
+        # Reading the length is safe to retry, we are the only writer of a fresh playlist
+        total = call_spotify(sp.playlist, playlist_id, fields='tracks.total')['tracks']['total']
+        if total >= offset + len(uris):
+            return
+        if total != offset:
+            # Something other than the whole chunk landed, resending could duplicate tracks
+            raise error
+
+    raise error
+
+
+def export_genre(sp, user_id, genre, track_uris):
+    """
+    Creates a private playlist for a genre and fills it with track_uris.
+    Chunks go in sequentially so the playlist keeps the grouping's order.
+    """
+    playlist_name = playlist_name_for(genre)
+    # Not retried on errors either, a lost response would leave a duplicate playlist
+    new_playlist = call_spotify(
+        sp.user_playlist_create,
+        user_id,
+        playlist_name,
+        public=False,
+        description=f"Auto-generated playlist with {genre} tracks",
+        retry_errors=False,
+    )
+
+    for offset in range(0, len(track_uris), PLAYLIST_CHUNK_SIZE):
+        add_chunk(sp, new_playlist['id'], track_uris[offset:offset + PLAYLIST_CHUNK_SIZE], offset)
+
+    return {
+        'playlist_name': playlist_name,
+        'playlist_id': new_playlist['id'],
+        'track_count': len(track_uris),
+    }
+
+
+def export_genres(sp, user_id, genre_uris):
+    """
+    Exports several genres at once, genre_uris is {genre: [uris]}. Playlists
+    are filled concurrently under the shared rate limiter and a failing genre
+    doesn't stop the others. Returns one result per genre, in input order.
+    """
+    def export(item):
+        genre, track_uris = item
+        try:
+            result = export_genre(sp, user_id, genre, track_uris)
+        except SpotifyFetchError as e:
+            logger.error(f"Error exporting genre {genre}: {e}")
+            return {'genre': genre, 'success': False, 'error': 'Failed to create playlist on Spotify'}
+        return {'genre': genre, 'success': True, **result}
+
+    if not genre_uris:
+        return []
+
+    workers = min(settings.SPOTIFY_MAX_WORKERS, len(genre_uris))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(in_request_context(export), genre_uris.items()))
@@ -0,0 +1,94 @@
+import hashlib
+import re
+import unicodedata
+
+# Duplicate detection. The same recording released as a single, on an album
+# and on a compilation gets a different uri each time, so tracks are matched
+# on their ISRC or on a hashed (artist, normalized title) key instead. Both
+# keys are plain dict lookups, one pass over a grouping finds every duplicate.
+
+# Title suffixes that name a release rather than a different recording. The
+# whole suffix has to be packaging: live, acoustic, demo, remix, edit and
+# other versions are different recordings and keep their suffix.
+_PACKAGING = (
+    r'(?:\d{4}\s+)?(?:digital(?:ly)?\s+)?remaster(?:ed)?(?:\s+version)?(?:\s+\d{4})?'
+    r'|(?:single|album|mono|stereo|explicit|clean)(?:\s+version)?'
+    r'|deluxe(?:\s+(?:edition|version))?'
+    r'|bonus\s+track'
+)
+_RELEASE_SUFFIX = re.compile(
+    rf'\s*(?:[-–]\s*|[(\[]\s*)(?:{_PACKAGING})(?:\s*[/,&]\s*(?:{_PACKAGING}))*\s*[)\]]?\s*$',
+    re.IGNORECASE,
+)
+_FEATURING = re.compile(r'\s*[(\[]\s*(?:feat\.?|ft\.?|featuring|with)\s[^()\[\]]*[)\]]', re.IGNORECASE)
+_NON_WORD = re.compile(r'[\W_]+')
+# CC-XXX-YY-NNNNN, hyphens are often included
+_ISRC = re.compile(r'^[A-Z]{2}[A-Z0-9]{3}[0-9]{7}$')
+
+
+def _fold(text):
+    # Case and accent insensitive, punctuation collapsed
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+    return _NON_WORD.sub(' ', text.casefold()).strip()
+
+
+def normalize_title(name):
+    """
+    'Song (feat. X) - Remastered 2011' -> 'song'
+    """
+    # Most titles have nothing to strip, skip the regexes for them
+    if not any(c in name for c in '([-–'):
+        return _fold(name)
+    name = _FEATURING.sub('', name)
+    # Suffixes can stack, e.g. 'Song - Single Version (Remastered)'
+    while True:
+        stripped = _RELEASE_SUFFIX.sub('', name)
+        if stripped == name or not stripped:
+            break
+        name = stripped
+    return _fold(name)
+
+
+def normalize_isrc(isrc):
+    """
+    The 12 character form of an ISRC, '' for missing or malformed ones
+    """
+    isrc = (isrc or '').replace('-', '').strip().upper()
+    return isrc if _ISRC.match(isrc) else ''
+
+
+def title_key(artist, name):
+    """
+    Fixed width hash of the normalized (artist, title) pair
+    """
+    key = f'{_fold(artist)}\x1f{normalize_title(name)}'
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+
+class DuplicateIndex:
+    """
+    Maps fingerprint keys to the first track seen with them. Tracks are
+    added in display order, a track sharing any key with an earlier one is
+    a duplicate of it and its keys then point to that track too, so chains
+    (ISRC match on one side, title match on the other) end up together.
+    """
+    def __init__(self):
+        self._owners = {}
+        # duplicate uri -> uri of the track kept in its place
+        self.duplicates = {}
+
+    def add(self, uri, isrc, key):
+        """
+        Returns the uri of the track this one duplicates, or None
+        """
+        keys = [f'i:{isrc.upper()}', f't:{key}'] if isrc else [f't:{key}']
+        owner = next((self._owners[k] for k in keys if k in self._owners), None)
+        if owner == uri:
+            return None
+        for k in keys:
+            self._owners.setdefault(k, owner or uri)
+        if owner is not None:
+            self.duplicates[uri] = owner
+        return owner
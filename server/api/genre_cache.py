@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .genre_snapshot import ArtistGenreSnapshot
+
+
+class ArtistGenreCache:
+    """
+    Process-wide artist id -> genres cache shared across users and sessions.
+    Entries expire after `ttl` seconds and the least recently used entries are
+    evicted once `max_size` is reached. Artists missing from memory are looked
+    up in the on-disk snapshot, if there is one, before going to Spotify.
+    """
+    def __init__(self, ttl, max_size, snapshot=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.snapshot = snapshot
+        self.hits = 0
+        self.misses = 0
+        self.snapshot_hits = 0
+        # artist_id -> (expires_at, genres)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, artist_ids):
+        """
+        Returns ({artist_id: genres} for cached artists, [artist ids to fetch])
+        """
+        found = {}
+        missing = []
+        now = time.time()
+
+        with self._lock:
+            for artist_id in artist_ids:
+                entry = self._entries.get(artist_id)
+
+                if entry is None or entry[0] <= now:
+                    if entry is not None:
+                        del self._entries[artist_id]
+                    missing.append(artist_id)
+                    self.misses += 1
+                    continue
+
+                # Mark as most recently used
+                self._entries.move_to_end(artist_id)
+                found[artist_id] = entry[1]
+                self.hits += 1
+
+        if self.snapshot is not None and missing:
+            from_snapshot = self.snapshot.get_many(missing)
+            if from_snapshot:
+                self.set_many(from_snapshot)
+                found.update(from_snapshot)
+                missing = [artist_id for artist_id in missing if artist_id not in from_snapshot]
+                with self._lock:
+                    self.misses -= len(from_snapshot)
+                    self.snapshot_hits += len(from_snapshot)
+
+        return found, missing
+
+    def set_many(self, artist_genres):
+        expires_at = time.time() + self.ttl
+
+        with self._lock:
+            for artist_id, genres in artist_genres.items():
+                self._entries[artist_id] = (expires_at, tuple(genres))
+                self._entries.move_to_end(artist_id)
+
+            # Evict least recently used artists
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.snapshot_hits = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'snapshot_hits': self.snapshot_hits,
+            }
+
+
+artist_genre_cache = ArtistGenreCache(
+    ttl=settings.ARTIST_GENRE_CACHE_TTL,
+    max_size=settings.ARTIST_GENRE_CACHE_MAX_SIZE,
+    snapshot=ArtistGenreSnapshot(settings.ARTIST_GENRE_SNAPSHOT_PATH),
+)
@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# On-disk artist id -> genres snapshot, a small SQLite file written by the
+# snapshot_artist_genres command. The running server reads it (memory mapped)
+# to resolve artists its in-memory cache hasn't seen yet.
+
+# SQLite caps the number of bound parameters per query
+SNAPSHOT_QUERY_BATCH = 500
+
+
+def write_snapshot(path, artist_genres):
+    """
+    Writes {artist_id: genres} to a new snapshot and swaps it in atomically,
+    so servers reading the old file are never handed a half-written one
+    """
+    tmp_path = f'{path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.execute('CREATE TABLE artist_genres (artist_id TEXT PRIMARY KEY, genres TEXT NOT NULL) WITHOUT ROWID')
+        connection.executemany(
+            'INSERT INTO artist_genres VALUES (?, ?)',
+            ((artist_id, json.dumps(list(genres))) for artist_id, genres in artist_genres.items()),
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path):
+    if not os.path.exists(path):
+        return {}
+
+    connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        return {
+            artist_id: json.loads(genres)
+            for artist_id, genres in connection.execute('SELECT artist_id, genres FROM artist_genres')
+        }
+    finally:
+        connection.close()
+
+
+class ArtistGenreSnapshot:
+    """
+    Read-only view of the snapshot file. Each thread keeps its own connection,
+    reopened whenever the file is replaced so a re-snapshot is picked up
+    without restarting the server.
+    """
+    def __init__(self, path, mmap_size=64 * 1024 * 1024):
+        self.path = path
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+
+    def _connection(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        version = (stat.st_ino, stat.st_mtime_ns)
+
+        if getattr(self._local, 'version', None) != version:
+            if getattr(self._local, 'connection', None) is not None:
+                self._local.connection.close()
+            connection = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+            connection.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+            self._local.connection = connection
+            self._local.version = version
+        return self._local.connection
+
+    def get_many(self, artist_ids):
+        """
+        {artist_id: genres} for the given artists found in the snapshot
+        """
+        connection = self._connection()
+        if connection is None or not artist_ids:
+            return {}
+
+        found = {}
+        try:
+            for i in range(0, len(artist_ids), SNAPSHOT_QUERY_BATCH):
+                batch = artist_ids[i:i + SNAPSHOT_QUERY_BATCH]
+                rows = connection.execute(
+                    f"SELECT artist_id, genres FROM artist_genres WHERE artist_id IN ({','.join('?' * len(batch))})",
+                    batch,
+                )
+                found.update((artist_id, tuple(json.loads(genres))) for artist_id, genres in rows)
+        except sqlite3.DatabaseError as e:
+            # A broken snapshot only costs us the extra Spotify requests
+            logger.warning(f"Could not read artist genre snapshot {self.path}: {e}")
+            return {}
+        return found
@@ -0,0 +1,148 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .classification import get_classifier
+from .concurrency import user_limiter
+from .metrics import metrics, track_request
+from .models import SortJob
+from .sorting import library_id, sort_library, sort_playlist
+from .spotify import SpotifyFetchError, spotify_pool
+
+logger = logging.getLogger(__name__)
+
+# Local worker pool for background sorts, shared by every request in the process
+sort_executor = ThreadPoolExecutor(max_workers=settings.SORT_JOB_WORKERS, thread_name_prefix='sort-job')
+
+# Queued or running job per (session_key, playlist_id, classifier, refresh),
+# an identical request while one is pending gets that job back
+_active_jobs = {}
+_active_lock = threading.Lock()
+# Jobs submitted to sort_executor that no worker has picked up yet
+_queued = 0
+_queued_lock = threading.Lock()
+
+
+def queued_jobs():
+    return _queued
+
+
+def _count_queued(change):
+    global _queued
+    with _queued_lock:
+        _queued += change
+
+
+def session_client(session_key):
+    """
+    Client for the token currently stored in the job's session, refreshed if
+    it expired while the job was queued. None if the user logged out.
+    """
+    session = import_module(settings.SESSION_ENGINE).SessionStore(session_key=session_key)
+    client = spotify_pool.client_for_session(session)
+    if session.modified:
+        session.save()
+    return client
+
+
+def fail_interrupted_jobs(**kwargs):
+    # Connected to the first request_started by ApiConfig.ready, jobs
+    # still pending from before a restart will never run
+    from django.core.signals import request_started
+    request_started.disconnect(dispatch_uid='api.fail_interrupted_jobs')
+    failed = SortJob.fail_stale()
+    if failed:
+        logger.warning(f"Failed {failed} sort jobs interrupted by a restart")
+
+
+def run_sort_job(job_id, refresh=False, classifier=None, playlist_ids=None, whole_library=False):
+    job = SortJob.objects.get(pk=job_id)
+    try:
+        sp = session_client(job.session_key)
+        if sp is None:
+            job.update_progress(SortJob.FAILED, error='Not authenticated, log in again')
+            return
+        # Stores into the same SortResult the edit endpoints read from
+        with track_request('sort_job'):
+            if playlist_ids is not None:
+                sort_library(
+                    sp,
+                    job.session_key,
+                    playlist_ids,
+                    whole_library=whole_library,
+                    progress=job.update_progress,
+                    refresh=refresh,
+                    classifier=classifier,
+                )
+            else:
+                sort_playlist(
+                    sp,
+                    job.session_key,
+                    job.playlist_id,
+                    progress=job.update_progress,
+                    refresh=refresh,
+                    classifier=classifier,
+                )
+        job.update_progress(SortJob.DONE)
+    except SpotifyFetchError as e:
+        job.update_progress(SortJob.FAILED, error=str(e))
+    except Exception:
+        logger.exception(f"Sort job {job_id} failed")
+        job.update_progress(SortJob.FAILED, error='Failed to sort playlist')
+    finally:
+        close_old_connections()
+
+
+def _run_job(key, job_id, *args):
+    _count_queued(-1)
+    try:
+        run_sort_job(job_id, *args)
+    finally:
+        with _active_lock:
+            if _active_jobs.get(key) == job_id:
+                del _active_jobs[key]
+        user_limiter.release(key[0])
+
+
+def _enqueue(session_key, playlist_id, refresh=False, classifier=None, playlist_ids=None, whole_library=False):
+    """
+    Creates the job, or returns the pending identical one, and starts it on
+    the worker pool once the user has a free slot (see USER_MAX_IN_FLIGHT),
+    so one user's jobs can't take every worker
+    """
+    key = (session_key, playlist_id, get_classifier(classifier).name, bool(refresh))
+    with _active_lock:
+        job_id = _active_jobs.get(key)
+        job = SortJob.objects.filter(pk=job_id).first() if job_id else None
+        if job and not job.finished:
+            metrics.inc('coalesced_requests_total')
+            return job
+        job = SortJob.objects.create(session_key=session_key, playlist_id=playlist_id)
+        _active_jobs[key] = job.id
+
+    def start():
+        _count_queued(1)
+        sort_executor.submit(_run_job, key, job.id, refresh, classifier, playlist_ids, whole_library)
+
+    user_limiter.start_when_free(session_key, start)
+    return job
+
+
+def enqueue_sort_job(session_key, playlist_id, refresh=False, classifier=None):
+    return _enqueue(session_key, playlist_id, refresh=refresh, classifier=classifier)
+
+
+def enqueue_library_sort_job(session_key, playlist_ids, whole_library=False, refresh=False, classifier=None):
+    # The job's playlist_id is the library id the grouping is stored under
+    return _enqueue(
+        session_key,
+        library_id(playlist_ids, whole_library),
+        refresh=refresh,
+        classifier=classifier,
+        playlist_ids=playlist_ids,
+        whole_library=whole_library,
+    )
@@ -0,0 +1,125 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from api.genre_cache import artist_genre_cache
+from api.spotify import spotify_rate_limiter
+from benchmarks.fake_spotify import FakeLibrary, FakeSpotifyServer
+from benchmarks.harness import BenchmarkClient, build_scenarios, compare, playlists_scenario, run_scenario
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the sort, playlist and genre-edit endpoints against a local "
+        "fake Spotify API, on a throwaway test database. Reports latency "
+        "percentiles, Spotify calls, bytes and peak memory per scenario and size."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='100,1000,10000,50000', help='Comma separated playlist sizes')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per scenario')
+        parser.add_argument('--scenario', action='append', default=[], help='Only run these scenarios, can be repeated')
+        parser.add_argument('--classifier', default='', help='Genre classifier the sorts use')
+        parser.add_argument('--latency', type=float, default=0, help='Fake Spotify latency per request, in ms')
+        parser.add_argument('--rate-limit-probability', type=float, default=0, help='Chance of a fake 429 per request')
+        parser.add_argument('--retry-after', type=int, default=0, help='Retry-After sent with fake 429s')
+        parser.add_argument('--spotify-rate-limit', type=float, help='Client side request rate limit, SPOTIFY_RATE_LIMIT by default')
+        parser.add_argument('--save-baseline', help='Write the results to this JSON file')
+        parser.add_argument('--compare', help='Compare against a baseline JSON file')
+        parser.add_argument('--threshold', type=float, default=0.2, help='p50 slowdown counted as a regression')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be a comma separated list of integers')
+
+        baseline = None
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as f:
+                baseline = json.load(f)['results']
+
+        self.stdout.write(f"Generating fake library for sizes {sizes}")
+        library = FakeLibrary(sizes)
+        fake = FakeSpotifyServer(
+            library,
+            latency=options['latency'] / 1000,
+            rate_limit_probability=options['rate_limit_probability'],
+            retry_after=options['retry_after'],
+        ).start()
+
+        # Keep any on-disk snapshot from answering artist lookups
+        artist_genre_cache.snapshot = None
+
+        setup_test_environment()
+        old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                results = self.run_benchmarks(fake, library, sizes, options)
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+            teardown_test_environment()
+            fake.stop()
+
+        changes = compare(results, baseline, options['threshold']) if baseline else {}
+        self.report(results, changes)
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w', encoding='utf-8') as f:
+                json.dump({
+                    'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'options': {key: options[key] for key in (
+                        'sizes', 'repeat', 'classifier', 'latency', 'rate_limit_probability', 'spotify_rate_limit',
+                    )},
+                    'results': results,
+                }, f, indent=2)
+            self.stdout.write(f"Saved baseline to {options['save_baseline']}")
+
+        if any(change['regressed'] for change in changes.values()):
+            raise CommandError('Regressions against the baseline')
+
+    def run_benchmarks(self, fake, library, sizes, options):
+        client = BenchmarkClient()
+        wanted = set(options['scenario'])
+        results = {}
+
+        def run(scenario, key):
+            if wanted and scenario.name not in wanted:
+                return
+            self.stdout.write(f"  {key}", ending='')
+            self.stdout.flush()
+            # Run at the production throttle unless told otherwise, and don't
+            # let 429s in one scenario slow down the next
+            rate = options['spotify_rate_limit']
+            if rate is None:
+                spotify_rate_limiter.configure(settings.SPOTIFY_RATE_LIMIT, burst=settings.SPOTIFY_RATE_LIMIT_BURST)
+            else:
+                spotify_rate_limiter.configure(rate, burst=int(rate))
+            results[key] = run_scenario(scenario, fake, options['repeat'])
+            self.stdout.write(f"  {results[key]['p50_ms']:.1f} ms")
+
+        run(playlists_scenario(client), 'playlists')
+        for size in sizes:
+            for scenario in build_scenarios(client, library, size, options['classifier']):
+                run(scenario, f'{scenario.name}@{size}')
+        return results
+
+    def report(self, results, changes):
+        header = f"{'scenario':<30}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'ttfb ms':>10}{'calls':>8}{'429s':>6}{'spotify KB':>12}{'resp KB':>10}{'peak MB':>9}"
+        self.stdout.write('')
+        self.stdout.write(header + ('    vs baseline' if changes else ''))
+        for key, result in results.items():
+            line = (
+                f"{key:<30}{result['p50_ms']:>10.1f}{result['p90_ms']:>10.1f}{result['p99_ms']:>10.1f}{result.get('first_byte_p50_ms', result['p50_ms']):>10.1f}"
+                f"{result['api_calls']:>8.0f}{result['rate_limited']:>6.0f}{result['spotify_bytes'] / 1024:>12.1f}"
+                f"{result['response_bytes'] / 1024:>10.1f}{result['peak_memory_bytes'] / 2 ** 20:>9.1f}"
+            )
+            change = changes.get(key)
+            if change:
+                line += f"    {change['p50_change']:+.0%} p50, {change['api_calls_change']:+.0f} calls"
+                line = self.style.ERROR(line) if change['regressed'] else line
+            self.stdout.write(line)
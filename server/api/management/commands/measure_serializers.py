@@ -0,0 +1,107 @@
+import json
+import time
+
+from django.core import signing
+from django.core.management.base import BaseCommand, CommandError
+
+from api.columnar import ColumnarGroups
+from api.serializers import SessionSerializer, pack_sort_state, unpack_sort_state
+from benchmarks.fake_spotify import FakeLibrary
+
+SESSION_SALT = 'django.contrib.sessions.SessionStore'
+TOKEN_INFO = {
+    'access_token': 'x' * 200,
+    'refresh_token': 'y' * 130,
+    'expires_at': 1760000000,
+    'scope': 'playlist-read-private playlist-modify-private playlist-modify-public',
+    'token_type': 'Bearer',
+}
+
+
+def fake_rows(library, playlist_id):
+    # Grouped the way the primary classifier would, by the first artist's first genre
+    rows = []
+    for item in library.playlists[playlist_id]['tracks']:
+        track = item['track']
+        artist = library.artists[track['artists'][0]['id']]
+        genre = artist['genres'][0] if artist['genres'] else 'Other'
+        rows.append((genre, track['uri'], track['name'], artist['name'], track['album']['images'][0]['url']))
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+
+def timed(func, repeat):
+    # Best of repeat, in ms
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best * 1000
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the size and encode/decode time of the sort state formats: "
+        "the genre_groups dict as the session used to store it, the columnar "
+        "JSON response and the packed binary sort state, plus the token-only "
+        "session with Django's JSON serializer and SessionSerializer."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tracks', default='1000,10000,50000', help='Comma separated grouping sizes')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per format, the best is reported')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['tracks'].split(',')]
+        except ValueError:
+            raise CommandError('--tracks must be a comma separated list of integers')
+        repeat = options['repeat']
+
+        library = FakeLibrary(sizes)
+        self.stdout.write(f"{'tracks':>7} {'format':<26} {'bytes':>10} {'encode ms':>10} {'decode ms':>10}")
+        for size in sizes:
+            groups = ColumnarGroups.from_rows(fake_rows(library, f'playlist{size}'))
+            genre_groups = groups.expand()
+
+            formats = {
+                # What every edit view used to read and rewrite: the whole grouping in the session
+                'session genre_groups': (
+                    lambda: signing.dumps(
+                        {'spotify_token_info': TOKEN_INFO, 'sorted_tracks_playlist': genre_groups},
+                        salt=SESSION_SALT, serializer=signing.JSONSerializer, compress=True,
+                    ),
+                    lambda data: signing.loads(data, salt=SESSION_SALT, serializer=signing.JSONSerializer),
+                ),
+                'json genre_groups': (lambda: json.dumps(genre_groups).encode(), json.loads),
+                'json columnar': (lambda: json.dumps(groups.as_json()).encode(), json.loads),
+                'packed sort state': (lambda: pack_sort_state(groups), unpack_sort_state),
+            }
+            if size == sizes[0]:
+                formats = {
+                    'session token (json)': (
+                        lambda: signing.dumps(
+                            {'spotify_token_info': TOKEN_INFO},
+                            salt=SESSION_SALT, serializer=signing.JSONSerializer, compress=True,
+                        ),
+                        lambda data: signing.loads(data, salt=SESSION_SALT, serializer=signing.JSONSerializer),
+                    ),
+                    'session token (orjson)': (
+                        lambda: signing.dumps(
+                            {'spotify_token_info': TOKEN_INFO},
+                            salt=SESSION_SALT, serializer=SessionSerializer, compress=True,
+                        ),
+                        lambda data: signing.loads(data, salt=SESSION_SALT, serializer=SessionSerializer),
+                    ),
+                    **formats,
+                }
+
+            for name, (encode, decode) in formats.items():
+                data, encode_ms = timed(encode, repeat)
+                _, decode_ms = timed(lambda: decode(data), repeat)
+                self.stdout.write(f'{size:>7} {name:<26} {len(data):>10} {encode_ms:>10.2f} {decode_ms:>10.2f}')
+
+            if unpack_sort_state(pack_sort_state(groups)).expand() != genre_groups:
+                raise CommandError(f'Packed sort state did not round-trip at {size} tracks')
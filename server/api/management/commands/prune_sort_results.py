@@ -0,0 +1,56 @@
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api.models import SortJob, SortResult
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes the sort results and jobs of sessions that have expired or "
+        "been flushed, and finished jobs older than --job-age hours. Sort "
+        "results are otherwise only removed when their session logs in "
+        "again, run this periodically (e.g. daily from cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job-age', type=float, default=24, help='Hours finished jobs are kept for')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+
+    def handle(self, *args, **options):
+        if settings.SESSION_ENGINE.endswith('signed_cookies'):
+            raise CommandError('Cookie based sessions are not stored server side, expired sessions cannot be told apart')
+
+        # Drops expired sessions first so exists() only sees live ones
+        if not options['dry_run']:
+            call_command('clearsessions')
+        session_store = import_module(settings.SESSION_ENGINE).SessionStore
+
+        session_keys = set(SortResult.objects.values_list('session_key', flat=True).distinct())
+        session_keys.update(SortJob.objects.values_list('session_key', flat=True).distinct())
+        expired = [key for key in session_keys if not session_store().exists(key)]
+
+        old_jobs = SortJob.objects.filter(
+            status__in=(SortJob.DONE, SortJob.FAILED),
+            updated_at__lt=timezone.now() - timedelta(hours=options['job_age']),
+        )
+        result_count, job_count = 0, old_jobs.count()
+        if not options['dry_run']:
+            old_jobs.delete()
+
+        # In chunks to stay under SQLite's query variable limit
+        for start in range(0, len(expired), 500):
+            chunk = expired[start:start + 500]
+            results = SortResult.objects.filter(session_key__in=chunk)
+            jobs = SortJob.objects.filter(session_key__in=chunk)
+            result_count += results.count()
+            job_count += jobs.count()
+            if not options['dry_run']:
+                results.delete()
+                jobs.delete()
+
+        self.stdout.write(f"{len(expired)} expired sessions: {result_count} sort results, {job_count} jobs")
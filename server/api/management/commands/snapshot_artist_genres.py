@@ -0,0 +1,66 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.genre_snapshot import read_snapshot, write_snapshot
+from api.spotify import (
+    PLAYLIST_TRACK_FIELDS,
+    SpotifyFetchError,
+    fetch_all_pages,
+    fetch_artist_genres,
+    parse_track,
+    spotify_pool,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes the artist -> genres snapshot the server resolves artists from "
+        "before asking Spotify. Artists come from the existing snapshot plus any "
+        "given artist ids or playlists. Safe to run while the server is up, "
+        "running servers pick up the new file on their next lookup."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--artists', help='File with one Spotify artist id per line')
+        parser.add_argument(
+            '--playlist', action='append', default=[],
+            help='Playlist whose artists should be included, can be repeated',
+        )
+        parser.add_argument('--refresh', action='store_true', help='Refetch genres of artists already in the snapshot')
+        parser.add_argument('--replace', action='store_true', help="Don't keep artists from the existing snapshot")
+        parser.add_argument('--output', default=settings.ARTIST_GENRE_SNAPSHOT_PATH)
+
+    def handle(self, *args, **options):
+        artist_genres = {} if options['replace'] else read_snapshot(options['output'])
+        self.stdout.write(f"{len(artist_genres)} artists in the existing snapshot")
+
+        artist_ids = set()
+        if options['artists']:
+            with open(options['artists'], encoding='utf-8') as f:
+                artist_ids.update(line.strip() for line in f if line.strip())
+
+        sp = spotify_pool.app_client()
+        try:
+            for playlist_id in options['playlist']:
+                tracks = fetch_all_pages(
+                    sp.playlist_items,
+                    playlist_id,
+                    limit=100,
+                    fields=PLAYLIST_TRACK_FIELDS,
+                    additional_types=('track',),
+                    parse_item=parse_track,
+                )
+                artist_ids.update(artist_id for track in tracks for artist_id in track.artist_ids)
+
+            if options['refresh']:
+                artist_ids.update(artist_genres)
+            else:
+                artist_ids.difference_update(artist_genres)
+
+            self.stdout.write(f"Fetching genres for {len(artist_ids)} artists")
+            artist_genres.update(fetch_artist_genres(sp, sorted(artist_ids)))
+        except SpotifyFetchError as e:
+            raise CommandError(f"Spotify request failed, snapshot left unchanged: {e}")
+
+        write_snapshot(options['output'], artist_genres)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {len(artist_genres)} artists to {options['output']}"))
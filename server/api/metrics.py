@@ -0,0 +1,221 @@
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+# Request instrumentation. Each request (or background sort job) gets a
+# RequestTimings in a context variable that phases and Spotify calls add to,
+# everything is also aggregated into the process-wide `metrics` registry
+# served in Prometheus text format. Counts are per process.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+HELP = {
+    'http_requests_total': 'Requests handled, by view and status',
+    'http_request_duration_seconds': 'Request duration, by view',
+    'request_phase_duration_seconds': 'Time spent per phase of a request, by view and phase',
+    'spotify_calls_total': 'Spotify Web API calls, by call and outcome',
+    'spotify_retries_total': 'Spotify calls retried after a 429, 5xx or connection error',
+    'spotify_rate_limited_total': '429 responses from Spotify',
+    'spotify_rate_limit_wait_seconds_total': 'Time spent waiting on the shared rate limiter',
+    'session_payload_bytes': 'Encoded size of the session on requests that used it',
+    'coalesced_requests_total': 'Requests that shared an identical in-flight sort or export',
+    'user_limit_rejections_total': 'Requests turned away because the user was at USER_MAX_IN_FLIGHT',
+}
+
+
+class RequestTimings:
+    """
+    Phase durations and Spotify call counts for one request. Phases running
+    on worker threads add up, so they can exceed the request's wall time.
+    """
+    def __init__(self, view):
+        self.view = view
+        self.phases = defaultdict(float)
+        self.spotify_calls = 0
+        self.spotify_retries = 0
+        self.rate_limited = 0
+        self.session_bytes = None
+        self._lock = threading.Lock()
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            self.phases[name] += seconds
+
+    def count_spotify(self, calls=0, retries=0, rate_limited=0):
+        with self._lock:
+            self.spotify_calls += calls
+            self.spotify_retries += retries
+            self.rate_limited += rate_limited
+
+    def server_timing(self, total):
+        """
+        Server-Timing header value
+        """
+        entries = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.phases.items()]
+        entries.append(f'total;dur={total * 1000:.1f}')
+        entries.append(f'spotify;desc="calls={self.spotify_calls} retries={self.spotify_retries} 429s={self.rate_limited}"')
+        if self.session_bytes is not None:
+            entries.append(f'session;desc="bytes={self.session_bytes}"')
+        return ', '.join(entries)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._counters = defaultdict(float)
+        # (name, labels) -> [per-bucket counts, sum, count]
+        self._histograms = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._buckets.setdefault(name, buckets)
+            histogram = self._histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self, gauges=()):
+        """
+        Everything recorded so far plus the given (name, labels, value)
+        gauges, in Prometheus text format
+        """
+        def format_labels(labels):
+            if not labels:
+                return ''
+            escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+            return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in HELP:
+                    lines.append(f'# HELP {name} {HELP[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._histograms.items())
+
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append(f'{name}{format_labels(labels)} {value:g}')
+
+        for (name, labels), (counts, total, count) in histograms:
+            describe(name, 'histogram')
+            for bound, bucket_count in zip(self._buckets[name], counts):
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", f"{bound:g}"),))} {bucket_count}')
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total:g}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+
+        for name, labels, value in gauges:
+            describe(name, 'gauge')
+            lines.append(f'{name}{format_labels(tuple(sorted(labels.items())))} {value:g}')
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+_current_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+@contextmanager
+def track_request(view):
+    """
+    Collects phase timings and Spotify counts for the code run inside, then
+    records them against `view`
+    """
+    timings = RequestTimings(view)
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+        # The view label may have been refined while the request ran
+        for name, seconds in timings.phases.items():
+            metrics.observe('request_phase_duration_seconds', seconds, view=timings.view, phase=name)
+        if timings.session_bytes is not None:
+            metrics.observe('session_payload_bytes', timings.session_bytes, buckets=SIZE_BUCKETS, view=timings.view)
+
+
+@contextmanager
+def phase(name):
+    """
+    Times the code inside as a phase of the current request, if there is one
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.add_phase(name, time.perf_counter() - start)
+
+
+def timed_phase(name):
+    """
+    Decorator form of phase()
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def in_request_context(func):
+    """
+    Wraps func so calls on worker threads still report to the submitting request
+    """
+    context = contextvars.copy_context()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+
+def record_spotify_call(call, outcome):
+    """
+    Counts one Spotify call attempt. outcome is 'ok', 'rate_limited',
+    'server_error', 'connection_error' or 'client_error'.
+    """
+    metrics.inc('spotify_calls_total', call=call, outcome=outcome)
+    if outcome == 'rate_limited':
+        metrics.inc('spotify_rate_limited_total')
+
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.count_spotify(calls=1, rate_limited=int(outcome == 'rate_limited'))
+
+
+def record_spotify_retry(call):
+    metrics.inc('spotify_retries_total', call=call)
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.count_spotify(retries=1)
+
+
+def record_rate_limit_wait(seconds):
+    metrics.inc('spotify_rate_limit_wait_seconds_total', seconds)
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.add_phase('rate_limit_wait', seconds)
@@ -0,0 +1,52 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .metrics import metrics, track_request
+
+
+class RequestMetricsMiddleware:
+    """
+    Times every request and its phases, counts its Spotify calls and reports
+    them in a Server-Timing header and the /api/metrics/ endpoint. Works for
+    both the sync views and the async ones.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        start = time.perf_counter()
+        with track_request(request.path) as timings:
+            response = self.get_response(request)
+            self.finish(request, response, timings, start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        with track_request(request.path) as timings:
+            response = await self.get_response(request)
+            self.finish(request, response, timings, start)
+        return response
+
+    def finish(self, request, response, timings, start):
+        # Label by route name, raw paths would give a series per playlist id
+        match = getattr(request, 'resolver_match', None)
+        timings.view = match.url_name if match and match.url_name else 'unmatched'
+
+        # Encoding the session isn't free, only measure it when it gets saved
+        session = getattr(request, 'session', None)
+        if session is not None and session.modified:
+            timings.session_bytes = len(session.encode(dict(session.items())))
+
+        total = time.perf_counter() - start
+        response['Server-Timing'] = timings.server_timing(total)
+        metrics.inc('http_requests_total', view=timings.view, status=response.status_code)
+        metrics.observe('http_request_duration_seconds', total, view=timings.view)
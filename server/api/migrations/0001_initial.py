@@ -0,0 +1,45 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SortResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_key', models.CharField(max_length=40)),
+                ('playlist_id', models.CharField(max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('session_key', 'playlist_id'), name='unique_sort_result_per_session')],
+            },
+        ),
+        migrations.CreateModel(
+            name='SortedTrack',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uri', models.CharField(max_length=100)),
+                ('name', models.TextField()),
+                ('artist', models.TextField()),
+                ('image', models.URLField(blank=True, max_length=500, null=True)),
+                ('genre', models.TextField()),
+                ('position', models.PositiveIntegerField()),
+                ('sort_result', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tracks', to='api.sortresult')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['sort_result', 'genre'], name='api_sortedt_sort_re_b8916c_idx')],
+                'constraints': [models.UniqueConstraint(fields=('sort_result', 'uri'), name='unique_track_per_sort_result')],
+            },
+        ),
+    ]
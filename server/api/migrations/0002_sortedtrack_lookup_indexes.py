@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:18
+
+from django.db import migrations, models
+
+
+def fill_artist_keys(apps, schema_editor):
+    SortedTrack = apps.get_model('api', 'SortedTrack')
+    for track in SortedTrack.objects.only('id', 'artist').iterator():
+        SortedTrack.objects.filter(id=track.id).update(artist_key=track.artist.strip().casefold())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sortedtrack',
+            name='artist_key',
+            field=models.TextField(default=''),
+        ),
+        migrations.RunPython(fill_artist_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='sortedtrack',
+            index=models.Index(fields=['sort_result', 'artist_key'], name='api_sortedt_sort_re_b31bc3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sortedtrack',
+            index=models.Index(fields=['sort_result', 'position'], name='api_sortedt_sort_re_163034_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_sortedtrack_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sortresult',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:22
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_sortresult_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SortJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('session_key', models.CharField(max_length=40)),
+                ('playlist_id', models.CharField(max_length=64)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('fetching_tracks', 'Fetching tracks'), ('resolving_artists', 'Resolving artists'), ('grouping', 'Grouping'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('tracks_fetched', models.PositiveIntegerField(default=0)),
+                ('tracks_total', models.PositiveIntegerField(default=0)),
+                ('artists_resolved', models.PositiveIntegerField(default=0)),
+                ('artists_total', models.PositiveIntegerField(default=0)),
+                ('genres_built', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_sortjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sortresult',
+            name='snapshot_id',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_sortresult_snapshot_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sortresult',
+            name='classifier',
+            field=models.CharField(default='primary', max_length=20),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_sortresult_classifier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sortedtrack',
+            name='source_playlists',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_sortedtrack_source_playlists'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sortedtrack',
+            name='isrc',
+            field=models.CharField(blank=True, default='', max_length=12),
+        ),
+        migrations.AddField(
+            model_name='sortedtrack',
+            name='title_key',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_sortedtrack_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sortresult',
+            name='journal_base',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='sortresult',
+            name='journal_head',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='sortresult',
+            name='journal_tail',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='JournalSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField(default=0)),
+                ('data', models.BinaryField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('sort_result', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='journal_snapshot', to='api.sortresult')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GenreEdit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField()),
+                ('kind', models.CharField(max_length=20)),
+                ('data', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sort_result', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='edits', to='api.sortresult')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('sort_result', 'seq'), name='unique_edit_seq_per_sort_result')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 11:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_edit_journal'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sortedtrack',
+            name='uri',
+            field=models.TextField(),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 5.2.7 on 2026-10-18 11:21
+
+import hashlib
+import re
+import unicodedata
+
+from django.db import migrations
+from django.db.models import Q
+
+# Frozen copy of api.fingerprints.title_key as of this migration, so running
+# it later gives the same keys whatever the normalizer has become since
+
+_PACKAGING = (
+    r'(?:\d{4}\s+)?(?:digital(?:ly)?\s+)?remaster(?:ed)?(?:\s+version)?(?:\s+\d{4})?'
+    r'|(?:single|album|mono|stereo|explicit|clean)(?:\s+version)?'
+    r'|deluxe(?:\s+(?:edition|version))?'
+    r'|bonus\s+track'
+)
+_RELEASE_SUFFIX = re.compile(
+    rf'\s*(?:[-–]\s*|[(\[]\s*)(?:{_PACKAGING})(?:\s*[/,&]\s*(?:{_PACKAGING}))*\s*[)\]]?\s*$',
+    re.IGNORECASE,
+)
+_FEATURING = re.compile(r'\s*[(\[]\s*(?:feat\.?|ft\.?|featuring|with)\s[^()\[\]]*[)\]]', re.IGNORECASE)
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def _fold(text):
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+    return _NON_WORD.sub(' ', text.casefold()).strip()
+
+
+def normalize_title(name):
+    if not any(c in name for c in '([-–'):
+        return _fold(name)
+    name = _FEATURING.sub('', name)
+    while True:
+        stripped = _RELEASE_SUFFIX.sub('', name)
+        if stripped == name or not stripped:
+            break
+        name = stripped
+    return _fold(name)
+
+
+def title_key(artist, name):
+    key = f'{_fold(artist)}\x1f{normalize_title(name)}'
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+
+def refresh_title_keys(apps, schema_editor):
+    # Live, acoustic, demo... versions used to get the plain title's key,
+    # only titles with a suffix can have changed
+    SortedTrack = apps.get_model('api', 'SortedTrack')
+    tracks = SortedTrack.objects.filter(
+        Q(name__contains='(') | Q(name__contains='[') | Q(name__contains='-') | Q(name__contains='–')
+    ).only('id', 'artist', 'name', 'title_key')
+    changed = []
+    for track in tracks.iterator(chunk_size=2000):
+        key = title_key(track.artist, track.name)
+        if key != track.title_key:
+            track.title_key = key
+            changed.append(track)
+        if len(changed) >= 1000:
+            SortedTrack.objects.bulk_update(changed, ['title_key'])
+            changed = []
+    SortedTrack.objects.bulk_update(changed, ['title_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_sortedtrack_uri_text'),
+    ]
+
+    operations = [
+        migrations.RunPython(refresh_title_keys, migrations.RunPython.noop),
+    ]
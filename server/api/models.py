@@ -1,3 +1,699 @@
-from django.db import models
+import logging
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import F, Max
+from django.utils import timezone
+
+from .columnar import ColumnarGroups
+from .fingerprints import DuplicateIndex, normalize_isrc, title_key
+from .metrics import timed_phase
+from .serializers import pack_sort_state, pack_track_rows, unpack_sort_state, unpack_track_rows
+
+logger = logging.getLogger(__name__)
 
 # Create your models here.
+
+# playlist_id of library sorts: the whole library, or LIBRARY_ID:<hash> for a
+# selection of playlists. Spotify playlist ids never contain ':'.
+LIBRARY_ID = 'library'
+
+# SortedTrack columns journal snapshots and removed-track entries keep, enough to recreate the row
+TRACK_ROW_FIELDS = (
+    'uri', 'name', 'artist', 'artist_key', 'image', 'genre', 'position', 'source_playlists', 'isrc', 'title_key',
+)
+_GENRE = TRACK_ROW_FIELDS.index('genre')
+_POSITION = TRACK_ROW_FIELDS.index('position')
+
+def replay_edit(rows, data):
+    """
+    Applies a journaled edit to in-memory track rows, {uri: row}
+    """
+    genre = data['genre']
+    for row in data['removed']:
+        rows.pop(row[0], None)
+    for tracks in data['moved'].values():
+        for uri, _, to_position in tracks:
+            row = rows.get(uri)
+            if row is not None:
+                row[_GENRE], row[_POSITION] = genre, to_position
+
+class SortResult(models.Model):
+    """
+    Genre grouping of one playlist for one session. Tracks are stored as
+    separate rows so edits only touch the rows that change.
+    """
+    session_key = models.CharField(max_length=40)
+    playlist_id = models.CharField(max_length=64)
+    # Incremented on every edit so clients patching deltas can detect stale state
+    version = models.PositiveIntegerField(default=0)
+    # Spotify snapshot of the playlist this grouping was built from
+    snapshot_id = models.CharField(max_length=100, blank=True)
+    # Name of the genre classifier that built the grouping
+    classifier = models.CharField(max_length=20, default='primary')
+    # Edit journal (see GenreEdit): seq of the last applied edit, of the last
+    # journaled one (edits after the head can be redone) and of the edit the
+    # journal snapshot was taken at (edits up to it are compacted away)
+    journal_head = models.PositiveIntegerField(default=0)
+    journal_tail = models.PositiveIntegerField(default=0)
+    journal_base = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['session_key', 'playlist_id'], name='unique_sort_result_per_session'),
+        ]
+
+    @classmethod
+    @timed_phase('store')
+    def store(cls, session_key, playlist_id, genre_groups, snapshot_id='', classifier='primary', sources=None):
+        """
+        Replaces the stored grouping of a playlist with genre_groups. Library
+        sorts pass sources, {uri: [playlist ids the track is in]}.
+        """
+        with transaction.atomic():
+            cls.objects.filter(session_key=session_key, playlist_id=playlist_id).delete()
+            result = cls.objects.create(
+                session_key=session_key,
+                playlist_id=playlist_id,
+                snapshot_id=snapshot_id,
+                classifier=classifier,
+            )
+            result._add_tracks(genre_groups, start_position=0, sources=sources)
+            result._take_snapshot()
+        return result
+
+    def _add_tracks(self, genre_groups, start_position, sources=None):
+        rows = []
+        seen_uris = set()
+        for genre, tracks in genre_groups.items():
+            for track in tracks:
+                # A uri can only live in one genre
+                if track['uri'] in seen_uris:
+                    continue
+                seen_uris.add(track['uri'])
+                rows.append(SortedTrack(
+                    sort_result=self,
+                    uri=track['uri'],
+                    name=track['name'],
+                    artist=track['artist'],
+                    artist_key=SortedTrack.normalize_artist(track['artist']),
+                    image=track['image'],
+                    genre=genre,
+                    position=start_position + len(rows),
+                    source_playlists=','.join(sources.get(track['uri'], ())) if sources else '',
+                    isrc=normalize_isrc(track.get('isrc')),
+                    title_key=title_key(track['artist'], track['name']),
+                ))
+
+        SortedTrack.objects.bulk_create(rows, batch_size=1000)
+        return len(rows)
+
+    def track_uris(self):
+        return set(self.tracks.values_list('uri', flat=True))
+
+    def genres(self):
+        return list(self.tracks.values_list('genre', flat=True).distinct())
+
+    @property
+    def is_library(self):
+        return self.playlist_id == LIBRARY_ID or self.playlist_id.startswith(f'{LIBRARY_ID}:')
+
+    def track_sources(self):
+        """
+        {uri: [playlist ids]} for library sorts, which playlists each track came from
+        """
+        rows = self.tracks.exclude(source_playlists='').values_list('uri', 'source_playlists')
+        return {uri: source_playlists.split(',') for uri, source_playlists in rows.iterator(chunk_size=2000)}
+
+    @timed_phase('store')
+    def apply_playlist_changes(self, added_genre_groups, removed_uris, snapshot_id, sources=None):
+        """
+        Brings the grouping up to date with a newer playlist snapshot: removed
+        tracks are deleted and newly classified tracks appended, while tracks
+        that stayed keep any genre the user moved them to. Library sorts pass
+        sources for every current track, kept tracks get theirs updated too.
+        """
+        with transaction.atomic():
+            self._lock_journal()
+            if removed_uris:
+                self.tracks.filter(uri__in=removed_uris).delete()
+            if sources:
+                self._update_sources(sources)
+            self._add_tracks(added_genre_groups, start_position=self._next_position(), sources=sources)
+            SortResult.objects.filter(pk=self.pk).update(snapshot_id=snapshot_id)
+            self.snapshot_id = snapshot_id
+            # Edits don't carry over a refresh, the refreshed grouping is the new base
+            self.edits.all().delete()
+            self._take_snapshot()
+            self._bump_version()
+
+    def _update_sources(self, sources):
+        changed = []
+        for track in self.tracks.only('id', 'uri', 'source_playlists').iterator(chunk_size=2000):
+            source_playlists = ','.join(sources.get(track.uri, ()))
+            if track.source_playlists != source_playlists:
+                track.source_playlists = source_playlists
+                changed.append(track)
+        SortedTrack.objects.bulk_update(changed, ['source_playlists'], batch_size=1000)
+
+    @classmethod
+    def lookup(cls, session_key, playlist_id):
+        return cls.objects.filter(session_key=session_key, playlist_id=playlist_id).first()
+
+    @timed_phase('load_groups')
+    def as_columnar(self, exclude_uris=()):
+        """
+        The grouping as ColumnarGroups. Read from the packed sort state cached
+        for this version, or in one pass over the rows without building model instances.
+        """
+        # Every edit bumps the version, so a cached version never goes stale
+        cache_key = self._sort_state_key(self.version)
+        groups = None
+        carried_key, carried = getattr(self, '_carried_sort_state', (None, None))
+        if carried_key == cache_key:
+            # Carried over by an edit on this instance, see _bump_version
+            groups = carried
+        elif (blob := cache.get(cache_key)) is not None:
+            try:
+                groups = unpack_sort_state(blob)
+            except ValueError:
+                groups = None
+
+        if groups is None:
+            rows = (
+                self.tracks.order_by('position')
+                .values_list('genre', 'uri', 'name', 'artist', 'image')
+                .iterator(chunk_size=2000)
+            )
+            # Rows come in position order, so genres keep the order in which their first track appears
+            groups = ColumnarGroups.from_rows(rows)
+            cache.set(cache_key, pack_sort_state(groups), settings.SORT_STATE_CACHE_TTL)
+
+        return groups.without(exclude_uris) if exclude_uris else groups
+
+    def as_genre_groups(self, exclude_uris=()):
+        """
+        Rebuilds the {genre: [track_info]} structure the client renders
+        """
+        return self.as_columnar(exclude_uris).expand()
+
+    def groups_payload(self, columnar=False, dedupe=False):
+        """
+        Response body with the grouping, its version and undo state. Clients that pass
+        ?columnar=true get the compact column form instead of genre_groups.
+        With dedupe, duplicate tracks are left out and listed under
+        duplicates instead. Library sorts also get the source playlists of each track.
+        """
+        duplicates = self.duplicates() if dedupe else {}
+        if columnar:
+            payload = {'columnar': self.as_columnar(duplicates).as_json(), 'version': self.version}
+        else:
+            payload = {'genre_groups': self.as_genre_groups(duplicates), 'version': self.version}
+        payload['can_undo'] = self.can_undo
+        payload['can_redo'] = self.can_redo
+        if dedupe:
+            payload['duplicates'] = duplicates
+        if self.is_library:
+            payload['sources'] = self.track_sources()
+        return payload
+
+    @timed_phase('dedupe')
+    def duplicates(self, genres=None):
+        """
+        {duplicate uri: uri of the earlier track it duplicates}, across every
+        genre or only the given ones. Earlier means earlier in display order.
+        """
+        tracks = self.tracks.all()
+        if genres is not None:
+            tracks = tracks.filter(genre__in=genres)
+
+        index = DuplicateIndex()
+        rows = tracks.order_by('position').values_list('uri', 'isrc', 'title_key', 'artist', 'name')
+        for uri, isrc, key, artist, name in rows.iterator(chunk_size=2000):
+            # Rows stored before fingerprints existed have no key yet
+            index.add(uri, isrc, key or title_key(artist, name))
+        return index.duplicates
+
+    def genre_uris(self, genre):
+        return list(self.tracks.filter(genre=genre).order_by('position').values_list('uri', flat=True))
+
+    def uris_by_genre(self, genres=None, dedupe=False):
+        """
+        {genre: [uris]} in display order, for every genre or only the given
+        ones. With dedupe a recording is only kept the first time it appears.
+        """
+        tracks = self.tracks.all()
+        if genres is not None:
+            tracks = tracks.filter(genre__in=genres)
+        duplicates = self.duplicates(genres) if dedupe else {}
+
+        uris_by_genre = {}
+        for genre, uri in tracks.order_by('position').values_list('genre', 'uri').iterator(chunk_size=2000):
+            if uri not in duplicates:
+                uris_by_genre.setdefault(genre, []).append(uri)
+        return uris_by_genre
+
+    def _next_position(self):
+        return (self.tracks.aggregate(Max('position'))['position__max'] or 0) + 1
+
+    def _sort_state_key(self, version):
+        return f'sort-state:{self.pk}:{version}'
+
+    def _bump_version(self, edit=None):
+        """
+        edit is (genre, moved, removed uris) of a move or combine just
+        journaled. The packed sort state cached for the old version is then
+        carried over to the new one, so reads after an edit don't go back to
+        the rows. Undo and redo put tracks back mid-grouping, they don't carry.
+        """
+        old_key = self._sort_state_key(self.version)
+        SortResult.objects.filter(pk=self.pk).update(version=F('version') + 1)
+        self.refresh_from_db(fields=['version'])
+        if edit is not None:
+            new_key = self._sort_state_key(self.version)
+            # Only once committed, a rolled back edit's version gets reused
+            transaction.on_commit(lambda: self._carry_sort_state(old_key, new_key, edit))
+
+    def _carry_sort_state(self, old_key, new_key, edit):
+        # The edit is already committed, failing to carry must not fail its request
+        try:
+            self._carry_edit(old_key, new_key, *edit)
+        except Exception:
+            logger.exception(f"Could not carry the sort state of {self.playlist_id} to version {self.version}")
+            self._carried_sort_state = (None, None)
+            try:
+                cache.delete(new_key)
+            except Exception:
+                logger.exception(f"Could not drop the sort state of {self.playlist_id} version {self.version}")
+
+    def _carry_edit(self, old_key, new_key, genre, moved, removed):
+        carried_key, groups = getattr(self, '_carried_sort_state', (None, None))
+        if carried_key != old_key:
+            blob = cache.get(old_key)
+            if blob is None:
+                return
+            try:
+                groups = unpack_sort_state(blob)
+            except ValueError:
+                return
+
+        removed = set(removed)
+        # Combines relabel tracks in place, moves append them after every other track
+        relabeled = {uri for uri, _, from_position, to_position in moved if from_position == to_position}
+        appended = {uri: to_position for uri, _, from_position, to_position in moved if from_position != to_position}
+        rows, moved_rows = [], []
+        for row in groups.rows():
+            uri = row[1]
+            if uri in removed:
+                continue
+            if uri in appended:
+                moved_rows.append((genre, *row[1:]))
+            elif uri in relabeled:
+                rows.append((genre, *row[1:]))
+            else:
+                rows.append(row)
+        moved_rows.sort(key=lambda row: appended[row[1]])
+        groups = ColumnarGroups.from_rows(rows + moved_rows)
+        cache.set(new_key, pack_sort_state(groups), settings.SORT_STATE_CACHE_TTL)
+        self._carried_sort_state = (new_key, groups)
+
+    def _track_rows(self):
+        return self.tracks.order_by('position').values_list(*TRACK_ROW_FIELDS)
+
+    def _take_snapshot(self):
+        # The current rows become the base the journal replays from
+        JournalSnapshot.objects.update_or_create(
+            sort_result=self,
+            defaults={'seq': self.journal_head, 'data': pack_track_rows(list(self._track_rows().iterator(chunk_size=2000)))},
+        )
+        SortResult.objects.filter(pk=self.pk).update(
+            journal_head=self.journal_head, journal_tail=self.journal_head, journal_base=self.journal_head,
+        )
+        self.journal_tail = self.journal_base = self.journal_head
+
+    def _lock_journal(self):
+        # Edits of one result run one at a time so journal seqs never fork.
+        # Picks up edits made through other instances since this one was loaded.
+        self.version, self.journal_head, self.journal_tail, self.journal_base = (
+            SortResult.objects.select_for_update()
+            .filter(pk=self.pk)
+            .values_list('version', 'journal_head', 'journal_tail', 'journal_base')
+            .get()
+        )
+        # Results stored before the journal existed get their base on the first edit
+        if not self.journal_head and not JournalSnapshot.objects.filter(sort_result=self).exists():
+            self._take_snapshot()
+
+    def _set_journal_head(self, seq, tail=None):
+        self.journal_head = seq
+        self.journal_tail = seq if tail is None else tail
+        SortResult.objects.filter(pk=self.pk).update(journal_head=self.journal_head, journal_tail=self.journal_tail)
+
+    def _journal(self, kind, genre, moved, removed=()):
+        """
+        Appends an applied edit. moved is [(uri, from genre, from position,
+        to position)], removed the TRACK_ROW_FIELDS rows of deleted tracks.
+        """
+        moved_from = {}
+        for uri, from_genre, from_position, to_position in moved:
+            moved_from.setdefault(from_genre, []).append([uri, from_position, to_position])
+
+        seq = self.journal_head + 1
+        # A new edit ends the redo history
+        if self.journal_tail >= seq:
+            self.edits.filter(seq__gte=seq).delete()
+        GenreEdit.objects.create(
+            sort_result=self,
+            seq=seq,
+            kind=kind,
+            data={'genre': genre, 'moved': moved_from, 'removed': [list(row) for row in removed]},
+        )
+        self._set_journal_head(seq)
+        if seq - self.journal_base >= settings.SORT_JOURNAL_COMPACT_EVERY:
+            self._compact()
+
+    def _compact(self):
+        """
+        Folds the edits older than SORT_UNDO_DEPTH into the snapshot
+        """
+        seq = self.journal_head - settings.SORT_UNDO_DEPTH
+        if seq <= self.journal_base:
+            return
+        rows = sorted(self.replay(seq).values(), key=lambda row: row[_POSITION])
+        JournalSnapshot.objects.filter(sort_result=self).update(seq=seq, data=pack_track_rows(rows))
+        self.edits.filter(seq__lte=seq).delete()
+        SortResult.objects.filter(pk=self.pk).update(journal_base=seq)
+        self.journal_base = seq
+
+    def _apply_edit(self, data, reverse=False):
+        # Only the rows the edit touched are written
+        if reverse and data['removed']:
+            SortedTrack.objects.bulk_create(
+                [SortedTrack(sort_result=self, **dict(zip(TRACK_ROW_FIELDS, row))) for row in data['removed']],
+                batch_size=1000,
+            )
+        elif data['removed']:
+            self.tracks.filter(uri__in=[row[0] for row in data['removed']]).delete()
+
+        for from_genre, tracks in data['moved'].items():
+            genre = from_genre if reverse else data['genre']
+            # Combines keep positions, those are one UPDATE per genre
+            relabeled = [uri for uri, from_position, to_position in tracks if from_position == to_position]
+            if relabeled:
+                self.tracks.filter(uri__in=relabeled).update(genre=genre)
+            positions = {
+                uri: from_position if reverse else to_position
+                for uri, from_position, to_position in tracks
+                if from_position != to_position
+            }
+            changed = []
+            for track in self.tracks.filter(uri__in=positions).only('id', 'uri', 'genre', 'position'):
+                track.genre, track.position = genre, positions[track.uri]
+                changed.append(track)
+            SortedTrack.objects.bulk_update(changed, ['genre', 'position'], batch_size=1000)
+
+    @property
+    def can_undo(self):
+        return self.journal_head > self.journal_base
+
+    @property
+    def can_redo(self):
+        return self.journal_tail > self.journal_head
+
+    @timed_phase('edit')
+    def undo(self):
+        """
+        Reverts the last applied edit. Returns it, or None if there is nothing
+        to undo (no edits, or only ones already compacted into the snapshot).
+        """
+        with transaction.atomic():
+            self._lock_journal()
+            if not self.can_undo:
+                return None
+            edit = self.edits.get(seq=self.journal_head)
+            self._apply_edit(edit.data, reverse=True)
+            self._set_journal_head(self.journal_head - 1, tail=self.journal_tail)
+            self._bump_version()
+            return edit
+
+    @timed_phase('edit')
+    def redo(self):
+        """
+        Applies the last undone edit again. Returns it, or None if there is nothing to redo.
+        """
+        with transaction.atomic():
+            self._lock_journal()
+            if not self.can_redo:
+                return None
+            edit = self.edits.get(seq=self.journal_head + 1)
+            self._apply_edit(edit.data)
+            self._set_journal_head(self.journal_head + 1, tail=self.journal_tail)
+            self._bump_version()
+            return edit
+
+    def replay(self, seq=None):
+        """
+        Track rows as of edit seq (default the head) as {uri: row}, rebuilt
+        from the journal snapshot and the edits after it
+        """
+        snapshot = JournalSnapshot.objects.get(sort_result=self)
+        seq = self.journal_head if seq is None else seq
+        rows = {row[0]: row for row in unpack_track_rows(snapshot.data)}
+        for data in self.edits.filter(seq__gt=snapshot.seq, seq__lte=seq).order_by('seq').values_list('data', flat=True):
+            replay_edit(rows, data)
+        return rows
+
+    @timed_phase('store')
+    def rebuild(self):
+        """
+        Rewrites the track rows from replay(), for rows that drifted from the journal
+        """
+        with transaction.atomic():
+            self._lock_journal()
+            rows = sorted(self.replay().values(), key=lambda row: row[_POSITION])
+            self.tracks.all().delete()
+            SortedTrack.objects.bulk_create(
+                [SortedTrack(sort_result=self, **dict(zip(TRACK_ROW_FIELDS, row))) for row in rows],
+                batch_size=1000,
+            )
+            self._bump_version()
+
+    @timed_phase('edit')
+    def move_track(self, track_uri, new_genre):
+        """
+        Moves one track to new_genre. Returns the list of moved uris, or None
+        if the track is not in this result.
+        """
+        with transaction.atomic():
+            self._lock_journal()
+            track = self.tracks.filter(uri=track_uri).values_list('genre', 'position').first()
+            if track is None:
+                return None
+            if track[0] == new_genre:
+                return []
+            position = self._next_position()
+            self.tracks.filter(uri=track_uri).update(genre=new_genre, position=position)
+            moved = [(track_uri, *track, position)]
+            self._journal('move_track', new_genre, moved)
+            self._bump_version(edit=(new_genre, moved, ()))
+            return [track_uri]
+
+    @timed_phase('edit')
+    def move_artist_tracks(self, artist_name, new_genre, current_genre=None):
+        """
+        Moves every track by artist_name into new_genre, returns the moved uris
+        """
+        with transaction.atomic():
+            self._lock_journal()
+            tracks = self.tracks.filter(artist_key=SortedTrack.normalize_artist(artist_name)).exclude(genre=new_genre)
+            if current_genre and self.tracks.filter(genre=current_genre).exists():
+                tracks = tracks.filter(genre=current_genre)
+
+            moved = list(tracks.order_by('position').values_list('id', 'uri', 'genre', 'position'))
+            if not moved:
+                return []
+
+            # Append the moved tracks to the end of new_genre, keeping their order
+            offset = self._next_position() - moved[0][3]
+            SortedTrack.objects.filter(id__in=[track_id for track_id, _, _, _ in moved]).update(
+                genre=new_genre,
+                position=F('position') + offset,
+            )
+            journaled = [(uri, genre, position, position + offset) for _, uri, genre, position in moved]
+            self._journal('move_artist', new_genre, journaled)
+            self._bump_version(edit=(new_genre, journaled, ()))
+            return [uri for _, uri, _, _ in moved]
+
+    @timed_phase('edit')
+    def combine_genres(self, genres, combined_genre, dedupe=False):
+        """
+        Relabels every track of the given genres. With dedupe, duplicate
+        recordings among them are removed first. Returns (combined uris, removed uris).
+        """
+        with transaction.atomic():
+            self._lock_journal()
+            removed = list(self.duplicates(genres)) if dedupe else []
+            removed_rows = []
+            if removed:
+                # Kept whole in the journal so undo can bring them back
+                removed_rows = list(self.tracks.filter(uri__in=removed).values_list(*TRACK_ROW_FIELDS))
+                self.tracks.filter(uri__in=removed).delete()
+            tracks = self.tracks.filter(genre__in=genres)
+            combined = list(tracks.order_by('position').values_list('uri', 'genre', 'position'))
+            if combined:
+                tracks.update(genre=combined_genre)
+            if combined or removed:
+                journaled = [
+                    (uri, genre, position, position) for uri, genre, position in combined if genre != combined_genre
+                ]
+                self._journal('combine', combined_genre, journaled, removed_rows)
+                self._bump_version(edit=(combined_genre, journaled, removed))
+            return [uri for uri, _, _ in combined], removed
+
+
+class SortedTrack(models.Model):
+    sort_result = models.ForeignKey(SortResult, related_name='tracks', on_delete=models.CASCADE)
+    # Local files have long spotify:local:artist:album:title:duration uris
+    uri = models.TextField()
+    name = models.TextField()
+    artist = models.TextField()
+    # Normalized artist name, indexed for moving all tracks by an artist
+    artist_key = models.TextField(default='')
+    image = models.URLField(max_length=500, null=True, blank=True)
+    genre = models.TextField()
+    # Display order, moved tracks get appended after every existing track
+    position = models.PositiveIntegerField()
+    # Comma separated ids of the playlists the track came from, library sorts only
+    source_playlists = models.TextField(blank=True, default='')
+    # Duplicate detection keys, see fingerprints.py
+    isrc = models.CharField(max_length=12, blank=True, default='')
+    title_key = models.CharField(max_length=16, blank=True, default='')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['sort_result', 'uri'], name='unique_track_per_sort_result'),
+        ]
+        indexes = [
+            models.Index(fields=['sort_result', 'genre']),
+            models.Index(fields=['sort_result', 'artist_key']),
+            models.Index(fields=['sort_result', 'position']),
+        ]
+
+    @staticmethod
+    def normalize_artist(artist_name):
+        return artist_name.strip().casefold()
+
+    def as_track_info(self):
+        return {
+            'name': self.name,
+            'artist': self.artist,
+            'uri': self.uri,
+            'image': self.image,
+        }
+
+
+class GenreEdit(models.Model):
+    """
+    One entry of a result's append-only edit journal. data holds only what
+    the edit changed: {'genre': target genre, 'moved': {from genre: [[uri,
+    from position, to position]]}, 'removed': [TRACK_ROW_FIELDS rows]}, so
+    it can be applied either way without touching other tracks.
+    """
+    sort_result = models.ForeignKey(SortResult, related_name='edits', on_delete=models.CASCADE)
+    seq = models.PositiveIntegerField()
+    # 'move_track', 'move_artist' or 'combine'
+    kind = models.CharField(max_length=20)
+    data = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['sort_result', 'seq'], name='unique_edit_seq_per_sort_result'),
+        ]
+
+
+class JournalSnapshot(models.Model):
+    """
+    Track rows of a result as of edit seq, packed (see serializers.py). The
+    journal replays on top of it, edits up to seq are compacted away.
+    """
+    sort_result = models.OneToOneField(SortResult, related_name='journal_snapshot', on_delete=models.CASCADE)
+    seq = models.PositiveIntegerField(default=0)
+    data = models.BinaryField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class SortJob(models.Model):
+    """
+    A playlist sort running on the background worker pool. Progress counters
+    are updated as the sort runs so clients can poll or stream them.
+    """
+    QUEUED = 'queued'
+    FETCHING_TRACKS = 'fetching_tracks'
+    RESOLVING_ARTISTS = 'resolving_artists'
+    GROUPING = 'grouping'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (FETCHING_TRACKS, 'Fetching tracks'),
+        (RESOLVING_ARTISTS, 'Resolving artists'),
+        (GROUPING, 'Grouping'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    session_key = models.CharField(max_length=40)
+    playlist_id = models.CharField(max_length=64)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    tracks_fetched = models.PositiveIntegerField(default=0)
+    tracks_total = models.PositiveIntegerField(default=0)
+    artists_resolved = models.PositiveIntegerField(default=0)
+    artists_total = models.PositiveIntegerField(default=0)
+    genres_built = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    @property
+    def stale(self):
+        return not self.finished and self.updated_at < timezone.now() - timedelta(seconds=settings.SORT_JOB_STALE_SECONDS)
+
+    @classmethod
+    def fail_stale(cls, **filters):
+        """
+        Fails unfinished jobs that made no progress for SORT_JOB_STALE_SECONDS,
+        i.e. ones lost when the process running them restarted. Returns how many.
+        """
+        cutoff = timezone.now() - timedelta(seconds=settings.SORT_JOB_STALE_SECONDS)
+        return (
+            cls.objects.filter(updated_at__lt=cutoff, **filters)
+            .exclude(status__in=(cls.DONE, cls.FAILED))
+            .update(status=cls.FAILED, error='The sort was interrupted, please try again', updated_at=timezone.now())
+        )
+
+    def update_progress(self, status, **counts):
+        SortJob.objects.filter(pk=self.pk).update(status=status, updated_at=timezone.now(), **counts)
+
+    def as_progress(self):
+        return {
+            'job_id': str(self.id),
+            'playlist_id': self.playlist_id,
+            'status': self.status,
+            'tracks_fetched': self.tracks_fetched,
+            'tracks_total': self.tracks_total,
+            'artists_resolved': self.artists_resolved,
+            'artists_total': self.artists_total,
+            'genres_built': self.genres_built,
+            'error': self.error or None,
+        }
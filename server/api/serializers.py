@@ -0,0 +1,145 @@
+import struct
+import sys
+import zlib
+from array import array
+
+import orjson
+
+from .columnar import IMAGE_URL_PREFIX, ColumnarGroups, _add_prefix, _strip_prefix
+
+# Compact encodings for state kept between requests.
+#
+# Sessions only hold the Spotify token since sort results moved to the
+# database, SessionSerializer just makes encoding it cheaper. The layout is
+# the same JSON Django writes, so existing sessions keep loading.
+#
+# Sort state is a stored grouping in columnar form, packed into one binary
+# blob that the cache can hold (see SortResult.as_columnar):
+#
+#   header  magic b'GS', schema version, then the byte lengths of the
+#           sections below (little endian)
+#   body    zlib of: orjson {artists, images, names, uris, genres, genre_sizes}
+#           (images without the i.scdn.co prefix)
+#           + artist_index + image_index + genre members, as raw 32-bit arrays
+#
+# Bump SORT_STATE_SCHEMA whenever the layout changes, blobs from another
+# schema are rejected and rebuilt from the database.
+
+SORT_STATE_SCHEMA = 1
+_MAGIC = b'GS'
+_HEADER = struct.Struct('<2sBIII')
+# Speed over ratio, most of the size win is the interning and the raw arrays
+_COMPRESSION_LEVEL = 1
+
+
+class SessionSerializer:
+    """
+    Drop-in for django.core.signing.JSONSerializer backed by orjson
+    """
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+def _array_bytes(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _bytes_array(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def pack_sort_state(groups):
+    """
+    ColumnarGroups -> bytes
+    """
+    members = array('I')
+    for genre_members in groups.genres.values():
+        members.extend(genre_members)
+
+    columns = orjson.dumps({
+        'artists': groups.artists,
+        'images': [_strip_prefix(image, IMAGE_URL_PREFIX) for image in groups.images],
+        'names': groups.names,
+        'uris': groups.uris,
+        'genres': list(groups.genres),
+        'genre_sizes': [len(genre_members) for genre_members in groups.genres.values()],
+    })
+    artist_index = _array_bytes(groups.artist_index)
+    image_index = _array_bytes(groups.image_index)
+    body = zlib.compress(columns + artist_index + image_index + _array_bytes(members), _COMPRESSION_LEVEL)
+    return _HEADER.pack(_MAGIC, SORT_STATE_SCHEMA, len(columns), len(artist_index), len(image_index)) + body
+
+
+def unpack_sort_state(blob):
+    """
+    bytes -> ColumnarGroups. Raises ValueError for blobs that aren't sort
+    state or were written with another schema.
+    """
+    try:
+        magic, schema, columns_size, artists_size, images_size = _HEADER.unpack_from(blob)
+        body = zlib.decompress(blob[_HEADER.size:])
+    except (struct.error, zlib.error, TypeError) as e:
+        raise ValueError('Not a sort state blob') from e
+    if magic != _MAGIC or schema != SORT_STATE_SCHEMA:
+        raise ValueError(f'Unsupported sort state schema {schema}')
+
+    columns = orjson.loads(body[:columns_size])
+    offset = columns_size
+    groups = ColumnarGroups()
+    groups.artists = columns['artists']
+    groups.images = [_add_prefix(image, IMAGE_URL_PREFIX, '://') for image in columns['images']]
+    groups.names = columns['names']
+    groups.uris = columns['uris']
+    groups.artist_index = _bytes_array('I', body[offset:offset + artists_size])
+    offset += artists_size
+    groups.image_index = _bytes_array('i', body[offset:offset + images_size])
+    offset += images_size
+
+    members = _bytes_array('I', body[offset:])
+    start = 0
+    for genre, size in zip(columns['genres'], columns['genre_sizes']):
+        groups.genres[genre] = members[start:start + size]
+        start += size
+    return groups
+
+
+# Journal snapshots (see JournalSnapshot) are the full track rows of a
+# grouping, each a list in TRACK_ROW_FIELDS order:
+#
+#   header  magic b'GR', schema version
+#   body    zlib of: orjson [[row], ...]
+
+TRACK_ROWS_SCHEMA = 1
+_ROWS_MAGIC = b'GR'
+_ROWS_HEADER = struct.Struct('<2sB')
+
+
+def pack_track_rows(rows):
+    """
+    Track rows -> bytes
+    """
+    return _ROWS_HEADER.pack(_ROWS_MAGIC, TRACK_ROWS_SCHEMA) + zlib.compress(orjson.dumps(rows), _COMPRESSION_LEVEL)
+
+
+def unpack_track_rows(blob):
+    """
+    bytes -> list of track rows. Raises ValueError like unpack_sort_state.
+    """
+    try:
+        magic, schema = _ROWS_HEADER.unpack_from(blob)
+        body = zlib.decompress(blob[_ROWS_HEADER.size:])
+    except (struct.error, zlib.error, TypeError) as e:
+        raise ValueError('Not a track rows blob') from e
+    if magic != _ROWS_MAGIC or schema != TRACK_ROWS_SCHEMA:
+        raise ValueError(f'Unsupported track rows schema {schema}')
+    return orjson.loads(body)
@@ -0,0 +1,288 @@
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .classification import get_classifier
+from .genre_cache import artist_genre_cache
+from .metrics import in_request_context, phase
+from .models import LIBRARY_ID, SortResult
+from .spotify import (
+    PLAYLIST_TRACK_FIELDS,
+    SpotifyFetchError,
+    call_spotify,
+    fetch_all_pages,
+    fetch_artist_genres,
+    parse_playlist,
+    parse_track,
+)
+from .user_cache import PLAYLIST_PAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# playlist_items allows up to 100 per page
+PLAYLIST_ITEMS_PAGE_SIZE = 100
+
+
+def new_tracks_since(sort_result, tracks):
+    """
+    Splits a fresh track list against a stored grouping into
+    (tracks that still need classifying, uris that left the playlist)
+    """
+    known_uris = sort_result.track_uris()
+    current_uris = {track.uri for track in tracks}
+    added_tracks = [track for track in tracks if track.uri not in known_uris]
+    return added_tracks, known_uris - current_uris
+
+
+def _no_report(status, **counts):
+    pass
+
+
+def resolve_artist_genres(sp, artist_ids, report=_no_report):
+    """
+    {artist_id: [genres]} for the given (unique) artists, from the shared
+    cache where possible, misses are fetched concurrently under the shared
+    rate limiter and cached. report(status, **counts) gets the progress.
+    """
+    artist_genres_map, missing_artist_ids = artist_genre_cache.get_many(artist_ids)
+    cached_count = len(artist_genres_map)
+    report('resolving_artists', artists_resolved=cached_count, artists_total=len(artist_ids))
+
+    with phase('fetch_artists'):
+        fetched_genres = fetch_artist_genres(
+            sp,
+            missing_artist_ids,
+            on_progress=lambda resolved, total: report(
+                'resolving_artists',
+                artists_resolved=cached_count + resolved,
+                artists_total=len(artist_ids),
+            ),
+        )
+
+    artist_genres_map.update(fetched_genres)
+    artist_genre_cache.set_many(fetched_genres)
+    return artist_genres_map
+
+
+def sort_playlist(sp, session_key, playlist_id, progress=None, refresh=False, classifier=None):
+    """
+    Sorts a playlist by genre and stores the result, returning the SortResult.
+    If the playlist's snapshot_id hasn't changed since the last sort the stored
+    grouping is returned as is. If it has, only added tracks are classified so
+    manual genre moves survive. refresh forces a full re-sort, as does asking
+    for a different classifier (a name for get_classifier) than the stored one.
+    progress(phase, **counts), if given, is called as tracks are fetched,
+    artists resolved and groups built. Raises SpotifyFetchError with a message
+    suitable for the client.
+    """
+    def report(status, **counts):
+        if progress:
+            progress(status, **counts)
+
+    try:
+        with phase('snapshot'):
+            snapshot_id = call_spotify(sp.playlist, playlist_id, fields='snapshot_id')['snapshot_id']
+    except SpotifyFetchError as e:
+        logger.error(f"Error fetching snapshot for playlist {playlist_id}: {e}")
+        raise SpotifyFetchError('Failed to fetch playlist from Spotify', status=e.status) from e
+
+    classifier = get_classifier(classifier)
+    previous = None if refresh else SortResult.lookup(session_key, playlist_id)
+    if previous and previous.classifier != classifier.name:
+        previous = None
+    if previous and previous.snapshot_id == snapshot_id:
+        return previous
+
+    # Get all tracks from the playlist, requesting only the fields we use
+    try:
+        with phase('fetch_tracks'):
+            tracks = fetch_all_pages(
+                sp.playlist_items,
+                playlist_id,
+                limit=100,
+                fields=PLAYLIST_TRACK_FIELDS,
+                additional_types=('track',),
+                parse_item=parse_track,
+                on_progress=lambda fetched, total: report('fetching_tracks', tracks_fetched=fetched, tracks_total=total),
+            )
+    except SpotifyFetchError as e:
+        logger.error(f"Error fetching tracks for playlist {playlist_id}: {e}")
+        raise SpotifyFetchError('Failed to fetch playlist tracks from Spotify', status=e.status) from e
+
+    # Only tracks added since the previous snapshot need classifying
+    removed_uris = set()
+    if previous and previous.snapshot_id:
+        tracks, removed_uris = new_tracks_since(previous, tracks)
+
+    try:
+        artist_genres_map = resolve_artist_genres(sp, classifier.artist_ids(tracks), report)
+    except SpotifyFetchError as e:
+        logger.error(f"Error fetching artists for playlist {playlist_id}: {e}")
+        raise SpotifyFetchError('Failed to fetch artist genres from Spotify', status=e.status) from e
+
+    # Now group tracks by genre, new tracks join the existing genres where they fit
+    known_genres = previous.genres() if previous and previous.snapshot_id else ()
+    with phase('classify'):
+        genre_groups = classifier.classify(tracks, artist_genres_map, known_genres=known_genres)
+    report('grouping', genres_built=len(genre_groups))
+
+    if previous and previous.snapshot_id:
+        previous.apply_playlist_changes(genre_groups, removed_uris, snapshot_id)
+        return previous
+    return SortResult.store(session_key, playlist_id, genre_groups, snapshot_id=snapshot_id, classifier=classifier.name)
+
+
+def library_id(playlist_ids, whole_library=False):
+    """
+    playlist_id the grouping of several playlists is stored under
+    """
+    if whole_library:
+        return LIBRARY_ID
+    digest = hashlib.sha1(','.join(sorted(playlist_ids)).encode()).hexdigest()[:16]
+    return f'{LIBRARY_ID}:{digest}'
+
+
+def fetch_library_snapshots(sp, playlist_ids):
+    """
+    {playlist_id: snapshot_id}. me/playlists lists 50 playlists and their
+    snapshots per page, so the listing is read when that takes fewer calls
+    than asking each playlist. Playlists it doesn't list are asked directly.
+    """
+    first_page = call_spotify(sp.current_user_playlists, limit=PLAYLIST_PAGE_SIZE, offset=0)
+    if -(-(first_page.get('total') or 0) // PLAYLIST_PAGE_SIZE) <= len(playlist_ids):
+        playlists = fetch_all_pages(sp.current_user_playlists, limit=PLAYLIST_PAGE_SIZE, parse_item=parse_playlist, first_page=first_page)
+    else:
+        playlists = [playlist for playlist in map(parse_playlist, first_page['items']) if playlist is not None]
+    snapshots = {playlist['id']: playlist['snapshot_id'] for playlist in playlists if playlist['snapshot_id']}
+
+    def fetch_snapshot(playlist_id):
+        return call_spotify(sp.playlist, playlist_id, fields='snapshot_id')['snapshot_id']
+
+    missing = [playlist_id for playlist_id in playlist_ids if playlist_id not in snapshots]
+    if missing:
+        workers = min(settings.SPOTIFY_MAX_WORKERS, len(missing))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            snapshots.update(zip(missing, executor.map(in_request_context(fetch_snapshot), missing)))
+    return snapshots
+
+
+def fetch_library_tracks(sp, playlist_ids, report):
+    """
+    Tracks of every playlist. The first pages (which give each playlist's
+    total) and then all remaining pages are fetched concurrently on one
+    pool. Returns the tracks deduplicated by uri (first occurrence wins, in
+    playlist order) and {uri: [playlist ids]} with every playlist each track is in.
+    """
+    def fetch_page(playlist_id, offset):
+        try:
+            page = call_spotify(
+                sp.playlist_items,
+                playlist_id,
+                limit=PLAYLIST_ITEMS_PAGE_SIZE,
+                offset=offset,
+                fields=PLAYLIST_TRACK_FIELDS,
+                additional_types=('track',),
+            )
+        except SpotifyFetchError as e:
+            logger.error(f"Error fetching tracks for playlist {playlist_id}: {e}")
+            raise
+        return page.get('total') or 0, [track for track in map(parse_track, page['items']) if track is not None]
+
+    playlist_tracks = {}
+    tracks_fetched = 0
+    workers = min(settings.SPOTIFY_MAX_WORKERS, len(playlist_ids))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        fetch = in_request_context(fetch_page)
+        first_pages = list(executor.map(fetch, playlist_ids, [0] * len(playlist_ids)))
+        tracks_total = sum(total for total, _ in first_pages)
+        rest_ids, rest_offsets = [], []
+        for playlist_id, (total, items) in zip(playlist_ids, first_pages):
+            playlist_tracks[playlist_id] = items
+            tracks_fetched += min(PLAYLIST_ITEMS_PAGE_SIZE, total)
+            for offset in range(PLAYLIST_ITEMS_PAGE_SIZE, total, PLAYLIST_ITEMS_PAGE_SIZE):
+                rest_ids.append(playlist_id)
+                rest_offsets.append(offset)
+        report('fetching_tracks', tracks_fetched=tracks_fetched, tracks_total=tracks_total)
+
+        # map yields in submission order, so each playlist's pages arrive in offset order
+        for playlist_id, (_, items) in zip(rest_ids, executor.map(fetch, rest_ids, rest_offsets)):
+            playlist_tracks[playlist_id].extend(items)
+            tracks_fetched = min(tracks_fetched + PLAYLIST_ITEMS_PAGE_SIZE, tracks_total)
+            report('fetching_tracks', tracks_fetched=tracks_fetched, tracks_total=tracks_total)
+
+    tracks = []
+    sources = {}
+    for playlist_id in playlist_ids:
+        for track in playlist_tracks[playlist_id]:
+            track_sources = sources.get(track.uri)
+            if track_sources is None:
+                sources[track.uri] = [playlist_id]
+                tracks.append(track)
+            elif track_sources[-1] != playlist_id:
+                track_sources.append(playlist_id)
+    return tracks, sources
+
+
+def sort_library(sp, session_key, playlist_ids, whole_library=False, progress=None, refresh=False, classifier=None):
+    """
+    Sorts several playlists, or the whole library, into one grouping stored
+    under library_id(). Tracks in more than one playlist are grouped once,
+    artists are resolved in a single pass over all playlists, and every track
+    records which playlists it came from. Like sort_playlist, an unchanged
+    set of snapshots returns the stored grouping, and a changed one only
+    classifies added tracks.
+    """
+    def report(status, **counts):
+        if progress:
+            progress(status, **counts)
+
+    playlist_ids = list(dict.fromkeys(playlist_ids))
+    classifier = get_classifier(classifier)
+    result_id = library_id(playlist_ids, whole_library)
+
+    # The library's snapshot is a digest of its playlists' snapshots
+    try:
+        with phase('snapshot'):
+            snapshots = fetch_library_snapshots(sp, playlist_ids)
+    except SpotifyFetchError as e:
+        logger.error(f"Error fetching snapshots for library {result_id}: {e}")
+        raise SpotifyFetchError('Failed to fetch playlists from Spotify', status=e.status) from e
+    snapshot_id = hashlib.sha1(
+        '\n'.join(f'{playlist_id}:{snapshots[playlist_id]}' for playlist_id in playlist_ids).encode()
+    ).hexdigest()
+
+    previous = None if refresh else SortResult.lookup(session_key, result_id)
+    if previous and previous.classifier != classifier.name:
+        previous = None
+    if previous and previous.snapshot_id == snapshot_id:
+        return previous
+
+    try:
+        with phase('fetch_tracks'):
+            tracks, sources = fetch_library_tracks(sp, playlist_ids, report)
+    except SpotifyFetchError as e:
+        raise SpotifyFetchError('Failed to fetch playlist tracks from Spotify', status=e.status) from e
+
+    removed_uris = set()
+    if previous:
+        tracks, removed_uris = new_tracks_since(previous, tracks)
+
+    try:
+        artist_genres_map = resolve_artist_genres(sp, classifier.artist_ids(tracks), report)
+    except SpotifyFetchError as e:
+        logger.error(f"Error fetching artists for library {result_id}: {e}")
+        raise SpotifyFetchError('Failed to fetch artist genres from Spotify', status=e.status) from e
+
+    known_genres = previous.genres() if previous else ()
+    with phase('classify'):
+        genre_groups = classifier.classify(tracks, artist_genres_map, known_genres=known_genres)
+    report('grouping', genres_built=len(genre_groups))
+
+    if previous:
+        previous.apply_playlist_changes(genre_groups, removed_uris, snapshot_id, sources=sources)
+        return previous
+    return SortResult.store(
+        session_key, result_id, genre_groups, snapshot_id=snapshot_id, classifier=classifier.name, sources=sources
+    )
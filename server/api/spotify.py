@@ -0,0 +1,427 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import spotipy
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth, SpotifyOauthError
+
+from .metrics import in_request_context, record_rate_limit_wait, record_spotify_call, record_spotify_retry
+
+logger = logging.getLogger(__name__)
+
+# Spotify allows up to 50 artists per request
+ARTIST_BATCH_SIZE = 50
+
+# Only request the track fields the sort actually reads
+PLAYLIST_TRACK_FIELDS = 'total,items(track(name,uri,external_ids(isrc),artists(id,name),album(images(url))))'
+
+# Compact track record used instead of the full Spotify track object
+TrackRecord = namedtuple('TrackRecord', ['name', 'artist_id', 'artist', 'uri', 'image', 'artist_ids', 'isrc'])
+
+
+class SpotifyFetchError(Exception):
+    """
+    Raised when a Spotify request still fails after every retry, or is
+    rejected outright. status is Spotify's HTTP status for rejected requests
+    (401 expired token, 404 unknown playlist...), None otherwise.
+    """
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def response_status(self):
+        # Status for our own response: an expired token or unknown playlist is
+        # passed on, anything else is Spotify failing us (bad gateway)
+        return self.status if self.status in (401, 404) else 502
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every request in the process. A 429 pauses the
+    bucket for Retry-After seconds and halves the refill rate, which then
+    recovers gradually as requests succeed.
+    """
+    def __init__(self, rate, burst, min_rate=1.0):
+        self.min_rate = min_rate
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst):
+        """
+        Resets the bucket to a new rate and burst size
+        """
+        with self._lock:
+            self.max_rate = rate
+            self.rate = rate
+            self.capacity = burst
+            self._tokens = float(burst)
+            self._updated = time.monotonic()
+            self._paused_until = 0.0
+
+    def reserve(self):
+        """
+        Takes a token if one is available and returns 0, otherwise returns how
+        long to wait before trying again. Does not block, so async code can
+        share the same bucket.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        waited = 0
+        while wait := self.reserve():
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            record_rate_limit_wait(waited)
+
+    def throttle(self, retry_after):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._tokens = 0.0
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def recover(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+
+spotify_rate_limiter = RateLimiter(
+    rate=settings.SPOTIFY_RATE_LIMIT,
+    burst=settings.SPOTIFY_RATE_LIMIT_BURST,
+)
+
+
+SCOPE = "playlist-read-private playlist-modify-public playlist-modify-private"
+
+REDIRECT_URI = os.environ.get('REDIRECT_URI')
+
+
+class PooledSpotify(spotipy.Spotify):
+    """
+    spotipy client running on the shared connection pool
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prefix = settings.SPOTIFY_API_URL
+
+    def __del__(self):
+        # spotipy closes its session when the client is collected, the pool
+        # outlives every client so leave it open
+        pass
+
+
+class PooledSpotifyOAuth(SpotifyOAuth):
+    """
+    SpotifyOAuth on the shared connection pool, which it must not close
+    when collected either
+    """
+    def __del__(self):
+        pass
+
+
+class PooledSpotifyClientCredentials(SpotifyClientCredentials):
+    """
+    SpotifyClientCredentials on the shared connection pool, left open like PooledSpotify's
+    """
+    def __del__(self):
+        pass
+
+
+class SpotifyClientPool:
+    """
+    Process-level factory for Spotify clients. Every client shares one
+    keep-alive connection pool, so requests reuse TLS connections to Spotify
+    instead of handshaking per request. The pool's session has no urllib3
+    retries, so 429 responses (and their Retry-After header) reach call_spotify.
+    """
+    def __init__(self, pool_size):
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', self.adapter)
+        self.clients_created = 0
+        self.token_refreshes = 0
+        self._lock = threading.Lock()
+
+    def oauth(self, token_info=None):
+        return PooledSpotifyOAuth(
+            client_id=os.environ.get('SPOTIFY_CLIENT_ID'),
+            client_secret=os.environ.get('SPOTIFY_CLIENT_SECRET'),
+            redirect_uri=REDIRECT_URI,
+            scope=SCOPE,
+            cache_handler=spotipy.MemoryCacheHandler(token_info=token_info),
+            requests_session=self.session,
+        )
+
+    def client(self, access_token):
+        with self._lock:
+            self.clients_created += 1
+        return PooledSpotify(auth=access_token, requests_session=self.session)
+
+    def app_client(self):
+        """
+        Client authenticated as the app itself rather than a user, for
+        server-side jobs that only read public data
+        """
+        auth_manager = PooledSpotifyClientCredentials(
+            client_id=os.environ.get('SPOTIFY_CLIENT_ID'),
+            client_secret=os.environ.get('SPOTIFY_CLIENT_SECRET'),
+            requests_session=self.session,
+        )
+        return PooledSpotify(auth_manager=auth_manager, requests_session=self.session)
+
+    def session_token(self, session):
+        """
+        Returns the session's token info, refreshing (and saving) it first if
+        it is about to expire. Returns None if there is no usable token.
+        """
+        token_info = session.get('spotify_token_info', None)
+        if not token_info:
+            return None
+
+        if SpotifyOAuth.is_token_expired(token_info):
+            try:
+                token_info = self.oauth(token_info).refresh_access_token(token_info['refresh_token'])
+            except (SpotifyOauthError, KeyError) as e:
+                logger.warning(f"Could not refresh Spotify token: {e}")
+                return None
+            with self._lock:
+                self.token_refreshes += 1
+            session['spotify_token_info'] = token_info
+
+        return token_info
+
+    def client_for_session(self, session):
+        """
+        Client bound to the token stored in a Django session, None if not logged in
+        """
+        token_info = self.session_token(session)
+        if not token_info:
+            return None
+        return self.client(token_info['access_token'])
+
+    def stats(self):
+        hosts = {}
+        for key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            hosts[pool.host] = {
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle_connections': pool.pool.qsize() if pool.pool else 0,
+            }
+        return {
+            'clients_created': self.clients_created,
+            'token_refreshes': self.token_refreshes,
+            'pool_maxsize': self.adapter._pool_maxsize,
+            'hosts': hosts,
+        }
+
+
+spotify_pool = SpotifyClientPool(pool_size=settings.SPOTIFY_POOL_SIZE)
+
+
+def retry_after_seconds(headers):
+    try:
+        return float(headers.get('Retry-After', 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+def backoff_delay(attempt):
+    # Exponential backoff with jitter, capped at 8 seconds
+    return min(8, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def call_spotify(func, *args, retry_errors=True, **kwargs):
+    """
+    Calls a spotipy method under the shared rate limiter, retrying 429s,
+    5xx responses and connection errors with backoff. Non-idempotent calls
+    pass retry_errors=False: only 429s (which Spotify never processed) are
+    retried and other failures raise SpotifyFetchError straight away.
+    """
+    max_retries = settings.SPOTIFY_MAX_RETRIES
+
+    for attempt in range(max_retries + 1):
+        spotify_rate_limiter.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except spotipy.SpotifyException as e:
+            if e.http_status == 429:
+                # The limiter blocks every worker until Retry-After has passed
+                spotify_rate_limiter.throttle(retry_after_seconds(e.headers))
+                delay = 0
+                record_spotify_call(func.__name__, 'rate_limited')
+            elif e.http_status >= 500:
+                delay = backoff_delay(attempt)
+                record_spotify_call(func.__name__, 'server_error')
+            else:
+                record_spotify_call(func.__name__, 'client_error')
+                raise SpotifyFetchError(f"Spotify call {func.__name__} failed: {e}", status=e.http_status) from e
+            error = e
+        except requests.exceptions.RequestException as e:
+            delay = backoff_delay(attempt)
+            error = e
+            record_spotify_call(func.__name__, 'connection_error')
+        else:
+            spotify_rate_limiter.recover()
+            record_spotify_call(func.__name__, 'ok')
+            return result
+
+        logger.warning(f"Spotify call {func.__name__} failed (attempt {attempt + 1}/{max_retries + 1}): {error}")
+        if delay and not retry_errors:
+            raise SpotifyFetchError(f"Spotify call {func.__name__} failed: {error}") from error
+        if attempt < max_retries:
+            record_spotify_retry(func.__name__)
+            if delay:
+                time.sleep(delay)
+
+    raise SpotifyFetchError(f"Spotify call {func.__name__} failed after {max_retries + 1} attempts") from error
+
+
+def conditional_get(access_token, path, etag=None, **params):
+    """
+    GET against the Web API on the shared pool, sending If-None-Match when an
+    etag is known. Returns (data, etag), data is None on 304 Not Modified.
+    """
+    def conditional_request():
+        headers = {'Authorization': f'Bearer {access_token}'}
+        if etag:
+            headers['If-None-Match'] = etag
+        response = spotify_pool.session.get(settings.SPOTIFY_API_URL + path, params=params, headers=headers, timeout=10)
+        if response.status_code >= 400:
+            raise spotipy.SpotifyException(response.status_code, -1, f"{response.url}: {response.text}", headers=response.headers)
+        return response
+
+    response = call_spotify(conditional_request)
+    if response.status_code == 304:
+        return None, etag
+    return response.json(), response.headers.get('ETag')
+
+
+def fetch_artist_genres(sp, artist_ids, on_progress=None):
+    """
+    Fetches genres for the given artists in concurrent 50-artist batches.
+    Returns {artist_id: [genres]}, raises SpotifyFetchError if any batch fails.
+    on_progress(resolved, total) is called after each batch.
+    """
+    batches = [
+        artist_ids[i:i + ARTIST_BATCH_SIZE]
+        for i in range(0, len(artist_ids), ARTIST_BATCH_SIZE)
+    ]
+    if not batches:
+        return {}
+
+    def fetch_batch(batch):
+        artists = call_spotify(sp.artists, batch)['artists']
+        return {
+            artist['id']: artist.get('genres', [])
+            for artist in artists if artist
+        }
+
+    artist_genres = {}
+    workers = min(settings.SPOTIFY_MAX_WORKERS, len(batches))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for resolved, batch_genres in enumerate(executor.map(in_request_context(fetch_batch), batches), 1):
+            artist_genres.update(batch_genres)
+            if on_progress:
+                on_progress(min(resolved * ARTIST_BATCH_SIZE, len(artist_ids)), len(artist_ids))
+
+    return artist_genres
+
+
+def parse_track(item):
+    """
+    Turns a playlist item into a TrackRecord, skipping empty and artistless items
+    """
+    track = item.get('track')
+    if not track or not track.get('artists'):
+        return None
+
+    artist = track['artists'][0]
+    images = (track.get('album') or {}).get('images')
+    return TrackRecord(
+        name=track['name'],
+        artist_id=artist.get('id'),
+        artist=artist['name'],
+        uri=track['uri'],
+        image=images[0]['url'] if images else None,
+        artist_ids=tuple(a['id'] for a in track['artists'] if a.get('id')),
+        isrc=(track.get('external_ids') or {}).get('isrc'),
+    )
+
+
+def parse_playlist(playlist):
+    """
+    Keeps only the playlist fields the client shows, plus the snapshot_id
+    library sorts compare against (me/playlists has no fields filter)
+    """
+    if not playlist:
+        return None
+
+    return {
+        'id': playlist['id'],
+        'name': playlist['name'],
+        'track_count': playlist['tracks']['total'],
+        'image_url': playlist['images'][0]['url'] if playlist.get('images') else None,
+        'snapshot_id': playlist.get('snapshot_id'),
+    }
+
+
+def fetch_all_pages(func, *args, limit, parse_item=None, on_progress=None, first_page=None, **kwargs):
+    """
+    Fetches every item of a paged Spotify endpoint. The first page reports
+    `total`, the remaining offsets are then fetched concurrently and
+    reassembled in their original order. If given, parse_item converts each
+    raw item as its page arrives (returning None drops the item) and
+    on_progress(fetched, total) is called after each page. An already fetched
+    first_page can be passed in to skip requesting it again.
+    """
+    def parse_page(page):
+        if parse_item is None:
+            return page['items']
+        return [record for record in map(parse_item, page['items']) if record is not None]
+
+    if first_page is None:
+        first_page = call_spotify(func, *args, limit=limit, offset=0, **kwargs)
+    items = parse_page(first_page)
+
+    total = first_page.get('total') or 0
+    if on_progress:
+        on_progress(min(limit, total), total)
+
+    offsets = list(range(limit, total, limit))
+    if not offsets:
+        return items
+
+    def fetch_page(offset):
+        return parse_page(call_spotify(func, *args, limit=limit, offset=offset, **kwargs))
+
+    workers = min(settings.SPOTIFY_MAX_WORKERS, len(offsets))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for offset, page_items in zip(offsets, executor.map(in_request_context(fetch_page), offsets)):
+            items.extend(page_items)
+            if on_progress:
+                on_progress(min(offset + limit, total), total)
+
+    return items
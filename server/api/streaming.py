@@ -0,0 +1,77 @@
+import json
+
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+
+# NDJSON responses for ?stream=true. The first line is a header (version,
+# counts), then one object per line so clients can render as lines arrive
+# instead of waiting for, and holding, one large JSON document. Groupings
+# are loaded in columnar form up front and only expanded a chunk at a time.
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+# Tracks per line, large genres are split over several lines with the same genre
+GENRE_CHUNK_SIZE = 500
+
+
+def ndjson_line(data):
+    return json.dumps(data, separators=(',', ':')) + '\n'
+
+
+def genre_group_lines(sort_result, chunk_size=GENRE_CHUNK_SIZE, dedupe=False):
+    """
+    Lines for a stored grouping: a header (version, counts, undo state), then
+    {genre, tracks} lines in display order. Reads the database right away,
+    only the expansion to track dicts and encoding is deferred. With dedupe
+    duplicate tracks are left out and listed in the header.
+    """
+    duplicates = sort_result.duplicates() if dedupe else {}
+    groups = sort_result.as_columnar(duplicates)
+    header = {
+        'version': sort_result.version,
+        'genres': len(groups.genres),
+        'tracks': len(groups.names),
+        'can_undo': sort_result.can_undo,
+        'can_redo': sort_result.can_redo,
+    }
+    if dedupe:
+        header['duplicates'] = duplicates
+
+    def lines():
+        yield ndjson_line(header)
+        for genre, members in groups.genres.items():
+            for start in range(0, len(members), chunk_size):
+                tracks = [groups.track_info(track_id) for track_id in members[start:start + chunk_size]]
+                yield ndjson_line({'genre': genre, 'tracks': tracks})
+
+    return lines()
+
+
+def playlist_lines(playlists):
+    yield ndjson_line({'playlists': len(playlists)})
+    for playlist in playlists:
+        yield ndjson_line(playlist)
+
+
+def served_over_asgi(request):
+    """
+    Whether the request came through Django's ASGI handler, DRF requests included
+    """
+    return isinstance(getattr(request, '_request', request), ASGIRequest)
+
+
+async def _aiter(lines):
+    for line in lines:
+        yield line
+
+
+def ndjson_response(lines, asynchronous=False):
+    """
+    Streams the lines. Views served over ASGI, sync ones included, pass
+    asynchronous=True: Django's ASGI handler buffers plain iterators in full
+    before sending.
+    """
+    response = StreamingHttpResponse(_aiter(lines) if asynchronous else lines, content_type=NDJSON_CONTENT_TYPE)
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,75 @@
+import os
+from functools import lru_cache
+
+# Bundled micro-genre -> parent genre tree, see data/genre_taxonomy.tsv
+TAXONOMY_PATH = os.path.join(os.path.dirname(__file__), 'data', 'genre_taxonomy.tsv')
+# Unlisted genres whose guessed placement is remembered
+GUESS_CACHE_SIZE = 10000
+
+
+class GenreTaxonomy:
+    """
+    Index of genre -> path from its top-level genre, e.g. 'bedroom pop' ->
+    ('pop', 'indie pop', 'bedroom pop'). Paths are resolved once when the
+    file is loaded, so finding a genre's ancestor at any depth is a dict
+    lookup and a tuple index.
+    """
+    def __init__(self, parents):
+        self._paths = {}
+        for genre in parents:
+            self._paths[genre] = self._resolve(genre, parents)
+        # Kept apart from _paths, which only ever holds the listed genres
+        self._guess = lru_cache(maxsize=GUESS_CACHE_SIZE)(self._place)
+
+    @classmethod
+    def load(cls, path=TAXONOMY_PATH):
+        parents = {}
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line or line.startswith('#'):
+                    continue
+                genre, _, parent = line.partition('\t')
+                parents[genre] = parent or None
+        return cls(parents)
+
+    @staticmethod
+    def _resolve(genre, parents):
+        path = [genre]
+        while parents.get(path[-1]):
+            path.append(parents[path[-1]])
+        return tuple(reversed(path))
+
+    def __contains__(self, genre):
+        return genre in self._paths
+
+    def path(self, genre):
+        """
+        Path of a genre from its top-level genre. Spotify keeps inventing
+        genres, unlisted ones are placed under the longest listed genre
+        they end with ('seattle indie pop' -> indie pop), then under any
+        listed word in them.
+        """
+        path = self._paths.get(genre)
+        if path is not None:
+            return path
+        return self._guess(genre)
+
+    def _place(self, genre):
+        words = genre.split()
+        match = next(
+            (' '.join(words[i:]) for i in range(1, len(words)) if ' '.join(words[i:]) in self._paths),
+            next((word for word in words if word in self._paths), None),
+        )
+        return self._paths[match] + (genre,) if match else (genre,)
+
+    def ancestor(self, genre, depth):
+        """
+        The genre's ancestor at depth (1 is the top level), or the genre
+        itself if it sits higher than that
+        """
+        path = self.path(genre)
+        return path[min(depth, len(path)) - 1]
+
+
+genre_taxonomy = GenreTaxonomy.load()
@@ -1,3 +1,777 @@
-from django.test import TestCase
+import asyncio
+import gc
+import json
+import threading
+import time
+from concurrent.futures import Future
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.sessions.backends.db import SessionStore
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from spotipy import SpotifyException
+
+from benchmarks.fake_spotify import FakeLibrary, FakeSpotifyServer
+
+from .async_views import AsyncGetPlaylistsView, AsyncIsAuthenticatedView, AsyncSortPlaylistByGenreView
+from .classification import PrimaryGenreClassifier, TaxonomyGenreClassifier, WeightedGenreClassifier, get_classifier
+from .columnar import ColumnarGroups
+from .export import add_chunk
+from .concurrency import SingleFlight
+from .fingerprints import DuplicateIndex, normalize_isrc, normalize_title, title_key
+from .genre_cache import artist_genre_cache
+from .middleware import RequestMetricsMiddleware
+from .models import TRACK_ROW_FIELDS, SortJob, SortResult
+from .serializers import pack_sort_state, pack_track_rows, unpack_sort_state, unpack_track_rows
+from .spotify import RateLimiter, SpotifyClientPool, SpotifyFetchError, TrackRecord, spotify_rate_limiter
+from .taxonomy import GenreTaxonomy, genre_taxonomy
 
 # Create your tests here.
+
+
+def track(uri, artist='Artist', name=None, isrc='', image='https://i.scdn.co/image/abc'):
+    return {'uri': uri, 'name': name or uri, 'artist': artist, 'image': image, 'isrc': isrc}
+
+
+class FingerprintTests(SimpleTestCase):
+    def test_release_markers_are_stripped(self):
+        for name in (
+            'Song',
+            'Song - Remastered 2011',
+            'Song (Remastered)',
+            'Song - Single Version',
+            'Song (feat. Someone)',
+            'Song [feat. Someone] - 2009 Remaster',
+            'SONG',
+        ):
+            self.assertEqual(normalize_title(name), 'song', name)
+
+    def test_packaging_suffixes_are_stripped(self):
+        for name in (
+            'Song (2009 Remaster)',
+            'Song - 2011 Digital Remaster',
+            'Song - Single Version (Remastered)',
+            'Song - Album Version',
+            'Song (Deluxe Edition)',
+            'Song [Explicit]',
+            'Song (Clean)',
+            'Song - Mono / Remastered',
+        ):
+            self.assertEqual(normalize_title(name), 'song', name)
+
+    def test_other_recordings_keep_their_suffix(self):
+        names = [
+            'Song - Live Version',
+            'Song (Acoustic Version)',
+            'Song - Instrumental Version',
+            'Song (Demo Version)',
+            'Song - Extended Edit',
+            'Song - Live at Wembley, 2005 Remaster',
+            'Song (Radio Edit)',
+            'Song - Remix',
+        ]
+        keys = [title_key('Artist', name) for name in names]
+        self.assertNotIn(title_key('Artist', 'Song'), keys)
+        self.assertEqual(len(set(keys)), len(names))
+        self.assertEqual(normalize_title('Song - Live at Wembley, 2005 Remaster'), 'song live at wembley 2005 remaster')
+
+    def test_accents_and_punctuation_are_folded(self):
+        self.assertEqual(normalize_title('Café   del Mar!'), 'cafe del mar')
+
+    def test_title_key_matches_across_releases(self):
+        self.assertEqual(title_key('Artist', 'Song'), title_key('ARTIST', 'Song - Remastered 2011'))
+        self.assertNotEqual(title_key('Artist', 'Song'), title_key('Other Artist', 'Song'))
+        self.assertEqual(len(title_key('Artist', 'Song')), 16)
+
+    def test_normalize_isrc(self):
+        self.assertEqual(normalize_isrc('us-rc1-17-00001'), 'USRC11700001')
+        self.assertEqual(normalize_isrc(' USRC11700001 '), 'USRC11700001')
+        self.assertEqual(normalize_isrc('USRC117000011'), '')
+        self.assertEqual(normalize_isrc('not an isrc'), '')
+        self.assertEqual(normalize_isrc(None), '')
+
+    def test_duplicate_index_chains_isrc_and_title_matches(self):
+        index = DuplicateIndex()
+        self.assertIsNone(index.add('u1', 'USRC11700001', 'a'))
+        # Same ISRC, different title
+        self.assertEqual(index.add('u2', 'USRC11700001', 'b'), 'u1')
+        # Matches u2's title, so it is a duplicate of u1 as well
+        self.assertEqual(index.add('u3', '', 'b'), 'u1')
+        self.assertIsNone(index.add('u4', '', 'c'))
+        self.assertEqual(index.duplicates, {'u2': 'u1', 'u3': 'u1'})
+
+
+class ColumnarTests(SimpleTestCase):
+    rows = [
+        ('rock', 'spotify:track:1', 'One', 'A', 'https://i.scdn.co/image/x'),
+        ('rock', 'spotify:local:a:b:c:120', 'Local', 'B', None),
+        ('pop', 'spotify:track:2', 'Two', 'A', 'https://example.com/y.jpg'),
+        ('rock', 'spotify:track:3', 'Three', 'C', 'https://i.scdn.co/image/x'),
+    ]
+
+    def test_from_rows_expands_in_display_order(self):
+        groups = ColumnarGroups.from_rows(self.rows)
+        expanded = groups.expand()
+        self.assertEqual(list(expanded), ['rock', 'pop'])
+        self.assertEqual([info['uri'] for info in expanded['rock']], [self.rows[i][1] for i in (0, 1, 3)])
+        self.assertIsNone(expanded['rock'][1]['image'])
+        self.assertEqual(groups.artists, ['A', 'B', 'C'])
+
+    def test_sort_state_round_trip(self):
+        groups = ColumnarGroups.from_rows(self.rows)
+        unpacked = unpack_sort_state(pack_sort_state(groups))
+        self.assertEqual(unpacked.expand(), groups.expand())
+        self.assertEqual(unpacked.as_json(), groups.as_json())
+
+    def test_rows_round_trip(self):
+        self.assertEqual(list(ColumnarGroups.from_rows(self.rows).rows()), self.rows)
+
+    def test_empty_sort_state_round_trip(self):
+        self.assertEqual(unpack_sort_state(pack_sort_state(ColumnarGroups())).expand(), {})
+
+    def test_unpack_rejects_other_blobs(self):
+        for blob in (b'', b'nope', pack_track_rows([])):
+            with self.assertRaises(ValueError):
+                unpack_sort_state(blob)
+
+    def test_track_rows_round_trip(self):
+        rows = [['spotify:track:1', 'One', 'A', 'a', None, 'rock', 1, '', '', 'abc']]
+        self.assertEqual(unpack_track_rows(pack_track_rows(rows)), rows)
+        with self.assertRaises(ValueError):
+            unpack_track_rows(pack_sort_state(ColumnarGroups()))
+
+
+def record(uri, *artist_ids):
+    return TrackRecord(
+        name=uri, artist_id=artist_ids[0] if artist_ids else None, artist='Artist', uri=uri,
+        image=None, artist_ids=artist_ids, isrc='',
+    )
+
+
+def grouped_uris(genre_groups):
+    return {genre: [info['uri'] for info in tracks] for genre, tracks in genre_groups.items()}
+
+
+class ClassifierTests(SimpleTestCase):
+    artist_genres = {
+        'a': ['rock', 'grunge'],
+        'b': ['grunge'],
+        'c': ['bedroom pop'],
+        'd': ['jazz'],
+        'e': [],
+    }
+    tracks = [record('1', 'a'), record('2', 'b'), record('3', 'c'), record('4', 'd'), record('5', 'e'), record('6')]
+
+    def test_primary(self):
+        groups = PrimaryGenreClassifier().classify(self.tracks, self.artist_genres)
+        self.assertEqual(grouped_uris(groups), {
+            'rock': ['1'], 'grunge': ['2'], 'bedroom pop': ['3'], 'jazz': ['4'], 'unknown': ['5', '6'],
+        })
+
+    def test_taxonomy(self):
+        groups = TaxonomyGenreClassifier(depth=1).classify(self.tracks, self.artist_genres)
+        self.assertEqual(grouped_uris(groups)['rock'], ['1', '2'])
+        self.assertEqual(grouped_uris(groups)['unknown'], ['5', '6'])
+
+    def test_weighted_groups_related_genres(self):
+        groups = grouped_uris(WeightedGenreClassifier(max_groups=20).classify(self.tracks, self.artist_genres))
+        # grunge only appears with rock, so both tracks share a parent
+        self.assertIn(['1', '2'], groups.values())
+        self.assertEqual(groups['unknown'], ['5', '6'])
+        self.assertCountEqual([uri for uris in groups.values() for uri in uris], '123456')
+
+    def test_weighted_keeps_known_genres(self):
+        groups = WeightedGenreClassifier(max_groups=2).classify(self.tracks[:4], self.artist_genres, known_genres=['jazz'])
+        self.assertEqual(grouped_uris(groups)['jazz'], ['4'])
+
+    def test_weighted_respects_max_groups(self):
+        for max_groups in (1, 2, 3):
+            for tracks in (self.tracks, self.tracks[:4]):
+                groups = WeightedGenreClassifier(max_groups).classify(tracks, self.artist_genres)
+                # Below three groups one parent, 'other' and 'unknown' can still all be needed
+                self.assertLessEqual(len(groups), max(max_groups, 3), (max_groups, len(tracks)))
+                self.assertCountEqual([uri for uris in grouped_uris(groups).values() for uri in uris], [t.uri for t in tracks])
+
+    def test_weighted_without_genres(self):
+        classifier = WeightedGenreClassifier(max_groups=5)
+        self.assertEqual(grouped_uris(classifier.classify(self.tracks[4:], self.artist_genres)), {'unknown': ['5', '6']})
+        self.assertEqual(classifier.classify([], self.artist_genres), {})
+
+    def test_get_classifier(self):
+        self.assertEqual(get_classifier('taxonomy:2').name, 'taxonomy:2')
+        self.assertIsInstance(get_classifier('weighted'), WeightedGenreClassifier)
+        for name in ('taxonomy:0', 'taxonomy:x', 'nope'):
+            with self.assertRaises(ValueError):
+                get_classifier(name)
+
+
+class GenreTaxonomyTests(SimpleTestCase):
+    def setUp(self):
+        self.taxonomy = GenreTaxonomy({
+            'pop': None,
+            'indie pop': 'pop',
+            'bedroom pop': 'indie pop',
+            'rock': None,
+        })
+
+    def test_listed_genre_paths(self):
+        self.assertEqual(self.taxonomy.path('bedroom pop'), ('pop', 'indie pop', 'bedroom pop'))
+        self.assertEqual(self.taxonomy.ancestor('bedroom pop', 1), 'pop')
+        self.assertEqual(self.taxonomy.ancestor('bedroom pop', 2), 'indie pop')
+        # Genres higher than depth are their own ancestor
+        self.assertEqual(self.taxonomy.ancestor('pop', 3), 'pop')
+
+    def test_unlisted_genres_are_placed_by_suffix_then_word(self):
+        self.assertEqual(self.taxonomy.path('seattle indie pop'), ('pop', 'indie pop', 'seattle indie pop'))
+        self.assertEqual(self.taxonomy.path('rock nacional'), ('rock', 'rock nacional'))
+        self.assertEqual(self.taxonomy.path('zzz weird'), ('zzz weird',))
+
+    def test_guesses_are_not_listed(self):
+        self.taxonomy.path('seattle indie pop')
+        self.assertIn('indie pop', self.taxonomy)
+        self.assertNotIn('seattle indie pop', self.taxonomy)
+
+    def test_bundled_taxonomy(self):
+        self.assertIn('grunge', genre_taxonomy)
+        self.assertEqual(genre_taxonomy.ancestor('grunge', 1), 'rock')
+
+
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch('api.spotify.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_refill(self):
+        limiter = RateLimiter(rate=10, burst=2)
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertAlmostEqual(limiter.reserve(), 0.1)
+        self.now += 0.11
+        self.assertEqual(limiter.reserve(), 0)
+
+    def test_throttle_pauses_and_halves_the_rate(self):
+        limiter = RateLimiter(rate=10, burst=5, min_rate=4)
+        limiter.throttle(2)
+        self.assertEqual(limiter.rate, 5)
+        self.assertAlmostEqual(limiter.reserve(), 2)
+        self.now += 2.2
+        self.assertEqual(limiter.reserve(), 0)
+        limiter.throttle(0)
+        self.assertEqual(limiter.rate, 4)
+        for _ in range(100):
+            limiter.recover()
+        self.assertEqual(limiter.rate, 10)
+
+
+class SpotifyClientPoolTests(SimpleTestCase):
+    @mock.patch.dict('os.environ', {'SPOTIFY_CLIENT_ID': 'id', 'SPOTIFY_CLIENT_SECRET': 'secret'})
+    @mock.patch('api.spotify.REDIRECT_URI', 'http://testserver/api/callback/')
+    def test_collected_clients_leave_the_pool_open(self):
+        pool = SpotifyClientPool(pool_size=4)
+        with mock.patch.object(pool.session, 'close') as close:
+            for make in (lambda: pool.client('token'), pool.oauth, pool.app_client):
+                make()
+                gc.collect()
+        close.assert_not_called()
+
+
+class AddChunkTests(SimpleTestCase):
+    uris = ['spotify:track:1', 'spotify:track:2']
+
+    def setUp(self):
+        self.sp = mock.Mock()
+        self.sp.playlist_add_items.__name__ = 'playlist_add_items'
+        self.sp.playlist.__name__ = 'playlist'
+        for logger in ('api.export.logger', 'api.spotify.logger'):
+            patcher = mock.patch(logger)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def playlist_length(self, total):
+        self.sp.playlist.return_value = {'tracks': {'total': total}}
+
+    def test_rejected_requests_are_not_retried(self):
+        self.sp.playlist_add_items.side_effect = SpotifyException(403, -1, 'Forbidden')
+        with self.assertRaises(SpotifyFetchError):
+            add_chunk(self.sp, 'p', self.uris, 100)
+        self.assertEqual(self.sp.playlist_add_items.call_count, 1)
+        self.sp.playlist.assert_not_called()
+
+    def test_lost_response_is_not_resent(self):
+        self.sp.playlist_add_items.side_effect = SpotifyException(502, -1, 'Bad Gateway')
+        self.playlist_length(102)
+        add_chunk(self.sp, 'p', self.uris, 100)
+        self.assertEqual(self.sp.playlist_add_items.call_count, 1)
+
+    def test_failed_chunk_is_resent(self):
+        self.sp.playlist_add_items.side_effect = [SpotifyException(500, -1, 'Server Error'), {'snapshot_id': 's'}]
+        self.playlist_length(100)
+        add_chunk(self.sp, 'p', self.uris, 100)
+        self.assertEqual(self.sp.playlist_add_items.call_count, 2)
+
+    def test_unexpected_length_is_not_resent(self):
+        self.sp.playlist_add_items.side_effect = SpotifyException(500, -1, 'Server Error')
+        self.playlist_length(101)
+        with self.assertRaises(SpotifyFetchError):
+            add_chunk(self.sp, 'p', self.uris, 100)
+        self.assertEqual(self.sp.playlist_add_items.call_count, 1)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_concurrent_callers_share_one_call(self):
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'result'
+
+        leader = threading.Thread(target=lambda: results.append(flights.do('key', work)))
+        leader.start()
+        started.wait(5)
+        with mock.patch('api.concurrency.metrics') as metrics:
+            followers = [threading.Thread(target=lambda: results.append(flights.do('key', work))) for _ in range(3)]
+            for follower in followers:
+                follower.start()
+            # Every follower has joined once it counted itself as coalesced
+            deadline = time.monotonic() + 5
+            while metrics.inc.call_count < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 4)
+        self.assertEqual(flights.in_flight(), 0)
+
+    def test_errors_reach_every_caller_and_free_the_key(self):
+        flights = SingleFlight()
+
+        def fail():
+            raise RuntimeError('boom')
+
+        with self.assertRaises(RuntimeError):
+            flights.do('key', fail)
+        self.assertEqual(flights.do('key', lambda: 'again'), 'again')
+
+    def test_async_callers_share_one_call(self):
+        flights = SingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'result'
+
+        async def main():
+            return await asyncio.gather(*(flights.ado('key', work) for _ in range(4)))
+
+        self.assertEqual(asyncio.run(main()), ['result'] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.in_flight(), 0)
+
+
+class EditJournalTests(TestCase):
+    def setUp(self):
+        self.result = SortResult.store('session', 'playlist', {
+            'rock': [track('u1', artist='A'), track('u2', artist='B', name='Song', isrc='USRC11700001')],
+            'pop': [track('u3', artist='A'), track('u4', artist='B', name='Song - Remastered', isrc='USRC11700001')],
+        })
+
+    def genres(self):
+        return dict(self.result.tracks.values_list('uri', 'genre'))
+
+    def stored_rows(self):
+        return {row[0]: list(row) for row in self.result._track_rows()}
+
+    def test_move_undo_redo(self):
+        original = self.genres()
+        self.assertEqual(self.result.move_track('u1', 'pop'), ['u1'])
+        moved = self.genres()
+        self.assertEqual(moved['u1'], 'pop')
+
+        self.assertTrue(self.result.undo())
+        self.assertEqual(self.genres(), original)
+        self.assertTrue(self.result.can_redo)
+        self.assertTrue(self.result.redo())
+        self.assertEqual(self.genres(), moved)
+        self.assertFalse(self.result.can_redo)
+
+    def test_new_edit_ends_redo_history(self):
+        self.result.move_track('u1', 'pop')
+        self.result.undo()
+        self.result.move_artist_tracks('A', 'jazz')
+        self.assertFalse(self.result.can_redo)
+        self.assertEqual(self.result.edits.count(), 1)
+
+    def test_undo_brings_back_deduplicated_tracks(self):
+        combined, removed = self.result.combine_genres(['rock', 'pop'], 'mixed', dedupe=True)
+        self.assertEqual(removed, ['u4'])
+        self.assertEqual(set(self.genres().values()), {'mixed'})
+        self.result.undo()
+        self.assertEqual(self.genres(), {'u1': 'rock', 'u2': 'rock', 'u3': 'pop', 'u4': 'pop'})
+
+    def test_replay_matches_stored_rows(self):
+        self.result.move_track('u1', 'pop')
+        self.result.move_artist_tracks('B', 'jazz')
+        self.result.combine_genres(['pop'], 'mixed')
+        self.result.undo()
+        self.assertEqual(self.result.replay(), self.stored_rows())
+        self.assertEqual(len(next(iter(self.result.replay().values()))), len(TRACK_ROW_FIELDS))
+
+    def test_edits_carry_the_cached_sort_state(self):
+        # Real uris, the columnar form adds spotify:track: to bare ones
+        result = SortResult.store('session', 'uris', {
+            'rock': [track('spotify:track:1', artist='A'), track('spotify:track:2', artist='B', name='Song', isrc='USRC11700001')],
+            'pop': [track('spotify:track:3', artist='A'), track('spotify:track:4', artist='B', name='Song', isrc='USRC11700001')],
+            'folk': [track('spotify:local:a:b:c:1', artist='C')],
+        })
+        cache.clear()
+        result.as_columnar()
+        edits = (
+            lambda: result.move_track('spotify:track:1', 'pop'),
+            lambda: result.move_artist_tracks('B', 'jazz'),
+            lambda: result.combine_genres(['pop', 'jazz'], 'mixed', dedupe=True),
+        )
+        for edit in edits:
+            with self.captureOnCommitCallbacks(execute=True):
+                edit()
+            carried = cache.get(result._sort_state_key(result.version))
+            self.assertIsNotNone(carried)
+            cache.clear()
+            self.assertEqual(unpack_sort_state(carried).expand(), SortResult.objects.get(pk=result.pk).as_genre_groups())
+
+    @override_settings(SORT_UNDO_DEPTH=2, SORT_JOURNAL_COMPACT_EVERY=3)
+    def test_compaction_keeps_undo_depth(self):
+        for genre in ('a', 'b', 'c', 'd'):
+            self.result.move_track('u1', genre)
+        # Edits older than the last two are folded into the snapshot
+        self.assertEqual(self.result.journal_base, 2)
+        self.assertEqual(self.result.edits.count(), 2)
+        self.assertEqual(self.result.replay(), self.stored_rows())
+        self.assertTrue(self.result.undo())
+        self.assertTrue(self.result.undo())
+        self.assertEqual(self.genres()['u1'], 'b')
+        self.assertFalse(self.result.can_undo)
+        self.assertIsNone(self.result.undo())
+
+
+class InlineExecutor:
+    """
+    Runs sort jobs in the test's thread, inside its transaction
+    """
+    def submit(self, func, *args):
+        future = Future()
+        future.set_result(func(*args))
+        return future
+
+
+class SpotifyViewTestCase(TestCase):
+    """
+    Logged in test client against the fake Spotify server of the benchmarks
+    """
+    # Playlists are named after their size, the first one is the one sorted
+    playlist_sizes = (60,)
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.library = FakeLibrary(cls.playlist_sizes)
+        cls.playlist_size = cls.playlist_sizes[0]
+        cls.playlist_id = f'playlist{cls.playlist_size}'
+        cls.fake = FakeSpotifyServer(cls.library).start()
+        cls.addClassCleanup(cls.fake.stop)
+        cls.enterClassContext(override_settings(SPOTIFY_API_URL=cls.fake.url))
+        # Tests shouldn't wait on the shared bucket
+        spotify_rate_limiter.configure(10000, 10000)
+        cls.addClassCleanup(spotify_rate_limiter.configure, settings.SPOTIFY_RATE_LIMIT, settings.SPOTIFY_RATE_LIMIT_BURST)
+
+    def setUp(self):
+        cache.clear()
+        artist_genre_cache.clear()
+        self.fake.reset_counters()
+        session = self.client.session
+        session['spotify_token_info'] = {'access_token': 'test', 'refresh_token': 'test', 'expires_at': 2 ** 40}
+        session.save()
+        self.session_key = session.session_key
+        # The job pool's threads can't see the test's transaction
+        for name, value in (('sort_executor', InlineExecutor()), ('close_old_connections', lambda: None)):
+            patcher = mock.patch(f'api.jobs.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, path, data):
+        return self.client.post(path, json.dumps(data), content_type='application/json')
+
+    def sort(self, **params):
+        response = self.client.get(f'/api/sort-playlist/{self.playlist_id}/', params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def playlist_uris(self):
+        return [item['track']['uri'] for item in self.library.playlists[self.playlist_id]['tracks']]
+
+
+class SortViewTests(SpotifyViewTestCase):
+    def test_sort_groups_every_track(self):
+        data = self.sort()
+        uris = [track['uri'] for tracks in data['genre_groups'].values() for track in tracks]
+        self.assertCountEqual(uris, self.playlist_uris())
+        self.assertEqual(data['version'], 0)
+
+    def test_unchanged_playlist_is_not_fetched_again(self):
+        self.sort()
+        self.fake.reset_counters()
+        self.sort()
+        self.assertEqual(self.fake.counters()['calls'], {'playlist': 1})
+
+    def test_not_logged_in(self):
+        self.client.session.flush()
+        self.client.cookies.clear()
+        self.assertEqual(self.client.get(f'/api/sort-playlist/{self.playlist_id}/').status_code, 401)
+
+
+class EditViewTests(SpotifyViewTestCase):
+    def setUp(self):
+        super().setUp()
+        self.groups = self.sort()['genre_groups']
+        self.uri = self.playlist_uris()[0]
+
+    def test_delta_response(self):
+        response = self.post('/api/assign-genre/', {
+            'playlist_id': self.playlist_id, 'track_uri': self.uri, 'genre': 'mine', 'delta': True,
+        })
+        data = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((data['genre'], data['moved_uris']), ('mine', [self.uri]))
+        self.assertEqual((data['base_version'], data['version']), (0, 1))
+        self.assertNotIn('genre_groups', data)
+
+    def test_failed_cache_carry_keeps_the_edit(self):
+        # Caches version 0's sort state, which the edit then carries
+        self.client.get(f'/api/genre-groups/{self.playlist_id}/')
+        data = {'playlist_id': self.playlist_id, 'track_uri': self.uri, 'genre': 'mine', 'delta': True}
+        with mock.patch('api.models.pack_sort_state', side_effect=RuntimeError('cache down')), \
+                self.assertLogs('api.models', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+            response = self.post('/api/assign-genre/', data)
+        self.assertEqual(response.status_code, 200)
+        groups = self.client.get(f'/api/genre-groups/{self.playlist_id}/').json()['genre_groups']
+        self.assertEqual([track['uri'] for track in groups['mine']], [self.uri])
+
+    def test_genre_must_be_a_string(self):
+        for path, field, value in (('assign-genre', 'track_uri', self.uri), ('assign-genre-by-artist', 'artist_name', 'Artist 0')):
+            response = self.post(f'/api/{path}/', {'playlist_id': self.playlist_id, field: value, 'genre': ['x']})
+            self.assertEqual(response.status_code, 400, path)
+        # Nothing was written
+        self.assertEqual(self.post('/api/undo-edit/', {'playlist_id': self.playlist_id}).status_code, 409)
+
+    def test_full_response_and_undo(self):
+        data = self.post('/api/assign-genre/', {'playlist_id': self.playlist_id, 'track_uri': self.uri, 'genre': 'mine'}).json()
+        self.assertEqual([track['uri'] for track in data['genre_groups']['mine']], [self.uri])
+        self.assertTrue(data['can_undo'])
+
+        data = self.post('/api/undo-edit/', {'playlist_id': self.playlist_id}).json()
+        self.assertEqual(data['genre_groups'], self.groups)
+        self.assertEqual(self.post('/api/undo-edit/', {'playlist_id': self.playlist_id}).status_code, 409)
+
+    def test_combine_genres(self):
+        genres = list(self.groups)[:2]
+        data = self.post('/api/combine-genres/', {'playlist_id': self.playlist_id, 'genres': genres, 'delta': True}).json()
+        self.assertCountEqual(data['moved_uris'], [track['uri'] for genre in genres for track in self.groups[genre]])
+        groups = self.client.get(f'/api/genre-groups/{self.playlist_id}/').json()['genre_groups']
+        self.assertEqual(len(groups[data['genre']]), len(data['moved_uris']))
+
+    def test_stream_matches_groups(self):
+        response = self.client.get(f'/api/genre-groups/{self.playlist_id}/?stream=true')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual({line['genre']: line['tracks'] for line in lines[1:]}, self.groups)
+
+    async def test_stream_starts_before_it_is_encoded_under_asgi(self):
+        self.async_client.cookies = self.client.cookies
+        with mock.patch.object(ColumnarGroups, 'track_info', autospec=True, side_effect=ColumnarGroups.track_info) as track_info:
+            response = await self.async_client.get(f'/api/genre-groups/{self.playlist_id}/?stream=true')
+            lines = aiter(response.streaming_content)
+            # ASGI would buffer a sync iterator whole before sending the header
+            header = json.loads(await anext(lines))
+            self.assertEqual(track_info.call_count, 0)
+            rest = [json.loads(line) async for line in lines]
+        self.assertEqual(header['tracks'], self.playlist_size)
+        self.assertEqual({line['genre']: line['tracks'] for line in rest}, self.groups)
+
+
+class LibrarySortViewTests(SpotifyViewTestCase):
+    playlist_sizes = (60, 250)
+
+    def sort_library(self):
+        response = self.post('/api/sort-library/', {'playlist_ids': ['playlist60', 'playlist250']})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_snapshots_come_from_the_listing(self):
+        data = self.sort_library()
+        self.assertEqual(sum(map(len, data['genre_groups'].values())), len(data['sources']))
+        # One listing page has both snapshots, then one first page per playlist plus two more for the 250
+        self.assertEqual(self.fake.counters()['calls'], {'my_playlists': 1, 'playlist_tracks': 4, 'artists': mock.ANY})
+
+        self.fake.reset_counters()
+        self.assertEqual(self.sort_library()['version'], data['version'])
+        self.assertEqual(self.fake.counters()['calls'], {'my_playlists': 1})
+
+    def test_unlisted_playlists_are_asked_directly(self):
+        with self.assertLogs('spotipy', 'ERROR'), self.assertLogs('api.sorting', 'ERROR'):
+            response = self.post('/api/sort-library/', {'playlist_ids': ['playlist60', 'nope']})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.fake.counters()['calls']['playlist'], 1)
+
+
+class SortJobViewTests(SpotifyViewTestCase):
+    def test_job_result_and_events(self):
+        response = self.post('/api/sort-jobs/', {'playlist_id': self.playlist_id})
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()['job_id']
+
+        data = self.client.get(f'/api/sort-jobs/{job_id}/').json()
+        self.assertEqual(data['status'], SortJob.DONE)
+        self.assertEqual(sum(map(len, data['genre_groups'].values())), self.playlist_size)
+
+        response = self.client.get(f'/api/sort-jobs/{job_id}/events/')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = [json.loads(line[len('data: '):]) for line in b''.join(response.streaming_content).decode().split('\n\n') if line]
+        self.assertEqual(events[-1]['status'], SortJob.DONE)
+
+    @override_settings(SORT_JOB_STREAM_SECONDS=2)
+    async def test_events_arrive_as_they_happen_under_asgi(self):
+        job = await SortJob.objects.acreate(session_key=self.session_key, playlist_id=self.playlist_id)
+        self.async_client.cookies = self.client.cookies
+        with mock.patch('api.views.SortJobEventsView.poll_interval', 0.01):
+            response = await self.async_client.get(f'/api/sort-jobs/{job.id}/events/')
+            events = aiter(response.streaming_content)
+            # A sync generator would only be drained once the stream ended
+            first = json.loads((await anext(events)).decode()[len('data: '):])
+            self.assertEqual(first['status'], SortJob.QUEUED)
+            await SortJob.objects.filter(pk=job.pk).aupdate(status=SortJob.DONE)
+            rest = [json.loads(event.decode()[len('data: '):]) async for event in events]
+        self.assertEqual([event['status'] for event in rest], [SortJob.DONE])
+
+    def test_other_sessions_jobs_are_hidden(self):
+        job = SortJob.objects.create(session_key='someone else', playlist_id=self.playlist_id)
+        self.assertEqual(self.client.get(f'/api/sort-jobs/{job.id}/').status_code, 404)
+        self.assertEqual(self.client.get(f'/api/sort-jobs/{job.id}/events/').status_code, 404)
+
+
+class ExportViewTests(SpotifyViewTestCase):
+    def test_export_keeps_the_grouping_order(self):
+        groups = self.sort()['genre_groups']
+        genre = max(groups, key=lambda genre: len(groups[genre]))
+        data = self.post('/api/create-playlist/', {'playlist_id': self.playlist_id, 'genre': genre}).json()
+        self.assertTrue(data['success'])
+        self.assertEqual(self.library.created[data['playlist_id']], [track['uri'] for track in groups[genre]])
+
+    def test_export_several_genres(self):
+        groups = self.sort()['genre_groups']
+        data = self.post('/api/create-playlists/', {'playlist_id': self.playlist_id, 'genres': [*groups, 'nope']}).json()
+        self.assertFalse(data['success'])
+        self.assertEqual([result['genre'] for result in data['results']], [*groups, 'nope'])
+        self.assertEqual(sum(result.get('track_count', 0) for result in data['results']), self.playlist_size)
+
+
+class PlaylistsViewTests(SpotifyViewTestCase):
+    def playlist_names(self):
+        return [playlist['name'] for playlist in self.client.get('/api/playlists/').json()['playlists']]
+
+    def test_listing_is_cached_then_revalidated(self):
+        names = self.playlist_names()
+        self.assertIn(self.playlist_id, names)
+        pages = self.fake.counters()['calls']['my_playlists']
+
+        self.fake.reset_counters()
+        self.assertEqual(self.playlist_names(), names)
+        self.assertEqual(self.fake.counters()['api_calls'], 0)
+
+        # Past the TTL every page is revalidated, unchanged pages come back as empty 304s
+        with mock.patch('api.user_cache.time.time', return_value=time.time() + settings.SPOTIFY_USER_CACHE_TTL + 1):
+            self.assertEqual(self.playlist_names(), names)
+        counters = self.fake.counters()
+        self.assertEqual(counters['calls']['my_playlists'], pages)
+        self.assertEqual(counters['bytes_sent'], 0)
+
+    def test_export_invalidates_the_listing(self):
+        self.playlist_names()
+        groups = self.sort()['genre_groups']
+        genre = next(iter(groups))
+        data = self.post('/api/create-playlist/', {'playlist_id': self.playlist_id, 'genre': genre}).json()
+        self.assertIn(data['playlist_name'], self.playlist_names())
+
+
+class MetricsViewTests(SpotifyViewTestCase):
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token_is_required(self):
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 401)
+        response = self.client.get('/api/metrics/', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'sort_jobs_queued 0', response.content)
+
+    @override_settings(METRICS_TOKEN=None, DEBUG=False)
+    def test_hidden_without_a_token(self):
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 404)
+
+    @override_settings(METRICS_TOKEN=None, DEBUG=True)
+    def test_open_without_a_token_in_debug(self):
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 200)
+
+    def test_session_size_is_only_measured_when_saved(self):
+        def server_timing(use_session):
+            def view(request):
+                use_session(request.session)
+                return HttpResponse()
+
+            request = RequestFactory().get('/')
+            request.session = SessionStore(self.session_key)
+            return RequestMetricsMiddleware(view)(request)['Server-Timing']
+
+        self.assertNotIn('session;', server_timing(lambda session: session.get('spotify_token_info')))
+        self.assertIn('session;', server_timing(lambda session: session.update({'seen': True})))
+
+
+class AsyncViewTests(SpotifyViewTestCase):
+    def setUp(self):
+        super().setUp()
+        # Every Spotify call has to go through the httpx client, not a thread running spotipy/requests
+        for target in ('api.user_cache.conditional_get', 'api.sorting.fetch_artist_genres'):
+            patcher = mock.patch(target, side_effect=AssertionError(f'{target} called'))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def get(self, view, path, **kwargs):
+        request = AsyncRequestFactory().get(path)
+        request.session = SessionStore(self.session_key)
+        response = await view.as_view()(request, **kwargs)
+        self.assertEqual(response.status_code, 200, response.content)
+        return json.loads(response.content)
+
+    async def test_profile_and_playlists(self):
+        data = await self.get(AsyncIsAuthenticatedView, '/api/is-authenticated/')
+        self.assertTrue(data['status'])
+        data = await self.get(AsyncGetPlaylistsView, '/api/playlists/')
+        self.assertIn(self.playlist_id, [playlist['name'] for playlist in data['playlists']])
+
+        # Revalidated pages come back as 304s through the async client too
+        self.fake.reset_counters()
+        with mock.patch('api.user_cache.time.time', return_value=time.time() + settings.SPOTIFY_USER_CACHE_TTL + 1):
+            self.assertEqual(await self.get(AsyncGetPlaylistsView, '/api/playlists/'), data)
+        self.assertEqual(self.fake.counters()['bytes_sent'], 0)
+
+    async def test_sort(self):
+        data = await self.get(AsyncSortPlaylistByGenreView, '/', playlist_id=self.playlist_id)
+        uris = [track['uri'] for tracks in data['genre_groups'].values() for track in tracks]
+        self.assertCountEqual(uris, self.playlist_uris())
+        self.assertGreater(self.fake.counters()['calls']['artists'], 0)
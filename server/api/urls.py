@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from .views import (
     SpotifyCallbackView,
@@ -5,20 +6,50 @@ from .views import (
     IsAuthenticatedView,
     GetPlaylistsView,
     SortPlaylistByGenreView,
+    SortLibraryView,
+    SortLibraryJobCreateView,
+    SortJobCreateView,
+    SortJobView,
+    SortJobEventsView,
+    GetGenreGroupsView,
     CreateGenrePlaylistView,
+    CreateGenrePlaylistsView,
     AssignGenreToTrackView,
     CombineGenresView,
     AssignGenreByArtistView,
+    UndoGenreEditView,
+    RedoGenreEditView,
+    MetricsView,
 )
 
+# Under ASGI the Spotify-bound views can run as async handlers sharing one
+# connection pool, WSGI deployments keep the sync APIViews
+if settings.SPOTIFY_ASYNC_VIEWS:
+    from .async_views import (
+        AsyncSpotifyLoginView as SpotifyLoginView,
+        AsyncIsAuthenticatedView as IsAuthenticatedView,
+        AsyncGetPlaylistsView as GetPlaylistsView,
+        AsyncSortPlaylistByGenreView as SortPlaylistByGenreView,
+    )
+
 urlpatterns = [
     path('login/', SpotifyLoginView.as_view(), name='spotify-login'),
     path('callback/', SpotifyCallbackView.as_view(), name='spotify-callback'),
     path('is-authenticated/', IsAuthenticatedView.as_view(), name='is-authenticated'),
     path('playlists/', GetPlaylistsView.as_view(), name='get-playlists'),
     path('sort-playlist/<str:playlist_id>/', SortPlaylistByGenreView.as_view(), name='sort-playlist'),
+    path('sort-library/', SortLibraryView.as_view(), name='sort-library'),
+    path('library-sort-jobs/', SortLibraryJobCreateView.as_view(), name='library-sort-jobs'),
+    path('sort-jobs/', SortJobCreateView.as_view(), name='sort-jobs'),
+    path('sort-jobs/<uuid:job_id>/', SortJobView.as_view(), name='sort-job'),
+    path('sort-jobs/<uuid:job_id>/events/', SortJobEventsView.as_view(), name='sort-job-events'),
+    path('genre-groups/<str:playlist_id>/', GetGenreGroupsView.as_view(), name='genre-groups'),
     path('create-playlist/', CreateGenrePlaylistView.as_view(), name='create-genre-playlist'),
+    path('create-playlists/', CreateGenrePlaylistsView.as_view(), name='create-genre-playlists'),
     path('assign-genre/', AssignGenreToTrackView.as_view(), name='assign-genre'),
     path('combine-genres/', CombineGenresView.as_view(), name='combine_genres'),
-    path('assign-genre-by-artist/', AssignGenreByArtistView.as_view(), name='assign-genre-by-artist')
+    path('assign-genre-by-artist/', AssignGenreByArtistView.as_view(), name='assign-genre-by-artist'),
+    path('undo-edit/', UndoGenreEditView.as_view(), name='undo-edit'),
+    path('redo-edit/', RedoGenreEditView.as_view(), name='redo-edit'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
\ No newline at end of file
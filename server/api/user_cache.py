@@ -0,0 +1,174 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import async_spotify
+from .metrics import in_request_context
+from .spotify import conditional_get, parse_playlist
+
+# Per-user cache of the current_user profile and the playlist listing. Entries
+# are served as is for a short TTL, after that they are revalidated with a
+# single If-None-Match request and only refetched if Spotify reports a change.
+# The a-prefixed functions are the async views' counterparts, they share the
+# cache entries but revalidate through the httpx client.
+
+# me/playlists allows up to 50 per page
+PLAYLIST_PAGE_SIZE = 50
+
+
+def _cache_key(session_key, name):
+    return f'spotify-user:{session_key}:{name}'
+
+
+def _fresh(entry):
+    return time.time() - entry['fetched_at'] < settings.SPOTIFY_USER_CACHE_TTL
+
+
+def _entry(data, etag):
+    return {'data': data, 'etag': etag, 'fetched_at': time.time()}
+
+
+def _store(session_key, name, data, etag):
+    # Kept well past the TTL so stale entries can still be revalidated
+    cache.set(_cache_key(session_key, name), _entry(data, etag), timeout=settings.SPOTIFY_USER_CACHE_TTL * 60)
+
+
+async def _astore(session_key, name, data, etag):
+    await cache.aset(_cache_key(session_key, name), _entry(data, etag), timeout=settings.SPOTIFY_USER_CACHE_TTL * 60)
+
+
+def _parse_page(page):
+    return [playlist for playlist in map(parse_playlist, page['items']) if playlist is not None]
+
+
+def _flatten(pages):
+    return [playlist for page in pages for playlist in page]
+
+
+def _revalidated_total(entry, first_page):
+    """
+    (total, cached pages, etags) to revalidate against, the cached pages are
+    dropped if the total changed
+    """
+    if not entry:
+        return first_page.get('total') or 0, [], []
+    total = entry['data']['total'] if first_page is None else first_page.get('total') or 0
+    if total != entry['data']['total']:
+        return total, [], []
+    return total, entry['data']['pages'], entry['etag']
+
+
+def _merge_pages(total, cached_pages, responses):
+    pages = []
+    etags = []
+    for index, (page, etag) in enumerate(responses):
+        # None is 304 Not Modified, only possible for pages we have cached
+        pages.append(cached_pages[index] if page is None else _parse_page(page))
+        etags.append(etag)
+    return {'total': total, 'pages': pages}, etags
+
+
+def get_profile(session_key, access_token):
+    """
+    The current user's Spotify profile
+    """
+    entry = cache.get(_cache_key(session_key, 'profile'))
+    if entry and _fresh(entry):
+        return entry['data']
+
+    data, etag = conditional_get(access_token, 'me', etag=entry['etag'] if entry else None)
+    if data is None:
+        data = entry['data']
+    _store(session_key, 'profile', data, etag)
+    return data
+
+
+def get_playlists(session_key, access_token):
+    """
+    The current user's playlists, reduced by parse_playlist. Every page is
+    revalidated with its own ETag, unchanged pages are reused and changed
+    ones parsed again. If the total changed, entries have shifted between
+    pages, so every page is fetched again.
+    """
+    entry = cache.get(_cache_key(session_key, 'playlists'))
+    if entry and _fresh(entry):
+        return _flatten(entry['data']['pages'])
+
+    etags = entry['etag'] if entry else []
+    first_page, first_etag = conditional_get(
+        access_token, 'me/playlists', etag=etags[0] if etags else None, limit=PLAYLIST_PAGE_SIZE, offset=0
+    )
+    total, cached_pages, etags = _revalidated_total(entry, first_page)
+
+    def fetch_page(index):
+        return conditional_get(
+            access_token,
+            'me/playlists',
+            etag=etags[index] if index < len(etags) else None,
+            limit=PLAYLIST_PAGE_SIZE,
+            offset=index * PLAYLIST_PAGE_SIZE,
+        )
+
+    indices = range(1, -(-total // PLAYLIST_PAGE_SIZE))
+    responses = [(first_page, first_etag)]
+    if indices:
+        workers = min(settings.SPOTIFY_MAX_WORKERS, len(indices))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            responses.extend(executor.map(in_request_context(fetch_page), indices))
+
+    data, new_etags = _merge_pages(total, cached_pages, responses)
+    _store(session_key, 'playlists', data, new_etags)
+    return _flatten(data['pages'])
+
+
+async def aget_profile(session_key, access_token):
+    entry = await cache.aget(_cache_key(session_key, 'profile'))
+    if entry and _fresh(entry):
+        return entry['data']
+
+    data, etag = await async_spotify.conditional_get(access_token, 'me', etag=entry['etag'] if entry else None)
+    if data is None:
+        data = entry['data']
+    await _astore(session_key, 'profile', data, etag)
+    return data
+
+
+async def aget_playlists(session_key, access_token):
+    entry = await cache.aget(_cache_key(session_key, 'playlists'))
+    if entry and _fresh(entry):
+        return _flatten(entry['data']['pages'])
+
+    etags = entry['etag'] if entry else []
+    first_page, first_etag = await async_spotify.conditional_get(
+        access_token, 'me/playlists', etag=etags[0] if etags else None, limit=PLAYLIST_PAGE_SIZE, offset=0
+    )
+    total, cached_pages, etags = _revalidated_total(entry, first_page)
+    semaphore = asyncio.Semaphore(settings.SPOTIFY_MAX_WORKERS)
+
+    async def fetch_page(index):
+        async with semaphore:
+            return await async_spotify.conditional_get(
+                access_token,
+                'me/playlists',
+                etag=etags[index] if index < len(etags) else None,
+                limit=PLAYLIST_PAGE_SIZE,
+                offset=index * PLAYLIST_PAGE_SIZE,
+            )
+
+    indices = range(1, -(-total // PLAYLIST_PAGE_SIZE))
+    responses = [(first_page, first_etag), *await asyncio.gather(*map(fetch_page, indices))]
+
+    data, new_etags = _merge_pages(total, cached_pages, responses)
+    await _astore(session_key, 'playlists', data, new_etags)
+    return _flatten(data['pages'])
+
+
+def invalidate_playlists(session_key):
+    cache.delete(_cache_key(session_key, 'playlists'))
+
+
+def invalidate_user(session_key):
+    cache.delete_many([_cache_key(session_key, 'profile'), _cache_key(session_key, 'playlists')])
@@ -1,36 +1,139 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from django.shortcuts import redirect
-from spotipy.oauth2 import SpotifyOAuth
-import spotipy
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views import View
+from asgiref.sync import sync_to_async
+import asyncio
 import os
+import json
 import time
-from collections import defaultdict
+import logging
+from .classification import get_classifier
+from .concurrency import TooManyInFlight, sort_flights, user_limiter
+from .export import export_genre, export_genres
+from .genre_cache import artist_genre_cache
+from .jobs import enqueue_library_sort_job, enqueue_sort_job, queued_jobs
+from .metrics import metrics
+from .models import SortJob, SortResult
+from .sorting import library_id, sort_library, sort_playlist
+from .spotify import SpotifyFetchError, spotify_pool, spotify_rate_limiter
+from .streaming import genre_group_lines, ndjson_response, playlist_lines, served_over_asgi
+from .user_cache import get_playlists, get_profile, invalidate_playlists, invalidate_user
 
-SCOPE = "playlist-read-private playlist-modify-public playlist-modify-private"
+logger = logging.getLogger(__name__)
 
-REDIRECT_URI = os.environ.get('REDIRECT_URI')
 CLIENT_URL = os.environ.get('CLIENT_URL')
 
-def get_spotify_oauth(token_info=None):
-    return SpotifyOAuth(
-        client_id=os.environ.get('SPOTIFY_CLIENT_ID'),
-        client_secret=os.environ.get('SPOTIFY_CLIENT_SECRET'),
-        redirect_uri=REDIRECT_URI,
-        scope=SCOPE,
-        cache_handler=spotipy.MemoryCacheHandler(token_info=token_info)
-    )
+def get_session_key(request):
+    # Sort results are keyed by session, so make sure the session has a key
+    if not request.session.session_key:
+        request.session.save()
+    return request.session.session_key
+
+def limited(session_key, flight_key, func):
+    """
+    Runs func as one of the user's Spotify-heavy operations. Identical
+    requests in flight at the same time (same flight_key) share one run and
+    its result. Raises TooManyInFlight if the user is at USER_MAX_IN_FLIGHT.
+    """
+    def run():
+        with user_limiter.slot(session_key):
+            return func()
+    return sort_flights.do(flight_key, run)
+
+def too_many_in_flight(e):
+    return Response({'error': str(e)}, status=429, headers={'Retry-After': '1'})
+
+def wants_columnar(request):
+    return request.GET.get('columnar', 'false').lower() == 'true'
+
+def wants_stream(request):
+    # ?stream=true answers with NDJSON lines instead of one JSON document
+    return request.GET.get('stream', 'false').lower() == 'true'
+
+def wants_dedupe(request):
+    # ?dedupe=true leaves out tracks that duplicate an earlier one, see fingerprints.py
+    return request.GET.get('dedupe', 'false').lower() == 'true'
+
+def genre_groups_response(request, sort_result):
+    if wants_stream(request):
+        lines = genre_group_lines(sort_result, dedupe=wants_dedupe(request))
+        return ndjson_response(lines, asynchronous=served_over_asgi(request))
+    return Response(sort_result.groups_payload(columnar=wants_columnar(request), dedupe=wants_dedupe(request)))
+
+def library_playlist_ids(request, token_info):
+    """
+    (playlist ids, whole library) for a library sort. playlist_ids in the body
+    is a list, or "all" (the default) for every playlist in the user's library.
+    Raises ValueError for anything else.
+    """
+    playlist_ids = request.data.get('playlist_ids', 'all')
+    if playlist_ids == 'all':
+        playlists = get_playlists(get_session_key(request), token_info['access_token'])
+        return [playlist['id'] for playlist in playlists], True
+    if not isinstance(playlist_ids, list) or not all(isinstance(playlist_id, str) and playlist_id for playlist_id in playlist_ids):
+        raise ValueError('playlist_ids must be a list of playlist ids or "all"')
+    return playlist_ids, False
+
+def edit_response(request, sort_result, data, genre, moved_uris, removed_uris=()):
+    """
+    Response for the genre edit views. With `delta` set in the request only the
+    moved uris and their new genre (and any removed uris) are returned,
+    otherwise the full genre_groups. `base_version` lets delta clients check
+    they were patching the latest state.
+    """
+    data['version'] = sort_result.version
+    data['base_version'] = sort_result.version - 1 if moved_uris or removed_uris else sort_result.version
+    data['can_undo'] = sort_result.can_undo
+    data['can_redo'] = sort_result.can_redo
+    if request.data.get('delta'):
+        data['genre'] = genre
+        data['moved_uris'] = moved_uris
+        if removed_uris:
+            data['removed_uris'] = removed_uris
+    else:
+        data['genre_groups'] = sort_result.as_genre_groups()
+    return Response(data)
+
+def journal_step(request, undo):
+    # Undo or redo one journal entry. An undone edit can touch several genres,
+    # so the full grouping comes back rather than a delta
+    token_info = request.session.get('spotify_token_info', None)
+
+    if not token_info:
+        return Response({'error': 'Not authenticated'}, status=401)
+
+    playlist_id = request.data.get('playlist_id')
+    if not playlist_id:
+        return Response({'error': 'Missing playlist_id'}, status=400)
+
+    sort_result = SortResult.lookup(get_session_key(request), playlist_id)
+    if not sort_result:
+        return Response({'error': 'No sorted tracks found'}, status=404)
+
+    edit = sort_result.undo() if undo else sort_result.redo()
+    if edit is None:
+        return Response({'error': 'Nothing to undo' if undo else 'Nothing to redo'}, status=409)
+
+    data = {'success': True, 'message': f"{'Undid' if undo else 'Redid'} {edit.kind.replace('_', ' ')}"}
+    data.update(sort_result.groups_payload(columnar=wants_columnar(request)))
+    return Response(data)
 
 class SpotifyLoginView(APIView):
     def get(self, request, *args, **kwargs):
         # reset session to ensure new user data
+        if request.session.session_key:
+            SortResult.objects.filter(session_key=request.session.session_key).delete()
+            invalidate_user(request.session.session_key)
         request.session.flush()
-        auth_url = get_spotify_oauth().get_authorize_url()
+        auth_url = spotify_pool.oauth().get_authorize_url()
         return redirect(auth_url)
     
 class SpotifyCallbackView(APIView):
     def get(self, request, *args, **kwargs):
-        oauth = get_spotify_oauth()
+        oauth = spotify_pool.oauth()
         code = request.GET.get('code')
         if code:
             token_info = oauth.get_access_token(code, as_dict=True, check_cache=False)
@@ -42,19 +145,16 @@ class SpotifyCallbackView(APIView):
 
 class IsAuthenticatedView(APIView):
     def get(self, request, *args, **kwargs):
-        token_info = request.session.get('spotify_token_info', None)
-
-        if not token_info:
-            return Response({'status': False})
-        # Validate token
-        oauth = get_spotify_oauth(token_info)
-        token_info = oauth.validate_token(oauth.get_cached_token())
+        # Validate token, refreshing it if it is about to expire
+        token_info = spotify_pool.session_token(request.session)
 
         if token_info:
-            request.session['spotify_token_info'] = token_info
             # Get user's name and profile picture
-            sp = spotipy.Spotify(auth=token_info['access_token'])
-            user_info = sp.current_user()
+            try:
+                user_info = get_profile(get_session_key(request), token_info['access_token'])
+            except SpotifyFetchError as e:
+                logger.error(f"Error fetching current user: {e}")
+                return Response({'error': 'Failed to fetch user from Spotify'}, status=e.response_status)
             user_data = {
                 'name': user_info.get('display_name', 'User'),
                 'image_url': user_info['images'][0]['url'] if user_info.get('images') else None
@@ -65,124 +165,272 @@ class IsAuthenticatedView(APIView):
 
 class GetPlaylistsView(APIView):
     def get(self, request, *args, **kwargs):
-        # Get spotify token
-        token_info = request.session.get('spotify_token_info', None)
+        # Get spotify token, refreshed if needed
+        token_info = spotify_pool.session_token(request.session)
 
         # If token doesn't exist
         if not token_info:
             return Response({'error': 'Token expired'}, status=401)
-        # Spotify object with access token as parameter
-        sp = spotipy.Spotify(auth=token_info['access_token'])
-
-        playlists = []
-        results = sp.current_user_playlists(limit=50)
 
         # Adding all playlists into a list with id, name, track count, and image url all tracked
-        while results:
-            for playlist in results['items']:
-                playlists.append({
-                    'id': playlist['id'],
-                    'name': playlist['name'],
-                    'track_count': playlist['tracks']['total'],
-                    'image_url': playlist['images'][0]['url'] if playlist['images'] else None
-                })
-            
-            # WHAT IS THE POINT OF THIS ??
-            if results['next']:
-                results = sp.next(results)
-            else:
-                results = None
-        
+        try:
+            playlists = get_playlists(get_session_key(request), token_info['access_token'])
+        except SpotifyFetchError as e:
+            logger.error(f"Error fetching playlists: {e}")
+            return Response({'error': 'Failed to fetch playlists from Spotify'}, status=e.response_status)
+        
+        if wants_stream(request):
+            return ndjson_response(playlist_lines(playlists), asynchronous=served_over_asgi(request))
         return Response({'playlists': playlists})
 
 class SortPlaylistByGenreView(APIView):
     def get(self, request, playlist_id, *args, **kwargs):
-        # Get Spotify token
-        token_info = request.session.get('spotify_token_info', None)
+        # Spotify object bound to the session's token, refreshed if needed
+        sp = spotify_pool.client_for_session(request.session)
         
         # If no token, throw error
+        if not sp:
+            return Response({'error': 'Not authenticated'}, status=401)
+        
+        # Pass ?refresh=true to discard manual edits and sort from scratch
+        refresh = request.GET.get('refresh', 'false').lower() == 'true'
+        # ?classifier=weighted groups by all of the artists' genres instead of the first one
+        classifier = request.GET.get('classifier')
+        try:
+            classifier_name = get_classifier(classifier).name
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        
+        # Sorts (or incrementally updates) and stores the result server side for later use,
+        # a double click or re-render sending the same sort again joins the running one
+        session_key = get_session_key(request)
+        try:
+            sort_result = limited(
+                session_key,
+                ('sort', session_key, playlist_id, classifier_name, refresh),
+                lambda: sort_playlist(sp, session_key, playlist_id, refresh=refresh, classifier=classifier),
+            )
+        except TooManyInFlight as e:
+            return too_many_in_flight(e)
+        except SpotifyFetchError as e:
+            return Response({'error': str(e)}, status=e.response_status)
+        
+        return genre_groups_response(request, sort_result)
+
+class SortJobCreateView(APIView):
+    def post(self, request, *args, **kwargs):
+        """
+        Queue a playlist sort on the background worker pool and return its job id right away
+        """
+        # Refreshed up front so the job's token lasts for the whole sort
+        token_info = spotify_pool.session_token(request.session)
+        
         if not token_info:
             return Response({'error': 'Not authenticated'}, status=401)
         
-        sp = spotipy.Spotify(auth=token_info['access_token'])
-        
-        # Get all tracks from the playlist
-        tracks = []
-        results = sp.playlist_tracks(playlist_id)
-        
-        while results:
-            for item in results['items']:
-                if item['track'] and item['track']['artists']:
-                    tracks.append(item['track'])
-            
-            if results['next']:
-                results = sp.next(results)
-            else:
-                results = None
-
-        # Sort tracks by genre based on artist genres
-        genre_groups = defaultdict(list)
-        
-        # Get unique artist IDs to avoid duplicate API calls
-        artist_ids = list(set(track['artists'][0]['id'] for track in tracks if track['artists']))
-        # Fetch artists in batches (Spotify allows up to 50 artists per request)
-        artist_genres_map = {}
-        batch_size = 50
-        
-        for i in range(0, len(artist_ids), batch_size):
-            batch = artist_ids[i:i + batch_size]
-            try:
-                artists = sp.artists(batch)['artists']
-                for artist in artists:
-                    artist_genres_map[artist['id']] = artist.get('genres', [])
-
-                # Add a small delay to avoid rate limiting
-                time.sleep(0.1)
-            except Exception as e:
-                print(f"Error fetching artists batch: {e}")
-                continue
-        
-        # Now group tracks by genre
-        for track in tracks:
-            if not track['artists']:
-                continue
-            
-            artist_id = track['artists'][0]['id']
-            artist_genres = artist_genres_map.get(artist_id, [])
-            
-            track_info = {
-                'name': track['name'],
-                'artist': track['artists'][0]['name'],
-                'uri': track['uri'],
-                'image' : track['album']['images'][0]['url'] if track['album'].get('images') else None
-            }
+        playlist_id = request.data.get('playlist_id')
+        
+        if not playlist_id:
+            return Response({'error': 'Missing playlist_id'}, status=400)
+        
+        classifier = request.data.get('classifier')
+        try:
+            get_classifier(classifier)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        
+        job = enqueue_sort_job(
+            get_session_key(request),
+            playlist_id,
+            refresh=bool(request.data.get('refresh')),
+            classifier=classifier,
+        )
+        
+        return Response(job.as_progress(), status=202)
 
-            #If artist does not have a genre, add to unknown
-            if not artist_genres:
-                genre_groups['unknown'].append(track_info)
-            else:
-                #Add track to the first genre the artist belongs to
-                primary_genre = artist_genres[0]
-                genre_groups[primary_genre].append(track_info)
-                # for genre in artist_genres:
-                #     genre_groups[genre].append(track_info)
-            
-        # Convert defaultdict to regular dict for JSON serialization
-        genre_groups = dict(genre_groups)
+class SortLibraryView(APIView):
+    def post(self, request, *args, **kwargs):
+        """
+        Sort several playlists, or the whole library, into one grouping. Edit
+        and export it with the returned library_id as its playlist_id.
+        """
+        token_info = spotify_pool.session_token(request.session)
         
-        # Store the sorted tracks in session for later use
-        request.session[f'sorted_tracks_{playlist_id}'] = genre_groups
+        if not token_info:
+            return Response({'error': 'Not authenticated'}, status=401)
         
-        return Response({'genre_groups': genre_groups})
+        classifier = request.data.get('classifier')
+        try:
+            classifier_name = get_classifier(classifier).name
+            playlist_ids, whole_library = library_playlist_ids(request, token_info)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        except SpotifyFetchError as e:
+            logger.error(f"Error fetching playlists: {e}")
+            return Response({'error': 'Failed to fetch playlists from Spotify'}, status=e.response_status)
+        
+        if not playlist_ids:
+            return Response({'error': 'No playlists to sort'}, status=400)
+        
+        session_key = get_session_key(request)
+        refresh = bool(request.data.get('refresh'))
+        try:
+            sort_result = limited(
+                session_key,
+                ('sort', session_key, library_id(playlist_ids, whole_library), classifier_name, refresh),
+                lambda: sort_library(
+                    spotify_pool.client(token_info['access_token']),
+                    session_key,
+                    playlist_ids,
+                    whole_library=whole_library,
+                    refresh=refresh,
+                    classifier=classifier,
+                ),
+            )
+        except TooManyInFlight as e:
+            return too_many_in_flight(e)
+        except SpotifyFetchError as e:
+            return Response({'error': str(e)}, status=e.response_status)
+        
+        data = sort_result.groups_payload(columnar=wants_columnar(request), dedupe=wants_dedupe(request))
+        data['library_id'] = sort_result.playlist_id
+        data['playlist_ids'] = playlist_ids
+        return Response(data)
 
-class CreateGenrePlaylistView(APIView):
+class SortLibraryJobCreateView(APIView):
     def post(self, request, *args, **kwargs):
+        """
+        Queue a library sort as a background job, polled like any other sort job
+        """
+        token_info = spotify_pool.session_token(request.session)
+        
+        if not token_info:
+            return Response({'error': 'Not authenticated'}, status=401)
+        
+        classifier = request.data.get('classifier')
+        try:
+            get_classifier(classifier)
+            playlist_ids, whole_library = library_playlist_ids(request, token_info)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        except SpotifyFetchError as e:
+            logger.error(f"Error fetching playlists: {e}")
+            return Response({'error': 'Failed to fetch playlists from Spotify'}, status=e.response_status)
+        
+        if not playlist_ids:
+            return Response({'error': 'No playlists to sort'}, status=400)
+        
+        job = enqueue_library_sort_job(
+            get_session_key(request),
+            playlist_ids,
+            whole_library=whole_library,
+            refresh=bool(request.data.get('refresh')),
+            classifier=classifier,
+        )
+        
+        return Response(job.as_progress(), status=202)
+
+class SortJobView(APIView):
+    def get(self, request, job_id, *args, **kwargs):
+        """
+        Poll the progress of a sort job, includes the genre groups once it is done
+        """
+        job = SortJob.objects.filter(pk=job_id, session_key=get_session_key(request)).first()
+        
+        if not job:
+            return Response({'error': 'Job not found'}, status=404)
+        
+        if job.stale:
+            SortJob.fail_stale(pk=job.pk)
+            job.refresh_from_db()
+        
+        data = job.as_progress()
+        if job.status == SortJob.DONE:
+            sort_result = SortResult.lookup(job.session_key, job.playlist_id)
+            if sort_result:
+                data.update(sort_result.groups_payload(columnar=wants_columnar(request), dedupe=wants_dedupe(request)))
+        
+        return Response(data)
+
+class SortJobEventsView(View):
+    # Plain Django view, DRF's content negotiation rejects the text/event-stream Accept header
+    poll_interval = 0.5
+
+    def get(self, request, job_id, *args, **kwargs):
+        """
+        Stream the progress of a sort job as server-sent events until it finishes
+        """
+        session_key = get_session_key(request)
+        
+        if not SortJob.objects.filter(pk=job_id, session_key=session_key).exists():
+            return JsonResponse({'error': 'Job not found'}, status=404)
+        
+        def events():
+            last_progress = None
+            # Frees the worker after a while, EventSource reconnects on its own
+            deadline = time.monotonic() + settings.SORT_JOB_STREAM_SECONDS
+            while time.monotonic() < deadline:
+                job = SortJob.objects.get(pk=job_id)
+                if job.stale:
+                    SortJob.fail_stale(pk=job.pk)
+                    job.refresh_from_db()
+                progress = job.as_progress()
+                if progress != last_progress:
+                    yield f"data: {json.dumps(progress)}\n\n"
+                    last_progress = progress
+                if job.finished:
+                    return
+                time.sleep(self.poll_interval)
+        
+        async def async_events():
+            # Same loop for ASGI, which would drain a sync generator in one
+            # thread and only send the events once the job is done
+            last_progress = None
+            deadline = time.monotonic() + settings.SORT_JOB_STREAM_SECONDS
+            while time.monotonic() < deadline:
+                job = await SortJob.objects.aget(pk=job_id)
+                if job.stale:
+                    await sync_to_async(SortJob.fail_stale)(pk=job.pk)
+                    await job.arefresh_from_db()
+                progress = job.as_progress()
+                if progress != last_progress:
+                    yield f"data: {json.dumps(progress)}\n\n"
+                    last_progress = progress
+                if job.finished:
+                    return
+                await asyncio.sleep(self.poll_interval)
+        
+        stream = async_events() if served_over_asgi(request) else events()
+        response = StreamingHttpResponse(stream, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+class GetGenreGroupsView(APIView):
+    def get(self, request, playlist_id, *args, **kwargs):
+        """
+        Return the stored genre groups without re-sorting, used to resync stale clients
+        """
         token_info = request.session.get('spotify_token_info', None)
         
         if not token_info:
             return Response({'error': 'Not authenticated'}, status=401)
         
-        sp = spotipy.Spotify(auth=token_info['access_token'])
+        sort_result = SortResult.lookup(get_session_key(request), playlist_id)
+        
+        if not sort_result:
+            return Response({'error': 'No sorted tracks found'}, status=404)
+        
+        return genre_groups_response(request, sort_result)
+
+class CreateGenrePlaylistView(APIView):
+    def post(self, request, *args, **kwargs):
+        token_info = spotify_pool.session_token(request.session)
+        
+        if not token_info:
+            return Response({'error': 'Not authenticated'}, status=401)
+        
+        sp = spotify_pool.client(token_info['access_token'])
         
         playlist_id = request.data.get('playlist_id')
         genre = request.data.get('genre')
@@ -190,37 +438,109 @@ class CreateGenrePlaylistView(APIView):
         if not playlist_id or not genre:
             return Response({'error': 'Missing playlist_id or genre'}, status=400)
         
-        # Get the sorted tracks from session
-        sorted_tracks = request.session.get(f'sorted_tracks_{playlist_id}', {})
+        if not isinstance(genre, str):
+            return Response({'error': 'genre must be a string'}, status=400)
         
-        if genre not in sorted_tracks:
-            return Response({'error': 'Genre not found'}, status=404)
+        # Get the sorted tracks for this session
+        session_key = get_session_key(request)
+        sort_result = SortResult.lookup(session_key, playlist_id)
+        if sort_result and request.data.get('dedupe'):
+            # Leave out repeats of the same recording (single, album, compilation...)
+            track_uris = sort_result.uris_by_genre([genre], dedupe=True).get(genre, [])
+        else:
+            track_uris = sort_result.genre_uris(genre) if sort_result else []
         
-        tracks = sorted_tracks[genre]
-        track_uris = [track['uri'] for track in tracks]
+        if not track_uris:
+            return Response({'error': 'Genre not found'}, status=404)
         
         # Get current user
-        user = sp.current_user()
+        try:
+            user = get_profile(session_key, token_info['access_token'])
+        except SpotifyFetchError as e:
+            logger.error(f"Error fetching current user: {e}")
+            return Response({'error': 'Failed to fetch user from Spotify'}, status=e.response_status)
         user_id = user['id']
         
-        # Create new playlist
-        playlist_name = f"{genre.title()} Mix"
-        new_playlist = sp.user_playlist_create(
-            user_id,
-            playlist_name,
-            public=False,
-            description=f"Auto-generated playlist with {genre} tracks"
-        )
+        # A repeated click while the export runs gets the same playlist instead of a second one
+        try:
+            result = limited(
+                session_key,
+                ('export', session_key, playlist_id, genre, bool(request.data.get('dedupe'))),
+                lambda: export_genre(sp, user_id, genre, track_uris),
+            )
+        except TooManyInFlight as e:
+            return too_many_in_flight(e)
+        except SpotifyFetchError as e:
+            logger.error(f"Error exporting genre {genre}: {e}")
+            return Response({'error': 'Failed to create playlist on Spotify'}, status=e.response_status)
 
-        # Add tracks to the new playlist (Spotify limits to 100 tracks per request)
-        for i in range(0, len(track_uris), 100):
-            sp.playlist_add_items(new_playlist['id'], track_uris[i:i+100])
+        # The user's playlist listing now has a new entry
+        invalidate_playlists(session_key)
         
+        return Response({'success': True, **result})
+
+class CreateGenrePlaylistsView(APIView):
+    def post(self, request, *args, **kwargs):
+        """
+        Exports several genres in one request, genres is a list or "all". With
+        dedupe a recording is only exported once, in the first genre it appears in.
+        """
+        token_info = spotify_pool.session_token(request.session)
+
+        if not token_info:
+            return Response({'error': 'Not authenticated'}, status=401)
+
+        playlist_id = request.data.get('playlist_id')
+        genres = request.data.get('genres')
+
+        if not playlist_id or not (genres == 'all' or isinstance(genres, list) and genres):
+            return Response({'error': 'Missing playlist_id or genres'}, status=400)
+
+        if genres != 'all' and not all(isinstance(genre, str) and genre for genre in genres):
+            return Response({'error': 'genres must be a list of genre names or "all"'}, status=400)
+
+        session_key = get_session_key(request)
+        sort_result = SortResult.lookup(session_key, playlist_id)
+
+        if not sort_result:
+            return Response({'error': 'No sorted tracks found for this playlist'}, status=404)
+
+        dedupe = bool(request.data.get('dedupe'))
+        if genres == 'all':
+            genre_uris = sort_result.uris_by_genre(dedupe=dedupe)
+        else:
+            found = sort_result.uris_by_genre(genres, dedupe=dedupe)
+            # Keep the requested order, unknown genres are reported rather than failing the batch
+            genre_uris = {genre: found[genre] for genre in dict.fromkeys(genres) if genre in found}
+
+        try:
+            user = get_profile(session_key, token_info['access_token'])
+        except SpotifyFetchError as e:
+            logger.error(f"Error fetching current user: {e}")
+            return Response({'error': 'Failed to fetch user from Spotify'}, status=e.response_status)
+        sp = spotify_pool.client(token_info['access_token'])
+        try:
+            # Copied, coalesced requests get the same list back
+            results = list(limited(
+                session_key,
+                ('export', session_key, playlist_id, tuple(genres) if genres != 'all' else 'all', dedupe),
+                lambda: export_genres(sp, user['id'], genre_uris),
+            ))
+        except TooManyInFlight as e:
+            return too_many_in_flight(e)
+
+        if genres != 'all':
+            results.extend(
+                {'genre': genre, 'success': False, 'error': 'Genre not found'}
+                for genre in dict.fromkeys(genres) if genre not in genre_uris
+            )
+
+        if any(result.get('playlist_id') for result in results):
+            invalidate_playlists(session_key)
+
         return Response({
-            'success': True,
-            'playlist_name': playlist_name,
-            'playlist_id': new_playlist['id'],
-            'track_count': len(track_uris)
+            'success': all(result['success'] for result in results),
+            'results': results,
         })
 
 class AssignGenreToTrackView(APIView):
@@ -236,55 +556,29 @@ class AssignGenreToTrackView(APIView):
         playlist_id = request.data.get('playlist_id')
         track_uri = request.data.get('track_uri')
         new_genre = request.data.get('genre')
-        current_genre = request.data.get('current_genre')  # Add this
         
         if not all([playlist_id, track_uri, new_genre]):
             return Response({'error': 'Missing required fields'}, status=400)
         
-        # Get the sorted tracks from session
-        sorted_tracks = request.session.get(f'sorted_tracks_{playlist_id}', {})
+        if not isinstance(new_genre, str):
+            return Response({'error': 'genre must be a string'}, status=400)
         
-        if not sorted_tracks:
-            return Response({'error': 'No sorted tracks found'}, status=404)
+        # Get the sorted tracks for this session
+        sort_result = SortResult.lookup(get_session_key(request), playlist_id)
         
-        # Find and remove the track from its current genre
-        track_to_move = None
-        if current_genre and current_genre in sorted_tracks:
-            for i, track in enumerate(sorted_tracks[current_genre]):
-                if track['uri'] == track_uri:
-                    track_to_move = sorted_tracks[current_genre].pop(i)
-                    break
-        
-        # If not found in specified genre, search all genres
-        if not track_to_move:
-            for genre, tracks in sorted_tracks.items():
-                for i, track in enumerate(tracks):
-                    if track['uri'] == track_uri:
-                        track_to_move = tracks.pop(i)
-                        break
-                if track_to_move:
-                    break
-        
-        if not track_to_move:
-            return Response({'error': 'Track not found'}, status=404)
-        
-        # Add to new genre
-        if new_genre not in sorted_tracks:
-            sorted_tracks[new_genre] = []
+        if not sort_result:
+            return Response({'error': 'No sorted tracks found'}, status=404)
         
-        # Check for duplicates
-        if not any(track['uri'] == track_uri for track in sorted_tracks[new_genre]):
-            sorted_tracks[new_genre].append(track_to_move)
+        # Move the track row, a track only ever lives in one genre
+        moved_uris = sort_result.move_track(track_uri, new_genre)
         
-        # Update session
-        request.session[f'sorted_tracks_{playlist_id}'] = sorted_tracks
-        request.session.modified = True
+        if moved_uris is None:
+            return Response({'error': 'Track not found'}, status=404)
         
-        return Response({
+        return edit_response(request, sort_result, {
             'success': True,
             'message': f'Track moved to {new_genre}',
-            'genre_groups': sorted_tracks
-        })
+        }, new_genre, moved_uris)
     
 class CombineGenresView(APIView):
     def post(self, request, *args, **kwargs):
@@ -305,47 +599,30 @@ class CombineGenresView(APIView):
         if len(genres_to_combine) < 2:
             return Response({'error': 'Need at least 2 genres to combine'}, status=400)
         
-        # Get stored genre data from session
-        session_key = f'sorted_tracks_{playlist_id}'
-        sorted_tracks = request.session.get(session_key, {})
+        # Get stored genre data for this session
+        sort_result = SortResult.lookup(get_session_key(request), playlist_id)
         
-        if not sorted_tracks:
+        if not sort_result:
             return Response({'error': 'No genre data found'}, status=404)
         
-        # Combine tracks from selected genres
-        seen_uris = set()
-        combined_tracks = []
-
-        for genre in genres_to_combine:
-            if genre in sorted_tracks:
-                for track in sorted_tracks[genre]:
-                    # Only add track if we haven't seen this URI before
-                    if track['uri'] not in seen_uris:
-                        combined_tracks.append(track)
-                        seen_uris.add(track['uri'])
-                # Remove the old genre
-                del sorted_tracks[genre]
-        
-        if not combined_tracks:
-            return Response({'error': 'No tracks found in selected genres'}, status=404)
-        
         # Create new combined genre name
         combined_genre_name = ' + '.join(sorted(genres_to_combine))
         
-        # Add combined genre with all tracks
-        sorted_tracks[combined_genre_name] = combined_tracks
+        # Relabel the tracks of the selected genres, uris are already unique per sort.
+        # With dedupe, other releases of the same recording are dropped as well
+        combined_uris, removed_uris = sort_result.combine_genres(
+            genres_to_combine, combined_genre_name, dedupe=bool(request.data.get('dedupe'))
+        )
         
-        # Update session
-        request.session[session_key] = sorted_tracks
-        request.session.modified = True
+        if not combined_uris:
+            return Response({'error': 'No tracks found in selected genres'}, status=404)
         
-        return Response({
+        return edit_response(request, sort_result, {
             'success': True,
-            'genre_groups': sorted_tracks,
             'combined_genre_name': combined_genre_name,
-            'total_tracks': len(combined_tracks),
-            'duplicates_removed': sum(len(sorted_tracks.get(g, [])) for g in genres_to_combine) - len(combined_tracks)
-        })
+            'total_tracks': len(combined_uris),
+            'duplicates_removed': len(removed_uris)
+        }, combined_genre_name, combined_uris, removed_uris)
 
 class AssignGenreByArtistView(APIView):
     def post(self, request, *args, **kwargs):
@@ -365,58 +642,72 @@ class AssignGenreByArtistView(APIView):
         if not all([playlist_id, artist_name, new_genre]):
             return Response({'error': 'Missing required fields'}, status=400)
         
-        # Get the sorted tracks from session
-        sorted_tracks = request.session.get(f'sorted_tracks_{playlist_id}', {})
+        if not isinstance(new_genre, str):
+            return Response({'error': 'genre must be a string'}, status=400)
         
-        if not sorted_tracks:
-            return Response({'error': 'No tracks found'}, status=404)
+        # Get the sorted tracks for this session
+        sort_result = SortResult.lookup(get_session_key(request), playlist_id)
         
-        tracks_moved = 0
+        if not sort_result:
+            return Response({'error': 'No tracks found'}, status=404)
         
         # Search through all genres (or just the current one if specified)
-        genres_to_search = [current_genre] if current_genre and current_genre in sorted_tracks else sorted_tracks.keys()
-        
-        for genre in list(genres_to_search):
-            if genre == new_genre:  # Skip the target genre
-                continue
-                
-            if genre not in sorted_tracks:
-                continue
-                
-            tracks_to_move = []
-            remaining_tracks = []
-            
-            for track in sorted_tracks[genre]:
-                if track['artist'].lower() == artist_name.lower():
-                    tracks_to_move.append(track)
-                else:
-                    remaining_tracks.append(track)
-            
-            # Update the current genre
-            sorted_tracks[genre] = remaining_tracks
-            
-            # Add tracks to new genre
-            if new_genre not in sorted_tracks:
-                sorted_tracks[new_genre] = []
-            
-            # Check for duplicates before adding
-            existing_uris = {track['uri'] for track in sorted_tracks[new_genre]}
-            for track in tracks_to_move:
-                if track['uri'] not in existing_uris:
-                    sorted_tracks[new_genre].append(track)
-                    existing_uris.add(track['uri'])
-                    tracks_moved += 1
+        moved_uris = sort_result.move_artist_tracks(artist_name, new_genre, current_genre)
+        tracks_moved = len(moved_uris)
         
         if tracks_moved == 0:
             return Response({'error': f'No tracks by {artist_name} found'}, status=404)
         
-        # Update session
-        request.session[f'sorted_tracks_{playlist_id}'] = sorted_tracks
-        request.session.modified = True
-        
-        return Response({
+        return edit_response(request, sort_result, {
             'success': True,
             'message': f'Moved {tracks_moved} tracks by {artist_name} to {new_genre}',
             'tracks_moved': tracks_moved,
-            'genre_groups': sorted_tracks
-        })            
\ No newline at end of file
+        }, new_genre, moved_uris)
+
+class UndoGenreEditView(APIView):
+    def post(self, request, *args, **kwargs):
+        """
+        Undo the last genre edit of a playlist's grouping
+        """
+        return journal_step(request, undo=True)
+
+class RedoGenreEditView(APIView):
+    def post(self, request, *args, **kwargs):
+        """
+        Apply the last undone genre edit again
+        """
+        return journal_step(request, undo=False)
+
+class MetricsView(View):
+    """
+    Prometheus scrape endpoint: request, phase and Spotify call metrics plus
+    the current state of the connection pool, artist cache and rate limiter
+    """
+    def get(self, request, *args, **kwargs):
+        if not settings.METRICS_TOKEN:
+            # Unprotected metrics are for local development only
+            if not settings.DEBUG:
+                return JsonResponse({'error': 'Not found'}, status=404)
+        elif request.headers.get('Authorization') != f'Bearer {settings.METRICS_TOKEN}':
+            return JsonResponse({'error': 'Not authenticated'}, status=401)
+
+        pool = spotify_pool.stats()
+        cache = artist_genre_cache.stats()
+        gauges = [
+            ('spotify_clients_created', {}, pool['clients_created']),
+            ('spotify_token_refreshes', {}, pool['token_refreshes']),
+            ('spotify_rate_limit_current', {}, spotify_rate_limiter.rate),
+            ('artist_genre_cache_size', {}, cache['size']),
+            ('artist_genre_cache_hits', {}, cache['hits']),
+            ('artist_genre_cache_misses', {}, cache['misses']),
+            ('artist_genre_cache_snapshot_hits', {}, cache['snapshot_hits']),
+            ('sort_jobs_queued', {}, queued_jobs()),
+            ('sort_jobs_waiting_for_user_slot', {}, user_limiter.waiting()),
+            ('user_operations_in_flight', {}, user_limiter.in_flight()),
+            ('coalesced_operations_in_flight', {}, sort_flights.in_flight()),
+        ]
+        for host, host_stats in pool['hosts'].items():
+            gauges.append(('spotify_pool_connections_opened', {'host': host}, host_stats['connections_opened']))
+            gauges.append(('spotify_pool_idle_connections', {'host': host}, host_stats['idle_connections']))
+
+        return HttpResponse(metrics.render(gauges), content_type='text/plain; version=0.0.4')
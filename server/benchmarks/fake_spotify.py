@@ -0,0 +1,366 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-in for the parts of the Spotify Web API the app uses. Serves
+# a generated library from memory, with optional per-request latency and
+# randomly injected 429s, and counts requests and bytes per endpoint.
+# Track objects carry the fields the real API sends and the fields query
+# parameter filters them the same way, so byte counts reflect it. GETs carry
+# an ETag and answer If-None-Match with 304 Not Modified.
+
+GENRES = [
+    'pop', 'indie pop', 'bedroom pop', 'dance pop', 'art pop', 'k-pop', 'rock', 'indie rock',
+    'classic rock', 'garage rock', 'post-punk', 'alternative rock', 'hip hop', 'rap', 'trap',
+    'uk drill', 'boom bap', 'r&b', 'neo soul', 'soul', 'funk', 'disco', 'house', 'deep house',
+    'techno', 'drum and bass', 'ambient', 'jazz', 'bebop', 'cool jazz', 'folk', 'indie folk',
+    'country', 'americana', 'metal', 'metalcore', 'reggaeton', 'latin pop', 'afrobeats', 'lo-fi beats',
+]
+
+# Full tracks list about 180 markets, shared between objects to keep memory down
+MARKETS = [f'{a}{b}' for a in 'ABCDEFGHIJKLMNOPQR' for b in 'ABCDEFGHIJ']
+
+_FIELD_NAME = re.compile(r'[\w.]+')
+
+
+def parse_fields(spec):
+    """
+    'total,items(track(name,album(images(url))))' -> {'total': None,
+    'items': {'track': {...}}}, None meaning the whole value. Dotted names
+    ('tracks.total') nest the same way parentheses do.
+    """
+    def parse(i):
+        tree = {}
+        while i < len(spec):
+            match = _FIELD_NAME.match(spec, i)
+            if not match:
+                raise ValueError(f'Bad fields at {i}: {spec}')
+            *parents, name = match.group().split('.')
+            i = match.end()
+            node = tree
+            for parent in parents:
+                node = node.setdefault(parent, {})
+            if i < len(spec) and spec[i] == '(':
+                node[name], i = parse(i + 1)
+            else:
+                node[name] = None
+            if i < len(spec) and spec[i] == ',':
+                i += 1
+            elif i < len(spec) and spec[i] == ')':
+                return tree, i + 1
+        return tree, i
+    return parse(0)[0]
+
+
+def select_fields(data, tree):
+    """
+    The parts of data named by a parse_fields tree, lists are filtered item by item
+    """
+    if tree is None:
+        return data
+    if isinstance(data, list):
+        return [select_fields(item, tree) for item in data]
+    if isinstance(data, dict):
+        return {name: select_fields(data[name], subtree) for name, subtree in tree.items() if name in data}
+    return data
+
+
+class FakeLibrary:
+    """
+    Deterministic fake data: one playlist per requested size, sharing a pool
+    of artists that each carry a few genres
+    """
+    def __init__(self, sizes, seed=0):
+        rng = random.Random(seed)
+        artist_count = max(50, max(sizes) // 4)
+        self.artists = {}
+        for i in range(artist_count):
+            artist_id = f'artist{i:07d}'
+            genres = rng.sample(GENRES, rng.randint(0, 4)) if i % 20 else []
+            self.artists[artist_id] = {'id': artist_id, 'name': f'Artist {i}', 'genres': genres}
+
+        artist_ids = list(self.artists)
+        self.playlists = {}
+        for size in sizes:
+            playlist_id = f'playlist{size}'
+            tracks = []
+            for i in range(size):
+                artists = rng.sample(artist_ids, 2 if rng.random() < 0.2 else 1)
+                artist_objects = [self.artist_object(a) for a in artists]
+                track_id = f't{size}x{i:07d}'
+                tracks.append({
+                    'added_at': '2024-01-01T00:00:00Z',
+                    'added_by': {'id': 'benchmarkuser', 'type': 'user', 'uri': 'spotify:user:benchmarkuser'},
+                    'is_local': False,
+                    'track': {
+                        'id': track_id,
+                        'name': f'Track {i}',
+                        'uri': f'spotify:track:{track_id}',
+                        'href': f'https://api.spotify.com/v1/tracks/{track_id}',
+                        'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'},
+                        'external_ids': {'isrc': f'QZ{size % 1000:03d}{i:07d}'},
+                        'duration_ms': rng.randint(90000, 400000),
+                        'explicit': False,
+                        'popularity': rng.randint(0, 100),
+                        'track_number': 1,
+                        'disc_number': 1,
+                        'available_markets': MARKETS,
+                        'artists': artist_objects,
+                        'album': {
+                            'id': f'album{track_id}',
+                            'name': f'Album {i}',
+                            'album_type': 'album',
+                            'release_date': '2020-01-01',
+                            'total_tracks': 12,
+                            'available_markets': MARKETS,
+                            'artists': artist_objects[:1],
+                            'images': [
+                                {'url': f'https://i.scdn.co/image/{size}x{i}', 'height': 640, 'width': 640},
+                                {'url': f'https://i.scdn.co/image/{size}x{i}m', 'height': 300, 'width': 300},
+                                {'url': f'https://i.scdn.co/image/{size}x{i}s', 'height': 64, 'width': 64},
+                            ],
+                        },
+                    },
+                })
+            self.playlists[playlist_id] = {'snapshot_id': f'{playlist_id}-1', 'tracks': tracks}
+
+        # Playlists created through the API: id -> track uris, and id -> name
+        self.created = {}
+        self.created_names = {}
+        self._lock = threading.Lock()
+
+    def artist_object(self, artist_id):
+        # Simplified artist, as nested in tracks and albums
+        return {
+            'id': artist_id,
+            'name': self.artists[artist_id]['name'],
+            'type': 'artist',
+            'uri': f'spotify:artist:{artist_id}',
+            'href': f'https://api.spotify.com/v1/artists/{artist_id}',
+            'external_urls': {'spotify': f'https://open.spotify.com/artist/{artist_id}'},
+        }
+
+
+class FakeSpotifyServer:
+    """
+    Runs the stand-in on a local port in a background thread
+    """
+    def __init__(self, library, latency=0.0, rate_limit_probability=0.0, retry_after=0):
+        self.library = library
+        self.latency = latency
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(FakeSpotifyHandler):
+            fake = server
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f'http://{host}:{port}/v1/'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.rate_limited = 0
+
+    def counters(self):
+        with self._lock:
+            return {
+                'api_calls': sum(self.calls.values()),
+                'calls': dict(self.calls),
+                'rate_limited': self.rate_limited,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+            }
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    fake = None
+    # Keep-alive, like the real API
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, don't let them wait on delayed acks
+    disable_nagle_algorithm = True
+
+    ROUTES = [
+        ('GET', re.compile(r'^/v1/me/?$'), 'me'),
+        ('GET', re.compile(r'^/v1/me/playlists/?$'), 'my_playlists'),
+        ('GET', re.compile(r'^/v1/playlists/(?P<playlist_id>\w+)/?$'), 'playlist'),
+        ('GET', re.compile(r'^/v1/playlists/(?P<playlist_id>\w+)/tracks/?$'), 'playlist_tracks'),
+        ('POST', re.compile(r'^/v1/playlists/(?P<playlist_id>\w+)/tracks/?$'), 'add_tracks'),
+        ('POST', re.compile(r'^/v1/users/(?P<user_id>\w+)/playlists/?$'), 'create_playlist'),
+        ('GET', re.compile(r'^/v1/artists/?$'), 'artists'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        fake = self.fake
+
+        for route_method, pattern, name in self.ROUTES:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                break
+        else:
+            return self.respond(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+        with fake._lock:
+            fake.calls[name] += 1
+            fake.bytes_received += length
+
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        if fake.rate_limit_probability and random.random() < fake.rate_limit_probability:
+            with fake._lock:
+                fake.rate_limited += 1
+            return self.respond(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                                headers={'Retry-After': str(fake.retry_after)})
+
+        status, data = getattr(self, f'handle_{name}')(params, body, **match.groupdict())
+        if 'fields' in params and status == 200:
+            try:
+                data = select_fields(data, parse_fields(params['fields']))
+            except ValueError as e:
+                return self.respond(400, {'error': {'status': 400, 'message': str(e)}})
+        self.respond(status, data, etag=method == 'GET' and status == 200)
+
+    def respond(self, status, data, headers=None, etag=False):
+        payload = json.dumps(data).encode()
+        headers = dict(headers or {})
+        if etag:
+            headers['ETag'] = f'"{hashlib.md5(payload).hexdigest()}"'
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                status, payload = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        with self.fake._lock:
+            self.fake.bytes_sent += len(payload)
+
+    def page(self, items, params):
+        limit = int(params.get('limit', 20))
+        offset = int(params.get('offset', 0))
+        return {'items': items[offset:offset + limit], 'total': len(items), 'limit': limit, 'offset': offset}
+
+    def handle_me(self, params, body):
+        return 200, {'id': 'benchmarkuser', 'display_name': 'Benchmark User', 'images': []}
+
+    def handle_my_playlists(self, params, body):
+        library = self.fake.library
+        playlists = [
+            {
+                'id': playlist_id,
+                'name': playlist_id,
+                'snapshot_id': playlist['snapshot_id'],
+                'tracks': {'total': len(playlist['tracks'])},
+                'images': [{'url': f'https://i.scdn.co/image/{playlist_id}'}],
+            }
+            for playlist_id, playlist in library.playlists.items()
+        ]
+        with library._lock:
+            playlists += [
+                {
+                    'id': playlist_id,
+                    'name': library.created_names[playlist_id],
+                    'snapshot_id': f'{playlist_id}-{len(items)}',
+                    'tracks': {'total': len(items)},
+                    'images': [],
+                }
+                for playlist_id, items in library.created.items()
+            ]
+        # Pad the listing out to a realistically sized library
+        playlists += [
+            {'id': f'filler{i}', 'name': f'Playlist {i}', 'snapshot_id': f'filler{i}-1', 'tracks': {'total': 25}, 'images': []}
+            for i in range(200)
+        ]
+        return 200, self.page(playlists, params)
+
+    def handle_playlist(self, params, body, playlist_id):
+        library = self.fake.library
+        if playlist_id in library.playlists:
+            playlist = library.playlists[playlist_id]
+            return 200, {
+                'id': playlist_id,
+                'name': playlist_id,
+                'snapshot_id': playlist['snapshot_id'],
+                'owner': {'id': 'benchmarkuser', 'display_name': 'Benchmark User'},
+                # The real API embeds the first page of tracks
+                'tracks': self.page(playlist['tracks'], {'limit': 100}),
+            }
+        with library._lock:
+            created = library.created.get(playlist_id)
+        if created is None:
+            return 404, {'error': {'status': 404, 'message': 'Not found'}}
+        return 200, {'snapshot_id': f'{playlist_id}-{len(created)}', 'tracks': {'total': len(created)}}
+
+    def handle_playlist_tracks(self, params, body, playlist_id):
+        playlist = self.fake.library.playlists.get(playlist_id)
+        if playlist is None:
+            return 404, {'error': {'status': 404, 'message': 'Not found'}}
+        return 200, self.page(playlist['tracks'], params)
+
+    def handle_artists(self, params, body):
+        artists = self.fake.library.artists
+        return 200, {'artists': [artists.get(artist_id) for artist_id in params.get('ids', '').split(',')]}
+
+    def handle_create_playlist(self, params, body, user_id):
+        library = self.fake.library
+        with library._lock:
+            playlist_id = f'created{len(library.created)}'
+            library.created[playlist_id] = []
+            library.created_names[playlist_id] = body.get('name')
+        return 201, {'id': playlist_id, 'name': body.get('name')}
+
+    def handle_add_tracks(self, params, body, playlist_id):
+        library = self.fake.library
+        with library._lock:
+            items = library.created.get(playlist_id)
+            if items is None:
+                return 404, {'error': {'status': 404, 'message': 'Not found'}}
+            position = int(params.get('position', len(items)))
+            # spotipy posts the bare uri list, the API also accepts {"uris": [...]}
+            items[position:position] = body['uris'] if isinstance(body, dict) else body
+        return 201, {'snapshot_id': f'{playlist_id}-{len(items)}'}
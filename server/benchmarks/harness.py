@@ -0,0 +1,196 @@
+import json
+import math
+import time
+import tracemalloc
+
+from django.test import Client
+
+from api.genre_cache import artist_genre_cache
+from api.models import SortResult
+from api.user_cache import invalidate_user
+
+# Scenarios timed by `manage.py benchmark`. Each drives one endpoint through
+# the Django test client against the fake Spotify server, so timings cover
+# the whole view including its Spotify round trips.
+
+
+def percentile(samples, pct):
+    """
+    Nearest-rank percentile of a list of samples
+    """
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+class Scenario:
+    def __init__(self, name, run, setup=None, sized=True):
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.sized = sized
+
+
+class BenchmarkClient:
+    """
+    Test client logged in with a token that never expires, plus helpers to
+    reach the stored grouping
+    """
+    def __init__(self):
+        self.client = Client()
+        session = self.client.session
+        session['spotify_token_info'] = {'access_token': 'benchmark', 'expires_at': 2 ** 40}
+        session.save()
+        self.session_key = session.session_key
+
+    def get(self, path):
+        return self.client.get(path)
+
+    def post(self, path, data):
+        return self.client.post(path, json.dumps(data), content_type='application/json')
+
+    def largest_genres(self, playlist_id, count):
+        sort_result = SortResult.lookup(self.session_key, playlist_id)
+        groups = sort_result.as_genre_groups()
+        return sorted(groups, key=lambda genre: len(groups[genre]), reverse=True)[:count]
+
+
+def build_scenarios(client, library, size, classifier=''):
+    playlist_id = f'playlist{size}'
+    first_track = library.playlists[playlist_id]['tracks'][0]['track']
+    sort_path = f'/api/sort-playlist/{playlist_id}/?classifier={classifier}'
+    toggle = {'n': 0}
+
+    def next_genre():
+        toggle['n'] += 1
+        return f"benchmark {toggle['n'] % 2}"
+
+    def resort():
+        client.get(sort_path + '&refresh=true')
+
+    def combine():
+        return client.post('/api/combine-genres/', {
+            'playlist_id': playlist_id,
+            'genres': client.largest_genres(playlist_id, 2),
+        })
+
+    def resort_and_combine():
+        resort()
+        combine()
+
+    return [
+        Scenario('sort_cold', lambda: client.get(sort_path + '&refresh=true'), setup=artist_genre_cache.clear),
+        Scenario('sort_warm', lambda: client.get(sort_path + '&refresh=true')),
+        Scenario('sort_unchanged', lambda: client.get(sort_path)),
+        Scenario('genre_groups', lambda: client.get(f'/api/genre-groups/{playlist_id}/')),
+        Scenario('genre_groups_stream', lambda: client.get(f'/api/genre-groups/{playlist_id}/?stream=true')),
+        Scenario('genre_groups_columnar', lambda: client.get(f'/api/genre-groups/{playlist_id}/?columnar=true')),
+        Scenario('assign_genre', lambda: client.post('/api/assign-genre/', {
+            'playlist_id': playlist_id,
+            'track_uri': first_track['uri'],
+            'genre': next_genre(),
+        })),
+        Scenario('assign_genre_by_artist', lambda: client.post('/api/assign-genre-by-artist/', {
+            'playlist_id': playlist_id,
+            'artist_name': first_track['artists'][0]['name'],
+            'genre': next_genre(),
+        })),
+        Scenario('combine_genres', combine, setup=resort),
+        Scenario('undo_combine', lambda: client.post('/api/undo-edit/', {
+            'playlist_id': playlist_id,
+        }), setup=resort_and_combine),
+        Scenario('create_playlist', lambda: client.post('/api/create-playlist/', {
+            'playlist_id': playlist_id,
+            'genre': client.largest_genres(playlist_id, 1)[0],
+        })),
+    ]
+
+
+def playlists_scenario(client):
+    return Scenario('playlists', lambda: client.get('/api/playlists/'), setup=lambda: invalidate_user(client.session_key), sized=False)
+
+
+def read_response(response, start):
+    """
+    Reads the body chunk by chunk, without joining streamed responses, and
+    returns (bytes, seconds from start to the first chunk)
+    """
+    if not response.streaming:
+        return len(response.content), time.perf_counter() - start
+    size = 0
+    first_chunk = None
+    for chunk in response.streaming_content:
+        if first_chunk is None:
+            first_chunk = time.perf_counter() - start
+        size += len(chunk)
+    return size, first_chunk if first_chunk is not None else time.perf_counter() - start
+
+
+def run_scenario(scenario, fake, repeat):
+    """
+    Times `repeat` runs of a scenario, then one more under tracemalloc for
+    peak memory (tracing slows everything down, so it isn't timed)
+    """
+    timings = []
+    first_byte_timings = []
+    calls = rate_limited = bytes_sent = bytes_received = response_bytes = 0
+
+    for _ in range(repeat):
+        if scenario.setup:
+            scenario.setup()
+        fake.reset_counters()
+
+        start = time.perf_counter()
+        response = scenario.run()
+        if response.status_code >= 400:
+            raise RuntimeError(f"{scenario.name} returned {response.status_code}: {response.content[:200]!r}")
+        size, first_byte = read_response(response, start)
+        timings.append(time.perf_counter() - start)
+        first_byte_timings.append(first_byte)
+
+        counters = fake.counters()
+        calls += counters['api_calls']
+        rate_limited += counters['rate_limited']
+        bytes_sent += counters['bytes_sent']
+        bytes_received += counters['bytes_received']
+        response_bytes += size
+
+    if scenario.setup:
+        scenario.setup()
+    tracemalloc.start()
+    try:
+        read_response(scenario.run(), time.perf_counter())
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p90_ms': percentile(timings, 90) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+        'max_ms': max(timings) * 1000,
+        'first_byte_p50_ms': percentile(first_byte_timings, 50) * 1000,
+        'api_calls': calls / repeat,
+        'rate_limited': rate_limited / repeat,
+        'spotify_bytes': (bytes_sent + bytes_received) / repeat,
+        'response_bytes': response_bytes / repeat,
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Per-result changes against a baseline. A result regresses if its p50 got
+    more than threshold (a fraction) slower or it makes more Spotify calls.
+    """
+    changes = {}
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        p50_change = (result['p50_ms'] - base['p50_ms']) / base['p50_ms'] if base['p50_ms'] else 0
+        changes[key] = {
+            'p50_change': p50_change,
+            'api_calls_change': result['api_calls'] - base['api_calls'],
+            'regressed': p50_change > threshold or result['api_calls'] > base['api_calls'],
+        }
+    return changes
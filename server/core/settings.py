@@ -47,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.RequestMetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -87,6 +88,11 @@ DATABASES = {
     )
 }
 
+# Local SQLite: take the write lock when a transaction starts, so concurrent
+# sorts wait for each other instead of failing with "database is locked"
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default'].setdefault('OPTIONS', {}).update({'transaction_mode': 'IMMEDIATE', 'timeout': 20})
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -140,4 +146,81 @@ CORS_ALLOW_CREDENTIALS = True
 SESSION_COOKIE_SECURE = True
 SESSION_COOKIE_SAMESITE = 'None'
 CSRF_COOKIE_SECURE = True
-CSRF_COOKIE_SAMESITE = 'None'
\ No newline at end of file
+CSRF_COOKIE_SAMESITE = 'None'
+
+# Shared artist -> genres cache used when sorting playlists
+ARTIST_GENRE_CACHE_TTL = int(os.environ.get('ARTIST_GENRE_CACHE_TTL', 60 * 60 * 24 * 7))
+ARTIST_GENRE_CACHE_MAX_SIZE = int(os.environ.get('ARTIST_GENRE_CACHE_MAX_SIZE', 100000))
+# On-disk snapshot the cache falls back to, written by `manage.py snapshot_artist_genres`
+ARTIST_GENRE_SNAPSHOT_PATH = os.environ.get('ARTIST_GENRE_SNAPSHOT_PATH', os.path.join(BASE_DIR, 'artist_genres.sqlite3'))
+
+# Web API base url, only changed to point at a stand-in server (see `manage.py benchmark`)
+SPOTIFY_API_URL = os.environ.get('SPOTIFY_API_URL', 'https://api.spotify.com/v1/')
+
+# Spotify request concurrency and rate limiting. Spotify limits the app as a
+# whole (over a rolling 30 second window, the exact quota isn't published),
+# so one bucket is shared by every user in the process. It starts at
+# SPOTIFY_RATE_LIMIT requests per second and halves on each 429, so keep it
+# high enough that a 100-page playlist isn't throttled to a crawl by default.
+# With several worker processes, divide your app's quota between them.
+SPOTIFY_MAX_WORKERS = int(os.environ.get('SPOTIFY_MAX_WORKERS', 8))
+SPOTIFY_RATE_LIMIT = float(os.environ.get('SPOTIFY_RATE_LIMIT', 50))
+SPOTIFY_RATE_LIMIT_BURST = int(os.environ.get('SPOTIFY_RATE_LIMIT_BURST', 50))
+SPOTIFY_MAX_RETRIES = int(os.environ.get('SPOTIFY_MAX_RETRIES', 4))
+# Keep-alive connections to Spotify shared by every client in the process
+SPOTIFY_POOL_SIZE = int(os.environ.get('SPOTIFY_POOL_SIZE', 20))
+
+# Serve the Spotify-bound views from async handlers (only useful under ASGI)
+SPOTIFY_ASYNC_VIEWS = os.environ.get('SPOTIFY_ASYNC_VIEWS', 'False').lower() == 'true'
+if SPOTIFY_ASYNC_VIEWS:
+    # WhiteNoise's middleware is sync only. With it in the stack Django runs
+    # every async view through one thread and requests are served one at a
+    # time, so async deployments serve static files from the web server or
+    # a CDN instead (collectstatic still writes them to STATIC_ROOT)
+    MIDDLEWARE.remove('whitenoise.middleware.WhiteNoiseMiddleware')
+SPOTIFY_ASYNC_MAX_CONNECTIONS = int(os.environ.get('SPOTIFY_ASYNC_MAX_CONNECTIONS', 50))
+
+# Worker threads for background sort jobs
+SORT_JOB_WORKERS = int(os.environ.get('SORT_JOB_WORKERS', 4))
+# Unfinished jobs without progress for this many seconds are failed, jobs
+# live in an in-memory pool and are lost when their process restarts
+SORT_JOB_STALE_SECONDS = int(os.environ.get('SORT_JOB_STALE_SECONDS', 600))
+# Longest a progress stream stays open, EventSource clients then reconnect
+SORT_JOB_STREAM_SECONDS = int(os.environ.get('SORT_JOB_STREAM_SECONDS', 300))
+# Sorts and exports one user can have running at once, further requests get
+# a 429 and further sort jobs wait in the user's own queue
+USER_MAX_IN_FLIGHT = int(os.environ.get('USER_MAX_IN_FLIGHT', 2))
+
+# Redis when REDIS_URL is set so caches are shared between workers, local memory otherwise
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+        }
+    }
+
+# How long cached profile and playlist listings are served before revalidating
+SPOTIFY_USER_CACHE_TTL = int(os.environ.get('SPOTIFY_USER_CACHE_TTL', 60))
+
+# Seconds a stored grouping stays cached as packed sort state (see api/serializers.py)
+SORT_STATE_CACHE_TTL = int(os.environ.get('SORT_STATE_CACHE_TTL', 300))
+
+# orjson backed, reads and writes the same JSON as Django's default serializer
+SESSION_SERIALIZER = 'api.serializers.SessionSerializer'
+
+# Genre edits that can be undone, and how many journal entries pile up before
+# the older ones are compacted into the journal snapshot
+SORT_UNDO_DEPTH = int(os.environ.get('SORT_UNDO_DEPTH', 50))
+SORT_JOURNAL_COMPACT_EVERY = int(os.environ.get('SORT_JOURNAL_COMPACT_EVERY', 100))
+
+# Genre classifier used when a sort doesn't ask for one ('primary', 'weighted' or 'taxonomy'),
+# and how many groups at most the weighted classifier splits a playlist into
+GENRE_CLASSIFIER = os.environ.get('GENRE_CLASSIFIER', 'primary')
+GENRE_MAX_GROUPS = int(os.environ.get('GENRE_MAX_GROUPS', 20))
+# Depth the taxonomy classifier groups at when none is given, 1 is top-level genres
+GENRE_TAXONOMY_DEPTH = int(os.environ.get('GENRE_TAXONOMY_DEPTH', 1))
+
+# Bearer token required to read /api/metrics/. Without one the endpoint is
+# only served with DEBUG on, otherwise it 404s
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')